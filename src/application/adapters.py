@@ -2,6 +2,9 @@ from marshmallow import Schema, fields, validate, post_load
 
 from datetime import datetime
 
+from src.application.codec import default
+from src.core.entity.user import Message
+
 
 class Timestamp(fields.Int):
 
@@ -42,6 +45,19 @@ class MessageSchema(Schema):
     created_at = Timestamp(dump_only=True)
 
 
+# fields of a message sent to clients, the same as the MessageSchema dump
+MESSAGE_FIELDS = ('id', 'creator_id', 'room_id', 'msg_type', 'msg_body', 'created_at')
+
+
+def message_data(message: Message) -> dict:
+    """ Message as it is sent to clients without a schema dump, datetimes are int timestamps """
+    data = {}
+    for name in MESSAGE_FIELDS:
+        value = getattr(message, name)
+        data[name] = default(value) if isinstance(value, datetime) else value
+    return data
+
+
 class CreateRoomSchema(Schema):
     # private = fields.Boolean()
     members_id = fields.List(fields.Int())
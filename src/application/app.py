@@ -10,6 +10,8 @@ from src.application.handlers.http import views as http_views
 from src.application.handlers.websocket import connection
 from src.application.containers import Container, container_middleware
 from src.application.ws.server import WebSocketServer
+from src.application.ws.compression import CompressionConfig
+from src.application.ws.ratelimit import RateLimitConfig, parse_costs
 from src.application.db import metadata
 
 logging.basicConfig(level=logging.DEBUG)
@@ -28,10 +30,32 @@ async def index(request: web.Request) -> web.Response:
     )
 
 
+async def stats(request: web.Request) -> web.Response:
+    """ counters of the websocket server and the in-process caches of this worker """
+    app = request.app
+    data = app.ws_server.stats()
+    for name in ("presence_store", "room_membership", "recent_messages", "message_writer"):
+        component = getattr(app.container, name)()
+        # optional components are None when disabled by config
+        data[name] = component.stats() if component is not None else None
+    return web.json_response(data, dumps=app['codec'].dumps)
+
+
+async def on_startup(app: web.Application):
+    app.container.presence_store().start()
+    await app.ws_server.start()
+
+
 async def on_shutdown(app: web.Application):
     print("SHUTDOWN")
+    # all sessions are closed and their offline transitions are in the store
     await app.ws_server.shutdown()
+    await app.container.presence_store().stop()
+    message_writer = app.container.message_writer()
+    if message_writer is not None:
+        await message_writer.close()
     await app.container.shutdown_resources()
+    await app.container.engine().dispose()
 
 
 async def app_factory():
@@ -42,10 +66,56 @@ async def app_factory():
                 db_password=os.getenv("DB_PASS"),
                 db_host=os.getenv("DB_HOST"),
                 db_name=os.getenv("DB_NAME"),
+                db_pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+                db_max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+                db_pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+                db_pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "1") == "1",
+                db_statement_timeout=int(os.getenv("DB_STATEMENT_TIMEOUT", 10000)),
                 neo4j_host=os.getenv("NEO4J_HOST"),
                 neo4j_port=7474,
                 neo4j_db_name="neo4j",
                 neo4j_password=os.getenv("NEO4J_PASS"),
+                json_codec=os.getenv("JSON_CODEC", "orjson"),
+                ws_queue_size=int(os.getenv("WS_QUEUE_SIZE", 256)),
+                ws_overflow_policy=os.getenv("WS_OVERFLOW_POLICY", "drop_oldest"),
+                ws_max_in_flight=int(os.getenv("WS_MAX_IN_FLIGHT", 8)),
+                ws_max_batch_size=int(os.getenv("WS_MAX_BATCH_SIZE", 32)),
+                ws_presence_grace=float(os.getenv("WS_PRESENCE_GRACE", 5)),
+                ws_presence_sync_interval=float(os.getenv("WS_PRESENCE_SYNC_INTERVAL", 5)),
+                ws_ping_interval=float(os.getenv("WS_PING_INTERVAL", 30)),
+                ws_ping_timeout=float(os.getenv("WS_PING_TIMEOUT", 10)),
+                ws_drain_timeout=float(os.getenv("WS_DRAIN_TIMEOUT", 20)),
+                ws_drain_concurrency=int(os.getenv("WS_DRAIN_CONCURRENCY", 512)),
+                ws_reconnect_delay=float(os.getenv("WS_RECONNECT_DELAY", 5)),
+                ws_rate_limit=os.getenv("WS_RATE_LIMIT", "1") == "1",
+                ws_rate=float(os.getenv("WS_RATE", 20)),
+                ws_burst=float(os.getenv("WS_BURST", 40)),
+                ws_user_rate=float(os.getenv("WS_USER_RATE", 40)),
+                ws_user_burst=float(os.getenv("WS_USER_BURST", 80)),
+                ws_resource_costs=os.getenv("WS_RESOURCE_COSTS", ""),
+                ws_max_frame_size=int(os.getenv("WS_MAX_FRAME_SIZE", 64 * 1024)),
+                ws_replay_events=int(os.getenv("WS_REPLAY_EVENTS", 256)),
+                ws_replay_bytes=int(os.getenv("WS_REPLAY_BYTES", 256 * 1024)),
+                auth_cache_size=int(os.getenv("AUTH_CACHE_SIZE", 10000)),
+                auth_cache_ttl=float(os.getenv("AUTH_CACHE_TTL", 300)),
+                auth_cache_negative_ttl=float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", 5)),
+                presence_flush_interval=float(os.getenv("PRESENCE_FLUSH_INTERVAL", 2)),
+                room_index_size=int(os.getenv("ROOM_INDEX_SIZE", 100000)),
+                message_page_size=int(os.getenv("MESSAGE_PAGE_SIZE", 100)),
+                changes_page_size=int(os.getenv("CHANGES_PAGE_SIZE", 100)),
+                recent_messages_per_room=int(os.getenv("RECENT_MESSAGES_PER_ROOM", 100)),
+                recent_messages_max_bytes=int(os.getenv("RECENT_MESSAGES_MAX_BYTES", 32 * 1024 * 1024)),
+                message_search_page_size=int(os.getenv("MESSAGE_SEARCH_PAGE_SIZE", 20)),
+                message_writer=os.getenv("MESSAGE_WRITER", "direct"),
+                message_writer_batch=int(os.getenv("MESSAGE_WRITER_BATCH", 100)),
+                message_writer_latency=float(os.getenv("MESSAGE_WRITER_LATENCY", 0.005)),
+                ws_compress=os.getenv("WS_COMPRESS", "1") == "1",
+                ws_compress_threshold=int(os.getenv("WS_COMPRESS_THRESHOLD", 512)),
+                ws_compress_window_bits=int(os.getenv("WS_COMPRESS_WINDOW_BITS", 15)),
+                ws_compress_mem_level=int(os.getenv("WS_COMPRESS_MEM_LEVEL", 8)),
+                ws_compress_no_takeover=os.getenv("WS_COMPRESS_NO_TAKEOVER", "0") == "1",
+                ws_bus=os.getenv("WS_BUS", "local"),
+                ws_bus_path=os.getenv("WS_BUS_PATH", "/tmp/ws-chat-bus.sock"),
                 )
     container.config.from_dict(
         conf
@@ -64,7 +134,41 @@ async def app_factory():
     # ws_worker = WsWorker(user_repo=await container.user_repo(), friends_repo=FriendsRepo(),
     #                      ws_client_repo=ws_client_repo)
     ws_server = WebSocketServer(user_repo=container.user_repo(),
-                                ws_connection_repo=container.ws_connection_repo())
+                                ws_connection_repo=container.ws_connection_repo(),
+                                session_queue_size=container.config.ws_queue_size(),
+                                session_overflow_policy=container.config.ws_overflow_policy(),
+                                bus=container.broadcast_bus(),
+                                max_in_flight=container.config.ws_max_in_flight(),
+                                max_batch_size=container.config.ws_max_batch_size(),
+                                presence_grace=container.config.ws_presence_grace(),
+                                presence_sync_interval=container.config.ws_presence_sync_interval(),
+                                ping_interval=container.config.ws_ping_interval(),
+                                ping_timeout=container.config.ws_ping_timeout(),
+                                drain_timeout=container.config.ws_drain_timeout(),
+                                drain_concurrency=container.config.ws_drain_concurrency(),
+                                reconnect_delay=container.config.ws_reconnect_delay(),
+                                rate_limit=RateLimitConfig(
+                                    enabled=container.config.ws_rate_limit(),
+                                    session_rate=container.config.ws_rate(),
+                                    session_burst=container.config.ws_burst(),
+                                    user_rate=container.config.ws_user_rate(),
+                                    user_burst=container.config.ws_user_burst(),
+                                    costs=parse_costs(container.config.ws_resource_costs()),
+                                    max_frame_size=container.config.ws_max_frame_size(),
+                                ),
+                                replay_events=container.config.ws_replay_events(),
+                                replay_bytes=container.config.ws_replay_bytes(),
+                                token_cache=container.token_cache(),
+                                unit_of_work=container.unit_of_work,
+                                db_pool=container.engine().pool,
+                                codec=container.codec(),
+                                compression=CompressionConfig(
+                                    enabled=container.config.ws_compress(),
+                                    threshold=container.config.ws_compress_threshold(),
+                                    window_bits=container.config.ws_compress_window_bits(),
+                                    mem_level=container.config.ws_compress_mem_level(),
+                                    no_context_takeover=container.config.ws_compress_no_takeover(),
+                                ))
     ws_server.register_command_handlers((
         ('friend', await container.friend_command_handler()),
         ('message', await container.message_command_handler()),
@@ -76,16 +180,20 @@ async def app_factory():
         ('friend_request', await container.friend_request_query_handler()),
         ('room', await container.room_query_handler()),
         ('message', container.message_query_handler()),
+        ('message_search', container.message_search_handler()),
     ))
-    ws_server.connect_handler = container.connect_handler
-    ws_server.disconnect_handler = container.disconnect_handler
+    ws_server.register_connection_handlers(
+        connect_handler=await container.connect_handler(),
+        disconnect_handler=await container.disconnect_handler()
+    )
 
     app.ws_server = ws_server
     app['salt'] = os.getenv("SALT")
+    app['codec'] = container.codec()
 
     # await ahsa.init_db(app, metadata)
 
-    app.add_routes([web.get('/connect', ws_server.handle)])
+    app.add_routes([web.get('/connect', ws_server.handle), web.get('/stats', stats)])
     for method, path, handler in http_views:
         app.router.add_route(method, path, handler)
 
@@ -101,5 +209,6 @@ async def app_factory():
     for route in list(app.router.routes()):
         cors.add(route)
 
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     return app
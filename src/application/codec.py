@@ -0,0 +1,144 @@
+import json
+import logging
+from dataclasses import asdict, is_dataclass
+from datetime import datetime
+from enum import Enum
+from typing import Any, Dict, Hashable
+
+
+logger = logging.getLogger(__name__)
+
+
+def default(obj):
+    # datetime is sent as int timestamp, the same as adapters.Timestamp field
+    if isinstance(obj, datetime):
+        return int(obj.timestamp())
+    if isinstance(obj, Enum):
+        return obj.value
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JsonCodec:
+    name = 'json'
+    # codecs with the same format produce interchangeable frames
+    format = 'json'
+    binary = False
+    # raised by loads() for malformed input, JSONDecodeError of json and orjson is a ValueError
+    decode_errors = (ValueError, RecursionError)
+
+    def dumps(self, obj: Any) -> str:
+        return json.dumps(obj, default=default)
+
+    def loads(self, data) -> Any:
+        return json.loads(data)
+
+    def prepend(self, encoded: str, key: str, value: Any) -> str:
+        """ Add a field to the encoded object without encoding the whole object again """
+        field = f'{self.dumps(key)}:{self.dumps(value)}'
+        if encoded == '{}':
+            return '{' + field + '}'
+        return '{' + field + ',' + encoded[1:]
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+        self._option = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj: Any) -> str:
+        return self._orjson.dumps(obj, default=default, option=self._option).decode()
+
+    def loads(self, data) -> Any:
+        return self._orjson.loads(data)
+
+
+class MsgpackCodec:
+    """ Binary codec, string values of `codes` fields are sent as integers """
+    name = 'msgpack'
+    format = 'msgpack'
+    binary = True
+
+    def __init__(self, codes: Dict[str, Dict[str, int]] = None):
+        import msgpack
+        self._msgpack = msgpack
+        # ExtraData and FormatError are ValueErrors, unhashable map keys a TypeError
+        self.decode_errors = (ValueError, TypeError, msgpack.UnpackException)
+        self.codes = codes or {}
+        # several names may share a code, the first one is used for decoding
+        self._names = {}
+        for field, field_codes in self.codes.items():
+            names = self._names[field] = {}
+            for value, code in field_codes.items():
+                names.setdefault(code, value)
+
+    @staticmethod
+    def _translate(data, table: Dict[str, Dict]):
+        if not isinstance(data, dict):
+            return data
+        for field, field_codes in table.items():
+            value = data.get(field)
+            if isinstance(value, Hashable) and value in field_codes:
+                data = {**data, field: field_codes[value]}
+        return data
+
+    def _encode_event(self, obj):
+        obj = self._translate(obj, self.codes)
+        if isinstance(obj, dict):
+            # echo of the query/command in responses
+            for key in ('query', 'command'):
+                if isinstance(obj.get(key), dict):
+                    obj = {**obj, key: self._translate(obj[key], self.codes)}
+            if isinstance(obj.get('batch'), list):
+                obj = {**obj, 'batch': [self._encode_event(item) for item in obj['batch']]}
+        return obj
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._msgpack.packb(self._encode_event(obj), default=default, use_bin_type=True)
+
+    def prepend(self, encoded: bytes, key: str, value: Any) -> bytes:
+        """ Add a field to the encoded map without encoding the whole map again """
+        head = encoded[0]
+        if 0x80 <= head <= 0x8f:
+            size, body = head & 0x0f, encoded[1:]
+        elif head == 0xde:
+            size, body = int.from_bytes(encoded[1:3], 'big'), encoded[3:]
+        elif head == 0xdf:
+            size, body = int.from_bytes(encoded[1:5], 'big'), encoded[5:]
+        else:
+            raise ValueError("Encoded object is not a map")
+        size += 1
+        if size < 16:
+            header = bytes((0x80 | size,))
+        elif size < 1 << 16:
+            header = b'\xde' + size.to_bytes(2, 'big')
+        else:
+            header = b'\xdf' + size.to_bytes(4, 'big')
+        return header + self._msgpack.packb(key) + self._msgpack.packb(value) + body
+
+    def loads(self, data) -> Any:
+        obj = self._msgpack.unpackb(data, raw=False)
+        if isinstance(obj, list):
+            return [self._translate(item, self._names) for item in obj]
+        return self._translate(obj, self._names)
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    OrjsonCodec.name: OrjsonCodec,
+}
+
+
+def get_codec(name: str = 'orjson') -> JsonCodec:
+    """ Codec by name, falls back to stdlib json if the backend isn't installed """
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, expected one of {list(CODECS)}")
+    try:
+        return CODECS[name]()
+    except ImportError:
+        logger.warning(f"codec {name} is not available, fallback to {JsonCodec.name}")
+        return JsonCodec()
@@ -1,22 +1,34 @@
+import time
+from contextvars import ContextVar
 from typing import Awaitable, Callable, Optional
 
 from aiohttp.web import Request, StreamResponse, middleware
-from dependency_injector import containers, providers, resources
-from dependency_injector.resources import T
+from dependency_injector import containers, providers
+from sqlalchemy import exc as sa_exc
 from sqlalchemy.ext.asyncio import (
     AsyncSession,
+    async_scoped_session,
     create_async_engine,
 )
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from src.infra.notificator import Notificator
 from src.data.user.repo import UserRepo
+from src.data.user.cache import TokenCache
+from src.data.user.membership import RoomMembershipIndex
+from src.data.user.writer import MessageWriter
+from src.data.user.presence import PresenceStore
 from src.data.frineds.repo import FriendsRepo
 from src.core.usecase.auth.register import UseCase as RegisterUseCase
 from src.core.usecase.auth.login import UseCase as LoginUseCase
+from src.core.usecase.auth.logout import UseCase as LogoutUseCase
 from src.core.usecase.auth.reset_pass import UseCase as ResetPassUseCase
 from src.core.usecase.auth.reset_pass_confirm import UseCase as ResetPassConfirmUseCase
 from src.application.handlers.websocket import query, connection, command
+from src.application.ws.bus import LocalBroadcastBus, UnixSocketBroadcastBus
+from src.application.ws.recent import RecentMessageCache
+from src.application.codec import get_codec
 
 
 THandler = Callable[..., Awaitable[StreamResponse]]
@@ -32,26 +44,82 @@ class TestUseCase:
         return
 
 
-def db_engine(user, password, host, db_name):
-    return create_async_engine(f'postgresql+asyncpg://{user}:{password}@{host}/{db_name}')
+class MeteredPool(AsyncAdaptedQueuePool):
+    """ Queue pool which measures how long checkouts wait for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sa_exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait_time = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def stats(self):
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "overflow": self.overflow(),
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "avg_wait_time": round(self.wait_time / self.checkouts, 6) if self.checkouts else 0.0,
+            "max_wait_time": round(self.max_wait_time, 6),
+        }
+
+
+def db_engine(user, password, host, db_name, pool_size=10, max_overflow=10, pool_timeout=30.0,
+              pool_pre_ping=True, statement_timeout=0):
+    connect_args = {}
+    if statement_timeout:
+        # milliseconds, set for every connection of the pool
+        connect_args["server_settings"] = {"statement_timeout": str(statement_timeout)}
+    return create_async_engine(
+        f'postgresql+asyncpg://{user}:{password}@{host}/{db_name}',
+        poolclass=MeteredPool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=pool_pre_ping,
+        connect_args=connect_args
+    )
 
 
-def session_factory(engine):
-    return sessionmaker(
-        bind=engine,
-        class_=AsyncSession,
-        expire_on_commit=False,
-        autocommit=False
-    )
+# key of the current unit of work, None outside of any
+db_scope: "ContextVar[Optional[object]]" = ContextVar("db_scope", default=None)
 
 
-class DbSessionResource(resources.Resource):
+class UnitOfWork:
+    """ Scope of one AsyncSession.
 
-    def init(self, factory) -> Optional[T]:
-        return factory()
+    Repos hold the scoped session proxy, inside the scope it resolves to a session of
+    its own which is closed (connection returned to the pool) on exit.
+    """
 
-    async def shutdown(self, session: Optional[T]) -> None:
-        await session.close()
+    def __init__(self, scoped_session: async_scoped_session):
+        self.scoped_session = scoped_session
+        self._token = None
+
+    async def __aenter__(self):
+        self._token = db_scope.set(object())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self.scoped_session.remove()
+        finally:
+            db_scope.reset(self._token)
 
 
 async def init_friend_repo(host, port, db_name, password):
@@ -69,7 +137,12 @@ class Container(containers.DeclarativeContainer):
         user=config.db_user,
         password=config.db_password,
         host=config.db_host,
-        db_name=config.db_name
+        db_name=config.db_name,
+        pool_size=config.db_pool_size,
+        max_overflow=config.db_max_overflow,
+        pool_timeout=config.db_pool_timeout,
+        pool_pre_ping=config.db_pool_pre_ping,
+        statement_timeout=config.db_statement_timeout
     )
     session_factory = providers.Singleton(
         sessionmaker,
@@ -79,9 +152,15 @@ class Container(containers.DeclarativeContainer):
         autocommit=False
     )
 
-    db_session = providers.Resource(
-        DbSessionResource,
-        factory=session_factory
+    db_session = providers.Singleton(
+        async_scoped_session,
+        session_factory,
+        scopefunc=db_scope.get
+    )
+
+    unit_of_work = providers.Factory(
+        UnitOfWork,
+        scoped_session=db_session
     )
 
     notificator = providers.Factory(
@@ -114,6 +193,73 @@ class Container(containers.DeclarativeContainer):
         dict
     )
 
+    # logout in another worker would not evict the token, the cache is only used with one worker
+    token_cache = providers.Selector(
+        config.ws_bus,
+        local=providers.Singleton(
+            TokenCache,
+            max_size=config.auth_cache_size,
+            ttl=config.auth_cache_ttl,
+            negative_ttl=config.auth_cache_negative_ttl
+        ),
+        unix=providers.Object(None)
+    )
+
+    # rooms deleted by other workers would be missed, the index is only used with one worker
+    room_membership = providers.Selector(
+        config.ws_bus,
+        local=providers.Singleton(
+            RoomMembershipIndex,
+            max_rooms=config.room_index_size
+        ),
+        unix=providers.Object(None)
+    )
+
+    presence_store = providers.Singleton(
+        PresenceStore,
+        unit_of_work=unit_of_work.provider,
+        user_repo=user_repo,
+        flush_interval=config.presence_flush_interval
+    )
+
+    # messages written by other workers would be missed, the cache is only used with one worker
+    recent_messages = providers.Selector(
+        config.ws_bus,
+        local=providers.Singleton(
+            RecentMessageCache,
+            per_room=config.recent_messages_per_room,
+            max_bytes=config.recent_messages_max_bytes
+        ),
+        unix=providers.Object(None)
+    )
+
+    message_writer = providers.Selector(
+        config.message_writer,
+        direct=providers.Object(None),
+        batch=providers.Singleton(
+            MessageWriter,
+            unit_of_work=unit_of_work.provider,
+            user_repo=user_repo,
+            max_batch=config.message_writer_batch,
+            max_latency=config.message_writer_latency
+        )
+    )
+
+    codec = providers.Singleton(
+        get_codec,
+        config.json_codec
+    )
+
+    broadcast_bus = providers.Selector(
+        config.ws_bus,
+        local=providers.Singleton(LocalBroadcastBus),
+        unix=providers.Singleton(
+            UnixSocketBroadcastBus,
+            path=config.ws_bus_path,
+            codec=codec
+        )
+    )
+
     register_use_case = providers.Factory(
         RegisterUseCase,
         user_repo=user_repo,
@@ -126,6 +272,12 @@ class Container(containers.DeclarativeContainer):
         user_repo=user_repo
     )
 
+    logout_use_case = providers.Factory(
+        LogoutUseCase,
+        user_repo=user_repo,
+        token_cache=token_cache
+    )
+
     reset_password_use_case = providers.Factory(
         ResetPassUseCase,
         user_repo=user_repo,
@@ -134,71 +286,93 @@ class Container(containers.DeclarativeContainer):
 
     reset_password_confirm_use_case = providers.Factory(
         ResetPassConfirmUseCase,
-        user_repo=user_repo
+        user_repo=user_repo,
+        token_cache=token_cache
     )
 
     # chat_repo = providers.Factory(
     #
     # )
-    connect_handler = providers.Factory(
+    # websocket handlers are resolved once, repos use the scoped db session of the current unit of work
+    connect_handler = providers.Singleton(
         connection.OnConnectHandler,
         friend_repo=friend_repo,
         user_repo=user_repo,
-        ws_connection_repo=ws_connection_repo
+        ws_connection_repo=ws_connection_repo,
+        presence_store=presence_store
     )
 
-    disconnect_handler = providers.Factory(
+    disconnect_handler = providers.Singleton(
         connection.OnDisconnectHandler,
         friend_repo=friend_repo,
         user_repo=user_repo,
-        ws_connection_repo=ws_connection_repo
+        ws_connection_repo=ws_connection_repo,
+        presence_store=presence_store
     )
 
-    user_search_handler = providers.Factory(
+    user_search_handler = providers.Singleton(
         query.UserSearchQueryHandler,
         user_repo=user_repo,
         friend_repo=friend_repo,
+        presence_store=presence_store
     )
 
-    friend_query_handler = providers.Factory(
+    friend_query_handler = providers.Singleton(
         query.FriendQueryHandler,
         user_repo=user_repo,
-        friend_repo=friend_repo
-
+        friend_repo=friend_repo,
+        presence_store=presence_store,
+        page_size=config.changes_page_size
     )
-    friend_request_query_handler = providers.Factory(
+    friend_request_query_handler = providers.Singleton(
         query.FriendRequestQueryHandler,
         user_repo=user_repo,
-        friend_repo=friend_repo
+        friend_repo=friend_repo,
+        presence_store=presence_store
     )
 
-    room_query_handler = providers.Factory(
+    room_query_handler = providers.Singleton(
         query.RoomQueryHandler,
         user_repo=user_repo,
-        friend_repo=friend_repo
+        friend_repo=friend_repo,
+        membership=room_membership,
+        page_size=config.changes_page_size
     )
 
-    message_query_handler = providers.Factory(
+    message_query_handler = providers.Singleton(
         query.MessageQueryHandler,
-        user_repo=user_repo
+        user_repo=user_repo,
+        page_size=config.message_page_size,
+        recent_messages=recent_messages
+    )
+
+    message_search_handler = providers.Singleton(
+        query.MessageSearchQueryHandler,
+        user_repo=user_repo,
+        page_size=config.message_search_page_size
     )
 
     # COMMAND
 
-    friend_command_handler = providers.Factory(
+    friend_command_handler = providers.Singleton(
         command.FriendCommandHandler,
         friend_repo=friend_repo
     )
 
-    room_command_handler = providers.Factory(
+    room_command_handler = providers.Singleton(
         command.RoomCommandHandler,
         user_repo=user_repo,
-        friend_repo=friend_repo
+        friend_repo=friend_repo,
+        membership=room_membership,
+        page_size=config.changes_page_size
     )
-    message_command_handler = providers.Factory(
+    message_command_handler = providers.Singleton(
         command.MessageCommandHandler,
         user_repo=user_repo,
-        friend_repo=friend_repo
+        friend_repo=friend_repo,
+        membership=room_membership,
+        message_writer=message_writer,
+        recent_messages=recent_messages
     )
 
 
@@ -212,7 +386,6 @@ class ContainerContextWrapper:
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
-        # await self.container.db_session.shutdown()
 
 
 def container_middleware(container: Container) -> THandler:
@@ -225,7 +398,8 @@ def container_middleware(container: Container) -> THandler:
         handler: THandler,
     ) -> StreamResponse:
 
-        async with context_container as request['di']:
+        # every request has own db session, websocket events open nested units of work
+        async with container.unit_of_work(), context_container as request['di']:
             return await handler(request)
 
     return container_middleware_
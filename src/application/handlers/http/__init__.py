@@ -1,9 +1,10 @@
-from .auth import RegisterView, ConfirmationView, LoginView, ResetPasswordConfirmView, ResetPasswordView
+from .auth import RegisterView, ConfirmationView, LoginView, LogoutView, ResetPasswordConfirmView, ResetPasswordView
 
 views = (
     ('*', '/register', RegisterView),
     ('*', '/confirm', ConfirmationView),
     ('*', '/login', LoginView),
+    ('*', '/logout', LogoutView),
     ('*', '/reset_password', ResetPasswordView),
     ('*', '/reset_password_confirm', ResetPasswordConfirmView),
 )
@@ -0,0 +1,15 @@
+from aiohttp import web
+from aiohttp_cors import CorsViewMixin
+
+
+class BaseView(web.View, CorsViewMixin):
+
+    @property
+    def codec(self):
+        return self.request.app['codec']
+
+    async def json(self):
+        return self.codec.loads(await self.request.read())
+
+    def json_response(self, data, status: int = 200) -> web.Response:
+        return web.json_response(data, status=status, dumps=self.codec.dumps)
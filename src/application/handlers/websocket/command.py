@@ -1,12 +1,15 @@
-from typing import List
+from typing import List, Optional
 from marshmallow import ValidationError
-from src.core.exceptions.base import ValidationError as DomainValidationError, NotFoundError
+from src.core.exceptions.base import ValidationError as DomainValidationError, NotFoundError, ForbiddenError
 from src.application.ws.event import Command, Broadcast, CommandDoneEvent
 from src.application.ws.base import WebsocketSession
 from src.application.ws.server import BaseCommandHandler
 from src.data.frineds.repo import FriendsRepo
 from src.data.user.repo import UserRepo
-from src.application.adapters import MessageSchema
+from src.data.user.membership import RoomMembershipIndex
+from src.data.user.writer import MessageWriter
+from src.application.ws.recent import RecentMessageCache
+from src.application.adapters import MessageSchema, message_data
 
 
 class FriendCommandHandler(BaseCommandHandler):
@@ -16,7 +19,7 @@ class FriendCommandHandler(BaseCommandHandler):
     async def create(self, command: Command, session: WebsocketSession) -> List[Broadcast]:
         friend_id = command.payload.get('user_id')
         if not friend_id:
-            session.ws.send_json(DomainValidationError("not found user_id in create friend payload").to_dict())
+            session.send_json(DomainValidationError("not found user_id in create friend payload").to_dict())
             return []
         user_id = session.user_id
         await self.friend_repo.create_friendship(user_id, friend_id)
@@ -24,52 +27,83 @@ class FriendCommandHandler(BaseCommandHandler):
 
 
 class RoomCommandHandler(BaseCommandHandler):
-    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo):
+    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo,
+                 membership: Optional[RoomMembershipIndex] = None):
         self.friend_repo = friend_repo
         self.user_repo = user_repo
+        self.membership = membership
 
     async def create(self, command: Command, session: WebsocketSession) -> List[Broadcast]:
         members_id = command.payload.get('members_id')
         if not members_id:
-            await session.ws.send_json(DomainValidationError("members_id: Missing").to_dict())
+            session.send_json(DomainValidationError("members_id: Missing").to_dict())
             return []
         try:
             members_id.append(session.user_id)
             members_id = list(set(members_id))
-            room_id = await self.user_repo.create_room(creator_id=session.user_id, members_id=members_id,
+            room = await self.user_repo.create_room(creator_id=session.user_id, members_id=members_id,
                                                        private=command.payload.get('private', True))
         # todo NotFound, NotUnique
         except:
             raise
         await self.user_repo.commit()
+        if self.membership is not None:
+            self.membership.set_room(room.id, room.members_id)
         return [Broadcast(receivers=members_id,
-                          event=CommandDoneEvent(command=command, user_id=session.user_id, result={"id": room_id}))]
+                          event=CommandDoneEvent(command=command, user_id=session.user_id, result={"id": room.id}))]
 
 
 class MessageCommandHandler(BaseCommandHandler):
-    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo):
+    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo,
+                 membership: Optional[RoomMembershipIndex] = None,
+                 message_writer: Optional[MessageWriter] = None,
+                 recent_messages: Optional[RecentMessageCache] = None):
         self.user_repo = user_repo
         self.friend_repo = friend_repo
+        # room members without a room read per message, the room is always read without it
+        self.membership = membership
+        # group commit of messages, each message is committed on its own without it
+        self.message_writer = message_writer
+        self.recent_messages = recent_messages
+
+    async def room_members(self, room_id: int):
+        """ member ids from the index, the room is read only on a miss """
+        if self.membership is not None:
+            members = self.membership.members(room_id)
+            if members is not None:
+                return members
+        room_list = await self.user_repo.get_rooms(self.user_repo.RoomSearchSpec(id_list=[room_id]))
+        if self.membership is not None:
+            self.membership.update(room_list)
+        return next((frozenset(room.members_id) for room in room_list
+                     if room.id == room_id and not room.deleted_at), None)
 
     async def create(self, command: Command, session: WebsocketSession) -> List[Broadcast]:
         try:
             payload = MessageSchema().load(command.payload)
         except ValidationError as err:
-            await session.ws.send_json(DomainValidationError(err.normalized_messages()).to_dict())
+            session.send_json(DomainValidationError(err.normalized_messages()).to_dict())
             return []
-        spec = self.user_repo.RoomSearchSpec(id_list=[payload.get('room_id')])
-        room_list = await self.user_repo.get_rooms(spec)
-        try:
-            room = room_list[0]
-        except IndexError:
-            session.ws.send_json(NotFoundError(obj="Room", search_spec=spec).to_dict())
+        members = await self.room_members(payload['room_id'])
+        if members is None:
+            session.send_json(NotFoundError(obj="Room", search_spec={"room_id": payload['room_id']}).to_dict())
+            return []
+        if session.user_id not in members:
+            session.send_json(ForbiddenError(f"Not a member of room {payload['room_id']}").to_dict())
             return []
 
-        msg_id = await self.user_repo.create_message(creator_id=session.user_id,
-                                                     room_id=payload['room_id'],
-                                                     msg_type=payload['msg_type'],
-                                                     msg_body=payload['msg_body'])
-        await self.user_repo.commit()
-        message_list = await self.user_repo.get_messages(self.user_repo.MessageSearchSpec(message_id=msg_id))
-        return [Broadcast(receivers=room.members_id,
-                          event=CommandDoneEvent(command=command, user_id=session.user_id, result=MessageSchema().dump(message_list, many=True)))]
+        if self.message_writer is not None:
+            message = await self.message_writer.write(creator_id=session.user_id,
+                                                      room_id=payload['room_id'],
+                                                      msg_type=payload['msg_type'],
+                                                      msg_body=payload['msg_body'])
+        else:
+            message = await self.user_repo.create_message(creator_id=session.user_id,
+                                                         room_id=payload['room_id'],
+                                                         msg_type=payload['msg_type'],
+                                                         msg_body=payload['msg_body'])
+            await self.user_repo.commit()
+        if self.recent_messages is not None:
+            self.recent_messages.append(message)
+        return [Broadcast(receivers=list(members),
+                          event=CommandDoneEvent(command=command, user_id=session.user_id, result=[message_data(message)]))]
@@ -1,25 +1,24 @@
 from typing import List
 from datetime import datetime
-from src.application.ws.base import WebsocketSession
+from src.application.ws.base import WebsocketSession, Priority
 from src.application.ws.event import Broadcast, CommandDoneEvent, Command, CommandAction
 from src.data.user.repo import UserRepo
+from src.data.user.presence import PresenceStore
 
 
 class OnConnectHandler:
-    def __init__(self, friend_repo, user_repo: UserRepo, ws_connection_repo):
+    def __init__(self, friend_repo, user_repo: UserRepo, ws_connection_repo, presence_store: PresenceStore):
         self.friend_repo = friend_repo
         self.user_repo = user_repo
         self.ws_connection_repo = ws_connection_repo
+        # written to the user table by its periodic flush
+        self.presence_store = presence_store
 
     async def __call__(self, _, session: WebsocketSession) -> List[Broadcast]:
-        # client = self.ws_connection_repo.get(session.user_id)
-        # todo duplicate online broadcasting
-        # if len(client.session_list) > 1:
-        #     pass
+        # called once per offline -> online transition, see PresenceManager
         online = True
 
-        await self.user_repo.update_user(user_id=session.user_id, data={"online": online, "last_activity": datetime.now()})
-        await self.user_repo.commit()
+        self.presence_store.set(session.user_id, online, datetime.now())
 
         friends_id = await self.friend_repo.get_friends_id(session.user_id)
         command = Command(resource='friends',
@@ -31,16 +30,19 @@ class OnConnectHandler:
         if friends_id:
             return [Broadcast(
                 receivers=friends_id,
-                event=CommandDoneEvent(command=command, user_id=session.user_id)
+                event=CommandDoneEvent(command=command, user_id=session.user_id),
+                priority=Priority.LOW
             )]
         return []
 
 
 class OnDisconnectHandler:
-    def __init__(self, friend_repo, user_repo: UserRepo, ws_connection_repo):
+    def __init__(self, friend_repo, user_repo: UserRepo, ws_connection_repo, presence_store: PresenceStore):
         self.friend_repo = friend_repo
         self.user_repo = user_repo
         self.ws_connection_repo = ws_connection_repo
+        # written to the user table by its periodic flush
+        self.presence_store = presence_store
 
     async def __call__(self, _, session: WebsocketSession) -> List[Broadcast]:
         client = self.ws_connection_repo.get(session.user_id)
@@ -52,9 +54,7 @@ class OnDisconnectHandler:
         if online:
             return []
 
-        await self.user_repo.update_user(user_id=session.user_id,
-                                         data={"online": online, "last_activity": datetime.now()})
-        await self.user_repo.commit()
+        self.presence_store.set(session.user_id, online, datetime.now())
         friends_id = await self.friend_repo.get_friends_id(session.user_id)
         command = Command(resource='friends',
                           action=CommandAction.UPDATE,
@@ -65,7 +65,8 @@ class OnDisconnectHandler:
         if friends_id:
             return [Broadcast(
                 receivers=friends_id,
-                event=CommandDoneEvent(command=command, user_id=session.user_id)
+                event=CommandDoneEvent(command=command, user_id=session.user_id),
+                priority=Priority.LOW
             )]
         return []
 
@@ -1,17 +1,43 @@
+from datetime import datetime
+from typing import Optional
+
 from src.application.ws.base import WebsocketSession
+from src.application.ws.cursor import Cursor, Position, split_changes
+from src.application.ws.recent import RecentMessageCache
 from src.application.ws.event import Query
 from src.application.ws.server import BaseQueryHandler
-from src.application.adapters import UserSchema, RoomSchema, MessageSchema
+from src.application.adapters import UserSchema, RoomSchema, message_data
 from src.data.user.repo import UserRepo
+from src.data.user.membership import RoomMembershipIndex
+from src.data.user.presence import PresenceStore
 from src.data.frineds.repo import FriendsRepo
 from src.core.exceptions.base import ValidationError
 
 
+def timestamp_param(payload: dict, name: str) -> Optional[datetime]:
+    value = payload.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromtimestamp(value)
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValidationError(obj=name, value=value)
+
+
+def int_param(payload: dict, name: str, default: int, minimum: int = 0) -> int:
+    value = payload.get(name, default)
+    if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+        raise ValidationError(obj=name, value=value)
+    return value
+
+
 class UserSearchQueryHandler(BaseQueryHandler):
 
-    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo):
+    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo, presence_store: PresenceStore):
         self.user_repo = user_repo
         self.friend_repo = friend_repo
+        # online/last_activity of the table may be behind by one flush
+        self.presence_store = presence_store
 
     async def handle(self, query: Query, session: WebsocketSession):
         friends_id = await self.friend_repo.get_friends_id(session.user_id)
@@ -20,32 +46,74 @@ class UserSearchQueryHandler(BaseQueryHandler):
         user_search_spec = self.user_repo.UserSearchSpec(email_like=query.payload.get('q'),
                                                          id_list=query.payload.get('id_list'))
         exclude = self.user_repo.UserSearchSpec(id_list=friends_id)
-        user_list = await self.user_repo.get_users(user_search_spec, exclude=exclude)
-        await session.ws.send_json({"response": UserSchema().dump(user_list, many=True), "query": query.to_dict()})
+        user_list = self.presence_store.overlay(await self.user_repo.get_users(user_search_spec, exclude=exclude))
+        session.send_json({"response": UserSchema().dump(user_list, many=True), "query": query.to_dict()})
 
 
 class FriendQueryHandler(BaseQueryHandler):
 
-    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo):
+    def __init__(self, user_repo: UserRepo, friend_repo: FriendsRepo, presence_store: PresenceStore,
+                 page_size: int = 100):
         self.user_repo = user_repo
         self.friend_repo = friend_repo
+        self.presence_store = presence_store
+        # max changed friends in a response
+        self.page_size = page_size
 
     async def handle(self, query: Query, session: WebsocketSession):
-        friends_id = await self.friend_repo.get_friends_id(session.user_id)
+        if "cursor" in query.payload:
+            await self.handle_changes(query, session, Cursor.decode(query.payload["cursor"]))
+            return
+        friendships = await self.friend_repo.get_friendships(session.user_id)
+        friends_id = [friend_id for friend_id, _ in friendships]
 
         if friends_id:
             spec = self.user_repo.UserSearchSpec(id_list=friends_id)
-            user_list = await self.user_repo.get_users(spec)
+            user_list = self.presence_store.overlay(await self.user_repo.get_users(spec))
         else:
             user_list = []
-        await session.ws.send_json({"response": UserSchema().dump(user_list, many=True), "query": query.to_dict()})
+        cursor = Cursor().advance(user_list, [created_at for _, created_at in friendships])
+        session.send_json({"response": UserSchema().dump(user_list, many=True), "cursor": cursor.encode(),
+                           "query": query.to_dict()})
+
+    async def handle_changes(self, query: Query, session: WebsocketSession, cursor: Cursor):
+        # new friendships and friends with changed rows (online, last_activity)
+        new_friendships = await self.friend_repo.get_friendships(session.user_id, since=cursor.graph_since)
+        new_id = {friend_id for friend_id, _ in new_friendships}
+        friends_id = await self.friend_repo.get_friends_id(session.user_id)
+        user_list, has_more = [], False
+        next_cursor = cursor.advance(graph_times=[created_at for _, created_at in new_friendships])
+        if friends_id:
+            # one extra row tells if there is a next page
+            spec = self.user_repo.UserSearchSpec(id_list=friends_id, updated_since=cursor.since,
+                                                 changed_after=cursor.changed_after,
+                                                 changes_limit=self.page_size + 1)
+            user_list, has_more, next_cursor = next_cursor.page(await self.user_repo.get_users(spec), self.page_size)
+        missing_id = new_id.difference(user.id for user in user_list)
+        if missing_id:
+            # rows of new friends out of this page don't move the cursor
+            user_list += await self.user_repo.get_users(self.user_repo.UserSearchSpec(id_list=list(missing_id)))
+        user_list = self.presence_store.overlay(user_list)
+        schema = UserSchema(many=True)
+        session.send_json({
+            "response": {
+                "created": schema.dump([user for user in user_list if user.id in new_id]),
+                "updated": schema.dump([user for user in user_list if user.id not in new_id]),
+                # friendship removal is not stored yet
+                "removed": [],
+            },
+            "has_more": has_more,
+            "cursor": next_cursor.encode(),
+            "query": query.to_dict()
+        })
 
 
 class FriendRequestQueryHandler(BaseQueryHandler):
 
-    def __init__(self,  user_repo: UserRepo, friend_repo: FriendsRepo):
+    def __init__(self,  user_repo: UserRepo, friend_repo: FriendsRepo, presence_store: PresenceStore):
         self.user_repo = user_repo
         self.friend_repo = friend_repo
+        self.presence_store = presence_store
 
     async def handle(self, query: Query, session: WebsocketSession):
         response = {}
@@ -54,7 +122,7 @@ class FriendRequestQueryHandler(BaseQueryHandler):
             incoming_data = []
             if incoming_id:
                 spec = self.user_repo.UserSearchSpec(id_list=incoming_id)
-                user_list = await self.user_repo.get_users(spec)
+                user_list = self.presence_store.overlay(await self.user_repo.get_users(spec))
                 incoming_data = UserSchema().dump(user_list, many=True)
             response.update({"incoming": incoming_data})
         if query.payload.get("outgoing"):
@@ -62,32 +130,166 @@ class FriendRequestQueryHandler(BaseQueryHandler):
             outgoing_data = []
             if outgoing_id:
                 spec = self.user_repo.UserSearchSpec(id_list=outgoing_id)
-                user_list = await self.user_repo.get_users(spec)
+                user_list = self.presence_store.overlay(await self.user_repo.get_users(spec))
                 outgoing_data = UserSchema().dump(user_list, many=True)
             response.update({"outgoing": outgoing_data})
-        await session.ws.send_json({"response": response, "query": query.to_dict()})
+        session.send_json({"response": response, "query": query.to_dict()})
 
 
 class RoomQueryHandler(BaseQueryHandler):
-    def __init__(self, user_repo: UserRepo, friend_repo):
+    def __init__(self, user_repo: UserRepo, friend_repo, membership: Optional[RoomMembershipIndex] = None,
+                 page_size: int = 100):
         self.user_repo = user_repo
         # self.friend_repo = friend_repo
+        self.membership = membership
+        # max changed rooms in a response
+        self.page_size = page_size
 
     async def handle(self, query: Query, session: WebsocketSession):
-        room_list = await self.user_repo.get_rooms(self.user_repo.RoomSearchSpec(member_id=session.user_id))
-        await session.ws.send_json({"response": RoomSchema().dump(room_list, many=True), "query": query.to_dict()})
+        cursor = Cursor.decode(query.payload.get("cursor"))
+        changes = "cursor" in query.payload
+        spec = self.user_repo.RoomSearchSpec(member_id=session.user_id, updated_since=cursor.since)
+        if changes:
+            # one extra row tells if there is a next page
+            spec.changed_after = cursor.changed_after
+            spec.changes_limit = self.page_size + 1
+        room_list = await self.user_repo.get_rooms(spec)
+        if changes:
+            room_list, has_more, next_cursor = cursor.page(room_list, self.page_size)
+        # warm the index for the message send path, deleted rooms are dropped
+        if self.membership is not None:
+            self.membership.update(room_list)
+        if changes:
+            created, updated, removed = split_changes(room_list, cursor.since)
+            schema = RoomSchema(many=True)
+            session.send_json({
+                "response": {"created": schema.dump(created), "updated": schema.dump(updated), "removed": removed},
+                "has_more": has_more,
+                "cursor": next_cursor.encode(),
+                "query": query.to_dict()
+            })
+            return
+        session.send_json({"response": RoomSchema().dump(room_list, many=True),
+                           "cursor": cursor.advance(room_list).encode(), "query": query.to_dict()})
 
 
 class MessageQueryHandler(BaseQueryHandler):
-    def __init__(self, user_repo: UserRepo):
+    def __init__(self, user_repo: UserRepo, page_size: int = 100,
+                 recent_messages: Optional[RecentMessageCache] = None):
         self.user_repo = user_repo
+        # max messages in a history page
+        self.page_size = page_size
+        # latest pages of hot rooms
+        self.recent_messages = recent_messages
+
+    async def latest_page(self, spec, limit: int):
+        """ (messages, response items, has_more) of the latest page from the recent message cache """
+        cached = self.recent_messages.page(spec.room_id, limit)
+        if cached is not None:
+            return cached
+        # the first read of the room fills its whole buffer
+        window = self.recent_messages.per_room
+        spec.limit = window + 1
+        # messages written during the read may be missing from its result
+        pending = self.recent_messages.begin_fill(spec.room_id)
+        try:
+            message_list = await self.user_repo.get_messages(spec=spec)
+        finally:
+            self.recent_messages.end_fill(spec.room_id, pending)
+        older = len(message_list) > window
+        if older:
+            message_list = message_list[1:]
+        self.recent_messages.fill(spec.room_id, message_list, older, pending)
+        page = message_list[-limit:]
+        return page, [message_data(message) for message in page], len(message_list) > limit or older
 
     async def handle(self, query: Query, session: WebsocketSession):
-        if not query.payload.get('room_id'):
-            await session.ws.send_json(ValidationError("not found room_id in message query payload").to_dict())
-        message_list = await self.user_repo.get_messages(
-            spec=self.user_repo.MessageSearchSpec(room_id=query.payload['room_id'])
+        if query.payload.get('room_id') is None:
+            session.send_json(ValidationError("not found room_id in message query payload").to_dict())
+            return
+        cursor = Cursor.decode(query.payload.get("cursor"))
+        spec = self.user_repo.MessageSearchSpec(
+            room_id=int_param(query.payload, "room_id", 0, minimum=1),
+            start_time=timestamp_param(query.payload, "start_time"),
+            end_time=timestamp_param(query.payload, "end_time"),
+            updated_since=cursor.since
         )
-        await session.ws.send_json({"response": MessageSchema().dump(message_list, many=True),
-                                    "query": query.to_dict()})
+        if "cursor" in query.payload:
+            # changes come in pages too, the client repeats the query with the new cursor while has_more
+            spec.changed_after = cursor.changed_after
+            spec.changes_limit = self.page_size + 1
+            message_list, has_more, next_cursor = cursor.page(await self.user_repo.get_messages(spec=spec),
+                                                              self.page_size)
+            created, updated, removed = split_changes(message_list, cursor.since)
+            session.send_json({"response": {"created": [message_data(message) for message in created],
+                                            "updated": [message_data(message) for message in updated],
+                                            "removed": removed},
+                               "has_more": has_more,
+                               "cursor": next_cursor.encode(), "query": query.to_dict()})
+            return
+
+        # history page: the newest messages, older than `before` or newer than `after`
+        limit = min(int_param(query.payload, "limit", self.page_size, minimum=1), self.page_size)
+        before = Position.decode(query.payload.get("before"), "before")
+        after = Position.decode(query.payload.get("after"), "after")
+        spec.before = before.key() if before else None
+        spec.after = after.key() if after else None
+        latest = not (before or after or spec.start_time or spec.end_time)
+        if latest and self.recent_messages is not None and limit <= self.recent_messages.per_room:
+            message_list, response, has_more = await self.latest_page(spec, limit)
+        else:
+            # one extra row tells if there is a next page
+            spec.limit = limit + 1
+            message_list = await self.user_repo.get_messages(spec=spec)
+            has_more = len(message_list) > limit
+            if has_more:
+                message_list = message_list[:-1] if after else message_list[1:]
+            response = [message_data(message) for message in message_list]
+        session.send_json({
+            "response": response,
+            "has_more": has_more,
+            "before": Position.of(message_list[0]).encode() if message_list else None,
+            "after": Position.of(message_list[-1]).encode() if message_list else None,
+            "cursor": cursor.advance(message_list).encode(),
+            "query": query.to_dict()
+        })
+
 
+class MessageSearchQueryHandler(BaseQueryHandler):
+    # deep pages of ranked results are not worth the scan
+    max_offset = 1000
+
+    def __init__(self, user_repo: UserRepo, page_size: int = 20):
+        self.user_repo = user_repo
+        self.page_size = page_size
+
+    async def handle(self, query: Query, session: WebsocketSession):
+        text = query.payload.get("q")
+        if not isinstance(text, str) or not text.strip():
+            session.send_json(ValidationError("not found q in message_search query payload").to_dict())
+            return
+        limit = min(int_param(query.payload, "limit", self.page_size, minimum=1), self.page_size)
+        offset = int_param(query.payload, "offset", 0)
+        if offset > self.max_offset:
+            raise ValidationError(obj="offset", value=offset)
+        room_id = query.payload.get("room_id")
+        if room_id is not None:
+            room_id = int_param(query.payload, "room_id", 0, minimum=1)
+        match_list = await self.user_repo.search_messages(self.user_repo.MessageTextSearchSpec(
+            text=text,
+            member_id=session.user_id,
+            room_id=room_id,
+            # one extra row tells if there is a next page
+            limit=limit + 1,
+            offset=offset
+        ))
+        has_more = len(match_list) > limit
+        session.send_json({
+            "response": [
+                {"message": message_data(match.message), "rank": match.rank, "snippet": match.snippet}
+                for match in match_list[:limit]
+            ],
+            "has_more": has_more,
+            "offset": offset + limit if has_more else None,
+            "query": query.to_dict()
+        })
@@ -1,21 +1,271 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+from enum import Enum, IntEnum
+from itertools import islice
+from typing import List, Optional
 from weakref import WeakSet
-from asyncio import Queue
+
+from aiohttp import WSCloseCode
+
+from src.application.codec import JsonCodec
+
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = 'drop_oldest'
+    DROP_LOW_PRIORITY = 'drop_low_priority'
+    DISCONNECT = 'disconnect'
+
+
+class Frame:
+    """ Outbound frame shared between sessions, payload is encoded only once per format """
+    __slots__ = ('_data', '_source', '_encoded')
+
+    def __init__(self, data):
+        self._data = data
+        self._source = None
+        self._encoded = {}
+
+    @classmethod
+    def from_encoded(cls, encoded, codec: JsonCodec) -> 'Frame':
+        frame = cls(None)
+        frame._source = codec
+        frame._encoded[codec.format] = encoded
+        return frame
+
+    @property
+    def data(self):
+        if self._data is None and self._source is not None:
+            self._data = self._source.loads(self._encoded[self._source.format])
+        return self._data
+
+    def encode(self, codec: JsonCodec):
+        try:
+            return self._encoded[codec.format]
+        except KeyError:
+            encoded = self._encoded[codec.format] = codec.dumps(self.data)
+            return encoded
+
+
+class SequencedFrame(Frame):
+    """ Frame of one user with the sequence number, the shared frame is not encoded again """
+    __slots__ = ('frame', 'seq')
+
+    def __init__(self, frame: Frame, seq: int):
+        super().__init__(None)
+        self.frame = frame
+        self.seq = seq
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {"seq": self.seq, **self.frame.data}
+        return self._data
+
+    def encode(self, codec: JsonCodec):
+        try:
+            return self._encoded[codec.format]
+        except KeyError:
+            encoded = self._encoded[codec.format] = codec.prepend(self.frame.encode(codec), "seq", self.seq)
+            return encoded
+
+
+class ReplayBuffer:
+    """ Last events of a user for resume, limited by count and by encoded size """
+
+    def __init__(self, max_events: int = 256, max_bytes: int = 256 * 1024, codec: JsonCodec = None):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        # size is measured in this format, sessions of the same format reuse the encoded frame
+        self.codec = codec or JsonCodec()
+        self.last_seq = 0
+        self.size = 0
+        self._items = deque()
+
+    def append(self, frame: SequencedFrame):
+        size = len(frame.frame.encode(self.codec))
+        self._items.append((frame, size))
+        self.size += size
+        self.last_seq = frame.seq
+        while self._items and (len(self._items) > self.max_events or self.size > self.max_bytes):
+            _, evicted_size = self._items.popleft()
+            self.size -= evicted_size
+
+    def since(self, seq: int) -> Optional[List[SequencedFrame]]:
+        """ Frames after seq, None if some of them are already evicted """
+        if seq > self.last_seq:
+            return None
+        first_seq = self._items[0][0].seq if self._items else self.last_seq + 1
+        if seq + 1 < first_seq:
+            return None
+        return [frame for frame, _ in islice(self._items, seq + 1 - first_seq, None)]
+
+    def __len__(self):
+        return len(self._items)
 
 
 class WebsocketSession:
-    def __init__(self, ws, user_id, sid):
+    def __init__(self, ws, user_id, sid, max_queue_size=256, overflow_policy=OverflowPolicy.DROP_OLDEST,
+                 codec: JsonCodec = None, transport=None):
         self.sid = sid
         self.ws = ws
+        self.transport = transport
         self.user_id = user_id
+        self.codec = codec or JsonCodec()
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.sent = 0
+        self.dropped = 0
+        # loop time of the last received frame, see LivenessMonitor
+        self.last_seen = 0.0
+        # see RateLimiter
+        self.bucket = None
+        self._queue = deque()
+        self._ready = asyncio.Event()
+        # set when everything queued is written
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writer = None
+        self._closing = False
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def start(self):
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write_loop())
+
+    def send_json(self, data, priority=Priority.NORMAL) -> bool:
+        return self.send_frame(Frame(data), priority)
+
+    def send_frame(self, frame: Frame, priority=Priority.NORMAL) -> bool:
+        """ Put frame to the session outbound queue without waiting for delivery """
+        if self._closing:
+            self.dropped += 1
+            return False
+        if len(self._queue) >= self.max_queue_size and not self._overflow(priority):
+            self.dropped += 1
+            return False
+        self._queue.append((priority, frame))
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    def _overflow(self, priority) -> bool:
+        # returns True if there is room for the new item after applying the policy
+        if self.overflow_policy is OverflowPolicy.DROP_OLDEST:
+            self._queue.popleft()
+            self.dropped += 1
+            return True
+        if self.overflow_policy is OverflowPolicy.DROP_LOW_PRIORITY:
+            victim = min(range(len(self._queue)), key=lambda i: self._queue[i][0])
+            if self._queue[victim][0] >= priority:
+                return False
+            del self._queue[victim]
+            self.dropped += 1
+            return True
+        logger.debug(f"slow consumer, disconnect: {self}")
+        self._closing = True
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        asyncio.ensure_future(self.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Slow consumer'))
+        return False
+
+    async def _write_loop(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                self._idle.set()
+                await self._ready.wait()
+            _, frame = self._queue.popleft()
+            try:
+                encoded = frame.encode(self.codec)
+            except Exception:
+                # e.g. bytes from a msgpack client in a frame for a json session, the next frames still go out
+                logger.exception(f"frame encode error: {self}")
+                self.dropped += 1
+                continue
+            try:
+                if self.codec.binary:
+                    await self.ws.send_bytes(encoded)
+                else:
+                    await self.ws.send_str(encoded)
+            except ConnectionResetError:
+                # connection already close
+                self.dropped += len(self._queue) + 1
+                self._queue.clear()
+                self._closing = True
+                self._idle.set()
+                return
+            self.sent += 1
+
+    async def stop(self):
+        self._closing = True
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        self.dropped += len(self._queue)
+        self._queue.clear()
+        self._idle.set()
+
+    async def flush(self):
+        """ Wait until the outbound queue is written """
+        if self._writer is not None and not self._closing:
+            await self._idle.wait()
 
     async def close(self, code, message):
         await self.ws.close(code=code, message=message)
 
+    def abort(self):
+        """ Drop the connection without the closing handshake """
+        self._closing = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def __repr__(self):
+        return f"<WebsocketSession-{self.user_id}:depth={self.depth}:dropped={self.dropped}>"
+
+
+class BatchSession:
+    """ Session proxy which collects responses to one event of a batched frame """
+
+    def __init__(self, session: WebsocketSession):
+        self._session = session
+        self.responses = []
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def send_json(self, data, priority=Priority.NORMAL) -> bool:
+        self.responses.append(data)
+        return True
+
 
 class WsClient:
-    def __init__(self, user_id):
+    def __init__(self, user_id, replay: Optional[ReplayBuffer] = None):
         self.user_id = user_id
         self.session_list: WeakSet[WebsocketSession] = WeakSet()
+        # seq of the last event, it is valid only with the same epoch (client instance)
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.replay = replay
+        # shared rate limit of all sessions, see RateLimiter
+        self.bucket = None
 
     def add(self, session):
         self.session_list.add(session)
@@ -23,12 +273,16 @@ class WsClient:
     def discard(self, session):
         self.session_list.discard(session)
 
-    async def send_json(self, data):
+    def send_json(self, data, priority=Priority.NORMAL):
+        self.send_frame(Frame(data), priority)
+
+    def send_frame(self, frame: Frame, priority=Priority.NORMAL):
+        if self.replay is not None:
+            self.seq += 1
+            frame = SequencedFrame(frame, self.seq)
+            self.replay.append(frame)
         for session in self.session_list:
-            try:
-                await session.ws.send_json(data)
-            except ConnectionResetError:
-                pass
+            session.send_frame(frame, priority)
 
     @property
     def online(self):
@@ -36,4 +290,3 @@ class WsClient:
 
     def __repr__(self):
         return f"<WsClient-{self.user_id}:{len(self.session_list)}:online={self.online}"
-
@@ -0,0 +1,201 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+from typing import Callable, List, Optional
+
+from src.application.codec import JsonCodec
+from src.application.ws.base import Frame, Priority
+
+
+logger = logging.getLogger(__name__)
+
+DeliverHandler = Callable[[List[int], Frame, Priority], None]
+ControlHandler = Callable[[dict], None]
+
+HEADER = struct.Struct('>I')
+
+
+class BaseBroadcastBus:
+    # True if every published message reaches only this process
+    local = False
+
+    def __init__(self):
+        self._handlers: List[DeliverHandler] = []
+        self._control_handlers: List[ControlHandler] = []
+
+    def subscribe(self, handler: DeliverHandler):
+        self._handlers.append(handler)
+
+    def subscribe_control(self, handler: ControlHandler):
+        """ handler of control messages of other workers, e.g. presence """
+        self._control_handlers.append(handler)
+
+    def publish_control(self, message: dict):
+        """ Send a control message to the other workers, best effort """
+
+    def _deliver(self, receivers: List[int], frame: Frame, priority: Priority):
+        for handler in self._handlers:
+            handler(receivers, frame, priority)
+
+    async def publish(self, receivers: List[int], frame: Frame, priority: Priority = Priority.NORMAL):
+        raise NotImplementedError(f"publish not implemented for {type(self)}")
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class LocalBroadcastBus(BaseBroadcastBus):
+    """ In-process bus, default for single worker """
+    local = True
+
+    async def publish(self, receivers: List[int], frame: Frame, priority: Priority = Priority.NORMAL):
+        self._deliver(receivers, frame, priority)
+
+
+class UnixSocketBroadcastBus(BaseBroadcastBus):
+    """ Bus between workers of one host.
+
+    Workers elect a broker with a lock file, the broker listens on the unix socket
+    and relays every message to all other connected workers. If the broker worker
+    dies the lock is released and the rest of the workers re-elect on reconnect.
+
+    Only workers sharing the socket path (one host, one container) see each other,
+    instances on other hosts need a network bus.
+    """
+
+    def __init__(self, path: str, reconnect_delay: float = 0.5, max_buffer_size: int = 16 * 1024 * 1024,
+                 codec: JsonCodec = None):
+        super().__init__()
+        self.path = path
+        self.codec = codec or JsonCodec()
+        self.reconnect_delay = reconnect_delay
+        self.max_buffer_size = max_buffer_size
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def is_broker(self):
+        return self._server is not None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def wait_connected(self, timeout: Optional[float] = None):
+        await asyncio.wait_for(self._connected.wait(), timeout)
+
+    async def publish(self, receivers: List[int], frame: Frame, priority: Priority = Priority.NORMAL):
+        self._deliver(receivers, frame, priority)
+        self.published += 1
+        self._write({"r": receivers, "p": int(priority), "f": frame.encode(self.codec)})
+
+    def publish_control(self, message: dict):
+        self._write({"c": message})
+
+    def _write(self, message: dict):
+        writer = self._writer
+        if writer is None or writer.transport.get_write_buffer_size() > self.max_buffer_size:
+            self.dropped += 1
+            logger.warning(f"broadcast bus is not available, message is delivered only locally: {self.path}")
+            return
+        body = self.codec.dumps(message).encode()
+        writer.write(HEADER.pack(len(body)) + body)
+
+    def _on_message(self, body: bytes):
+        self.received += 1
+        message = self.codec.loads(body)
+        if "c" in message:
+            for handler in self._control_handlers:
+                handler(message["c"])
+            return
+        self._deliver(message["r"], Frame.from_encoded(message["f"], self.codec), Priority(message["p"]))
+
+    async def _run(self):
+        while not self._closed:
+            await self._elect()
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self._writer = writer
+            self._connected.set()
+            try:
+                while True:
+                    self._on_message(await self._read(reader))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.warning(f"broadcast bus connection lost: {self.path}")
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+            if not self._closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def _elect(self):
+        if self._lock_fd is not None:
+            return
+        fd = os.open(f"{self.path}.lock", os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        # socket file may be left by a dead broker
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_peer, self.path)
+        logger.info(f"broadcast bus broker started: {self.path}")
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._peers.add(writer)
+        try:
+            while True:
+                body = await self._read(reader)
+                data = HEADER.pack(len(body)) + body
+                for peer in self._peers:
+                    if peer is not writer and peer.transport.get_write_buffer_size() <= self.max_buffer_size:
+                        peer.write(data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._peers.discard(writer)
+            writer.close()
+
+    @staticmethod
+    async def _read(reader: asyncio.StreamReader) -> bytes:
+        header = await reader.readexactly(HEADER.size)
+        return await reader.readexactly(HEADER.unpack(header)[0])
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
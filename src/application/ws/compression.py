@@ -0,0 +1,119 @@
+import time
+import zlib
+from dataclasses import dataclass
+
+from aiohttp import web, hdrs
+from aiohttp.http_websocket import ws_ext_gen
+
+
+@dataclass
+class CompressionConfig:
+    enabled: bool = True
+    # smaller messages (presence, acks) are sent uncompressed
+    threshold: int = 512
+    # 9..15, compressor memory per connection is about 2 ** (window_bits + 2) + 2 ** (mem_level + 9)
+    window_bits: int = 15
+    mem_level: int = 8
+    level: int = zlib.Z_BEST_SPEED
+    # reset compressor state after every message, less memory between messages, worse ratio
+    no_context_takeover: bool = False
+
+
+class CompressionStats:
+    def __init__(self):
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        self.skipped = 0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def to_dict(self):
+        return {
+            "messages": self.messages,
+            "skipped": self.skipped,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_saved,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            "cpu_time": round(self.cpu_time, 6),
+        }
+
+
+class MeteredCompressor:
+    """ zlib compressobj wrapper which counts bytes and time spent on compression """
+
+    def __init__(self, compressobj, stats: CompressionStats):
+        self._compressobj = compressobj
+        self._stats = stats
+
+    def compress(self, data: bytes) -> bytes:
+        start = time.perf_counter()
+        result = self._compressobj.compress(data)
+        self._stats.cpu_time += time.perf_counter() - start
+        self._stats.messages += 1
+        self._stats.bytes_in += len(data)
+        self._stats.bytes_out += len(result)
+        return result
+
+    def flush(self, mode: int = zlib.Z_FINISH) -> bytes:
+        start = time.perf_counter()
+        result = self._compressobj.flush(mode)
+        self._stats.cpu_time += time.perf_counter() - start
+        self._stats.bytes_out += len(result)
+        return result
+
+
+class CompressedWebSocketResponse(web.WebSocketResponse):
+    """ WebSocketResponse with tunable permessage-deflate.
+
+    Window bits and no_context_takeover of the server compressor are limited by the config
+    (RFC 7692 allows the server to add them to the response), messages shorter than
+    the threshold are sent without compression.
+    """
+
+    def __init__(self, *, compression: CompressionConfig, stats: CompressionStats, **kwargs):
+        super().__init__(compress=compression.enabled, **kwargs)
+        self.compression_config = compression
+        self.compression_stats = stats
+
+    def _handshake(self, request):
+        headers, protocol, compress, notakeover = super()._handshake(request)
+        if compress:
+            compress = min(compress, self.compression_config.window_bits)
+            notakeover = notakeover or self.compression_config.no_context_takeover
+            headers[hdrs.SEC_WEBSOCKET_EXTENSIONS] = ws_ext_gen(
+                compress=compress, isserver=True, server_notakeover=notakeover
+            )
+        return headers, protocol, compress, notakeover
+
+    def _pre_start(self, request):
+        protocol, writer = super()._pre_start(request)
+        if writer.compress and hasattr(writer, '_compressobj'):
+            writer._compressobj = MeteredCompressor(
+                zlib.compressobj(level=self.compression_config.level, wbits=-writer.compress,
+                                 memLevel=self.compression_config.mem_level),
+                self.compression_stats
+            )
+        return protocol, writer
+
+    async def _send(self, send, data, compress):
+        writer = self._writer
+        if writer is None or not writer.compress or len(data) >= self.compression_config.threshold:
+            return await send(data, compress=compress)
+        # uncompressed message is valid within permessage-deflate (RSV1 is not set)
+        self.compression_stats.skipped += 1
+        window_bits, writer.compress = writer.compress, 0
+        try:
+            await send(data, compress=compress)
+        finally:
+            writer.compress = window_bits
+
+    async def send_str(self, data: str, compress=None) -> None:
+        await self._send(super().send_str, data, compress)
+
+    async def send_bytes(self, data: bytes, compress=None) -> None:
+        await self._send(super().send_bytes, data, compress)
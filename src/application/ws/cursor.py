@@ -0,0 +1,125 @@
+import base64
+import binascii
+import json
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from src.core.exceptions.base import ValidationError
+
+
+# transactions committed a bit later than their now() are read again, clients upsert by id
+OVERLAP = timedelta(seconds=5)
+
+
+@dataclass(frozen=True)
+class Cursor:
+    """ Position in the change stream of a query resource, opaque for the client """
+    # max updated_at of postgres rows seen by the client
+    updated_at: Optional[datetime] = None
+    # max neo4j timestamp() (ms) of relationships seen by the client
+    graph_time: Optional[int] = None
+    # id of the last row of a capped page, the next page starts right after (updated_at, after_id)
+    after_id: Optional[int] = None
+
+    @property
+    def since(self) -> Optional[datetime]:
+        if not self.updated_at:
+            return None
+        # the overlap would read the same full page again
+        return self.updated_at if self.after_id is not None else self.updated_at - OVERLAP
+
+    @property
+    def changed_after(self) -> Optional[Tuple[datetime, int]]:
+        return (self.updated_at, self.after_id) if self.updated_at and self.after_id is not None else None
+
+    @property
+    def graph_since(self) -> int:
+        return max(0, self.graph_time - int(OVERLAP.total_seconds() * 1000)) if self.graph_time else 0
+
+    def advance(self, items: Iterable = (), graph_times: Iterable[int] = ()) -> 'Cursor':
+        updated_at = max((item.updated_at for item in items if item.updated_at), default=None)
+        graph_time = max(graph_times, default=None)
+        cursor = self
+        if cursor.after_id is not None:
+            # read to the end, the overlap is back
+            cursor = replace(cursor, after_id=None)
+        if updated_at and (self.updated_at is None or updated_at > self.updated_at):
+            cursor = replace(cursor, updated_at=updated_at)
+        if graph_time and (self.graph_time is None or graph_time > self.graph_time):
+            cursor = replace(cursor, graph_time=graph_time)
+        return cursor
+
+    def page(self, items: List, limit: int) -> Tuple[List, bool, 'Cursor']:
+        """ Changes read with limit + 1 in (updated_at, id) order -> (items, has_more, next cursor) """
+        if len(items) <= limit:
+            return items, False, self.advance(items)
+        items = items[:limit]
+        return items, True, replace(self, updated_at=items[-1].updated_at, after_id=items[-1].id)
+
+    def encode(self) -> Optional[str]:
+        data = {}
+        if self.updated_at:
+            data["u"] = self.updated_at.isoformat()
+        if self.graph_time:
+            data["g"] = self.graph_time
+        if self.after_id is not None:
+            data["i"] = self.after_id
+        if not data:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode()
+
+    @classmethod
+    def decode(cls, token: Optional[str]) -> 'Cursor':
+        if token is None:
+            return cls()
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode()))
+            return cls(
+                updated_at=datetime.fromisoformat(data["u"]) if "u" in data else None,
+                graph_time=int(data["g"]) if "g" in data else None,
+                after_id=int(data["i"]) if "i" in data else None,
+            )
+        except (AttributeError, TypeError, ValueError, KeyError, binascii.Error):
+            raise ValidationError(obj="cursor", value=token)
+
+
+@dataclass(frozen=True)
+class Position:
+    """ Keyset position (created_at, id) of a message in the room history, opaque for the client """
+    created_at: datetime
+    id: int
+
+    @classmethod
+    def of(cls, item) -> 'Position':
+        return cls(created_at=item.created_at, id=item.id)
+
+    def key(self) -> Tuple[datetime, int]:
+        return self.created_at, self.id
+
+    def encode(self) -> str:
+        data = {"t": self.created_at.isoformat(), "i": self.id}
+        return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode()
+
+    @classmethod
+    def decode(cls, token: Optional[str], name: str = "position") -> Optional['Position']:
+        if token is None:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(token.encode()))
+            return cls(created_at=datetime.fromisoformat(data["t"]), id=int(data["i"]))
+        except (AttributeError, TypeError, ValueError, KeyError, binascii.Error):
+            raise ValidationError(obj=name, value=token)
+
+
+def split_changes(items: Iterable, since: Optional[datetime]) -> Tuple[List, List, List[int]]:
+    """ Changed entities -> (created, updated, removed id list) """
+    created, updated, removed = [], [], []
+    for item in items:
+        if getattr(item, "deleted_at", None):
+            removed.append(item.id)
+        elif since is None or item.created_at >= since:
+            created.append(item)
+        else:
+            updated.append(item)
+    return created, updated, removed
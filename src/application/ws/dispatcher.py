@@ -0,0 +1,71 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Set, Union
+
+from src.application.ws.event import Command, Query
+
+
+logger = logging.getLogger(__name__)
+
+Event = Union[Query, Command]
+
+
+class EventDispatcher:
+    """ Per-connection event pipeline.
+
+    Queries run concurrently, commands on the same resource/room run in the order
+    they were received. At most `max_in_flight` events are handled at once, submit()
+    waits for a free slot so a flooding client is not read faster than it is served.
+    """
+
+    def __init__(self, handle: Callable[..., Awaitable], max_in_flight: int = 8):
+        self._handle = handle
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._tails: Dict[Hashable, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.in_flight = 0
+
+    @staticmethod
+    def order_key(event: Event) -> Optional[Hashable]:
+        if isinstance(event, Command):
+            room_id = (event.payload or {}).get('room_id')
+            # any other value is rejected by the handler, the key only has to be hashable
+            if not isinstance(room_id, int) or isinstance(room_id, bool):
+                room_id = None
+            return event.resource, room_id
+        return None
+
+    async def submit(self, event: Event, *args: Any) -> asyncio.Task:
+        """ Schedule handle(event, *args) """
+        key = self.order_key(event)
+        await self._slots.acquire()
+        self.in_flight += 1
+        previous = self._tails.get(key) if key is not None else None
+        task = self.spawn(self._run(event, previous, args))
+        if key is not None:
+            self._tails[key] = task
+            task.add_done_callback(lambda done: self._tails.get(key) is done and self._tails.pop(key))
+        return task
+
+    def spawn(self, coro: Awaitable) -> asyncio.Task:
+        """ Run a coroutine which doesn't need a slot, join() waits for it too """
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, event: Event, previous: Optional[asyncio.Task], args: tuple):
+        try:
+            if previous is not None:
+                # result of the previous command doesn't matter, only the order
+                await asyncio.wait([previous])
+            await self._handle(event, *args)
+        except Exception:
+            logger.exception(f"event handling error: {event}")
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
@@ -1,19 +1,22 @@
-from typing import List, Union
+from typing import List, Callable
 from dataclasses import dataclass, field
 
 from src.core.exceptions.base import ValidationError
-from .adapters import QuerySchema, CommandSchema, CommandAction
+from .adapters import CommandAction
+from .base import Priority, Frame
+from .validators import compile_decoder, string, mapping, enum, INVALID_INPUT_MSG
 
 
 class BaseWsEvent:
-    _schema: Union[QuerySchema, CommandSchema]
+    # compiled replacement of QuerySchema/CommandSchema.load, see validators
+    _decode: Callable[[dict], dict]
 
     def to_dict(self):
-        return self._schema.dump(self)
+        raise NotImplementedError(f"to_dict not implemented for {type(self)}")
 
     @classmethod
     def from_dict(cls, data):
-        return cls(**cls._schema.load(data))
+        return cls(**cls._decode(data))
 
 
 @dataclass
@@ -23,7 +26,14 @@ class Query(BaseWsEvent):
     payload: dict = None
     uid: str = "-"
 
-    _schema = QuerySchema()
+    _decode = staticmethod(compile_decoder({
+        'resource': (string, True),
+        'payload': (mapping, False),
+        'uid': (string, False),
+    }))
+
+    def to_dict(self):
+        return {"resource": self.resource, "payload": self.payload, "uid": self.uid}
 
 
 @dataclass
@@ -33,19 +43,30 @@ class Command(BaseWsEvent):
     payload: dict
     uid: str = "-"
 
-    _schema = CommandSchema()
+    _decode = staticmethod(compile_decoder({
+        'resource': (string, True),
+        'payload': (mapping, True),
+        'action': (enum(CommandAction), True),
+        'uid': (string, False),
+    }))
+
+    def to_dict(self):
+        # action is dumped as str(CommandAction), the same as CommandSchema did
+        return {"resource": self.resource, "payload": self.payload, "action": str(self.action), "uid": self.uid}
 
 
 def event_from_dict(data):
+    if not isinstance(data, dict):
+        raise ValidationError(msg={'_schema': [INVALID_INPUT_MSG]})
     try:
         type_ = data.pop('type')
-        if type_ == 'query':
-            return Query.from_dict(data)
-        if type_ == 'command':
-            return Command.from_dict(data)
-        raise ValidationError(f"Invalid type {data['type']}")
     except KeyError:
         raise ValidationError("Invalid event format, missing 'type'")
+    if type_ == 'query':
+        return Query.from_dict(data)
+    if type_ == 'command':
+        return Command.from_dict(data)
+    raise ValidationError(f"Invalid type {type_}")
 
 
 class ServerEvent:
@@ -54,6 +75,9 @@ class ServerEvent:
     def to_dict(self):
         raise NotImplementedError(f"to_dict not implemented for {type(self)}")
 
+    def to_frame(self) -> Frame:
+        return Frame(self.to_dict())
+
 
 @dataclass
 class QueryResponse(ServerEvent):
@@ -74,9 +98,30 @@ class CommandDoneEvent(ServerEvent):
         return {"command": self.command.to_dict(), "user_id": self.user_id, "result": self.result}
 
 
+@dataclass
+class ReconnectEvent(ServerEvent):
+    # seconds, the client should wait before reconnecting
+    delay: float
+
+    def to_dict(self):
+        return {"type": "reconnect", "delay": self.delay}
+
+
+@dataclass
+class SessionEvent(ServerEvent):
+    """ First frame of the connection, resumed=False means the client has to resync its state """
+    epoch: str
+    seq: int
+    resumed: bool
+
+    def to_dict(self):
+        return {"type": "session", "epoch": self.epoch, "seq": self.seq, "resumed": self.resumed}
+
+
 @dataclass
 class Broadcast:
     receivers: List[int]
     event: ServerEvent
+    priority: Priority = Priority.NORMAL
 
 
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import math
+from typing import Dict, Hashable, List, Optional, Set
+
+from aiohttp import WSCloseCode
+
+from src.application.ws.base import WebsocketSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """ Hashed timing wheel, schedule/cancel/advance are O(1) per item.
+
+    Delays are rounded up to ticks and limited by `span`.
+    """
+
+    def __init__(self, tick: float, span: float):
+        self.tick = tick
+        self._slots: List[Set[Hashable]] = [set() for _ in range(math.ceil(span / tick) + 1)]
+        self._slot_of: Dict[Hashable, int] = {}
+        self._cursor = 0
+
+    def schedule(self, item: Hashable, delay: float):
+        self.cancel(item)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self._slots) - 1)
+        index = (self._cursor + ticks) % len(self._slots)
+        self._slots[index].add(item)
+        self._slot_of[item] = index
+
+    def cancel(self, item: Hashable):
+        index = self._slot_of.pop(item, None)
+        if index is not None:
+            self._slots[index].discard(item)
+
+    def advance(self) -> Set[Hashable]:
+        """ Move to the next slot and return its expired items """
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        expired, self._slots[self._cursor] = self._slots[self._cursor], set()
+        for item in expired:
+            del self._slot_of[item]
+        return expired
+
+    def __len__(self):
+        return len(self._slot_of)
+
+
+class LivenessMonitor:
+    """ Pings idle sessions and closes the ones which don't answer.
+
+    Every received frame only updates session.last_seen, the wheel entry is moved lazily
+    when it expires. A session idle for `ping_interval` is pinged and closed if nothing
+    comes back within `ping_timeout`.
+    """
+
+    def __init__(self, ping_interval: float = 30.0, ping_timeout: float = 10.0, tick: float = 1.0):
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._wheel = TimingWheel(tick, max(ping_interval, ping_timeout))
+        # session -> loop time of the unanswered ping
+        self._pinged: Dict[WebsocketSession, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.pings = 0
+        self.reaped = 0
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_event_loop().time()
+
+    def add(self, session: WebsocketSession):
+        session.last_seen = self._now()
+        self._wheel.schedule(session, self.ping_interval)
+
+    def touch(self, session: WebsocketSession):
+        session.last_seen = self._now()
+
+    def remove(self, session: WebsocketSession):
+        self._wheel.cancel(session)
+        self._pinged.pop(session, None)
+
+    def tick(self):
+        now = self._now()
+        for session in self._wheel.advance():
+            pinged_at = self._pinged.pop(session, None)
+            idle = now - session.last_seen
+            if (pinged_at is not None and session.last_seen >= pinged_at) or idle < self.ping_interval:
+                self._wheel.schedule(session, self.ping_interval - idle)
+            elif pinged_at is None:
+                self._pinged[session] = now
+                self.pings += 1
+                asyncio.ensure_future(self._ping(session))
+                self._wheel.schedule(session, self.ping_timeout)
+            else:
+                self.reaped += 1
+                logger.debug(f"ping timeout, close: {session}")
+                asyncio.ensure_future(session.close(code=WSCloseCode.GOING_AWAY, message=b'Ping timeout'))
+
+    @staticmethod
+    async def _ping(session: WebsocketSession):
+        try:
+            await session.ws.ping()
+        except (ConnectionResetError, RuntimeError):
+            # closing connection is reaped on the next expiry
+            pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._wheel.tick)
+            self.tick()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "tracked": len(self._wheel),
+            "pings": self.pings,
+            "reaped": self.reaped,
+        }
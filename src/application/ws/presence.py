@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceManager:
+    """ Debounces online/offline transitions of users.
+
+    The user goes offline only if no session is opened again within `grace` seconds
+    after the last one was closed, so a reconnecting client produces neither DB writes
+    nor broadcasts. connect() returns True only on a real offline -> online transition.
+
+    With several workers the users online in each worker are exchanged over the bus
+    (`publish`): changes as they happen and the whole set every `sync_interval` seconds.
+    A worker whose user is still online elsewhere defers the offline transition until
+    the other workers report the user offline or stop reporting at all.
+    """
+
+    def __init__(self, grace: float = 5.0, sync_interval: float = 5.0, worker_id: Optional[str] = None):
+        self.grace = grace
+        self.sync_interval = sync_interval
+        self.worker_id = worker_id or uuid.uuid4().hex
+        self._online: Set[int] = set()
+        self._pending: Dict[int, asyncio.Task] = {}
+        self._flushing = asyncio.Event()
+        # worker id -> online users and loop time of its last message
+        self._remote: Dict[str, Set[int]] = {}
+        self._remote_seen: Dict[str, float] = {}
+        # user_id -> offline handling waiting for the other workers
+        self._deferred: Dict[int, Callable[[], Awaitable]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._sync_task: Optional[asyncio.Task] = None
+        # sends a control message to the other workers, None with one worker
+        self.publish: Optional[Callable[[dict], None]] = None
+        self.suppressed = 0
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._online
+
+    def online_elsewhere(self, user_id: int) -> bool:
+        return any(user_id in users for users in self._remote.values())
+
+    async def connect(self, user_id: int) -> bool:
+        self._deferred.pop(user_id, None)
+        task = self._pending.pop(user_id, None)
+        if task is not None:
+            if user_id in self._online:
+                # reconnect within the grace window
+                task.cancel()
+                self.suppressed += 1
+                return False
+            # offline transition is already in progress, keep the order of broadcasts
+            await asyncio.wait([task])
+        if user_id in self._online:
+            return False
+        self._online.add(user_id)
+        self._send({"on": [user_id]})
+        return True
+
+    def disconnect(self, user_id: int, on_offline: Callable[[], Awaitable],
+                   on_leave: Optional[Callable[[], None]] = None):
+        """ Last session of the user is closed.
+
+        After the grace window on_leave is called, then on_offline once the user is offline
+        in every worker: right away or when the worker having the user last reports it.
+        """
+        if user_id not in self._online or user_id in self._pending:
+            return
+        task = asyncio.ensure_future(self._offline_later(user_id, on_offline, on_leave))
+        self._pending[user_id] = task
+        task.add_done_callback(lambda done: self._pending.get(user_id) is done and self._pending.pop(user_id))
+
+    async def _offline_later(self, user_id: int, on_offline: Callable[[], Awaitable],
+                             on_leave: Optional[Callable[[], None]]):
+        try:
+            await asyncio.wait_for(self._flushing.wait(), self.grace)
+        except asyncio.TimeoutError:
+            pass
+        self._online.discard(user_id)
+        if on_leave is not None:
+            on_leave()
+        if self.online_elsewhere(user_id):
+            self._deferred[user_id] = on_offline
+            self._send({"off": [user_id]})
+            return
+        # "done" tells the other workers the transition is handled here
+        self._send({"off": [user_id], "done": True})
+        try:
+            await on_offline()
+        except Exception:
+            logger.exception(f"offline handling error: {user_id}")
+
+    def on_remote(self, message: dict):
+        """ Control message of another worker, {"w": id, "on": [...], "off": [...], "all": bool, "done": bool} """
+        worker_id = message.get("w")
+        if worker_id is None or worker_id == self.worker_id:
+            return
+        users = self._remote.setdefault(worker_id, set())
+        if message.get("all"):
+            left = users - set(message.get("on", ()))
+            users.clear()
+        else:
+            left = set(message.get("off", ()))
+        users.update(message.get("on", ()))
+        users.difference_update(message.get("off", ()))
+        self._remote_seen[worker_id] = asyncio.get_event_loop().time()
+        if message.get("done"):
+            for user_id in left:
+                self._deferred.pop(user_id, None)
+            return
+        self._release(left)
+
+    def _release(self, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            if user_id in self._deferred and user_id not in self._online and not self.online_elsewhere(user_id):
+                task = asyncio.ensure_future(self._run_deferred(user_id, self._deferred.pop(user_id)))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _run_deferred(self, user_id: int, on_offline: Callable[[], Awaitable]):
+        self._send({"off": [user_id], "done": True})
+        try:
+            await on_offline()
+        except Exception:
+            logger.exception(f"offline handling error: {user_id}")
+
+    def _send(self, message: dict):
+        if self.publish is not None:
+            try:
+                self.publish({"w": self.worker_id, **message})
+            except Exception:
+                logger.exception("presence sync error")
+
+    def start(self):
+        if self.publish is not None and self._sync_task is None:
+            self._sync_task = asyncio.ensure_future(self._sync())
+
+    async def stop(self):
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            try:
+                await self._sync_task
+            except asyncio.CancelledError:
+                pass
+            self._sync_task = None
+
+    async def _sync(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            # the whole set repairs lost messages and introduces this worker to new ones
+            self._send({"on": list(self._online), "all": True})
+            await asyncio.sleep(self.sync_interval)
+            # a worker which stopped reporting is gone with its sessions
+            expired = [worker_id for worker_id, seen in self._remote_seen.items()
+                       if loop.time() - seen > 3 * self.sync_interval]
+            for worker_id in expired:
+                del self._remote_seen[worker_id]
+                self._release(self._remote.pop(worker_id, ()))
+
+    async def flush(self):
+        """ Fire pending offline transitions now, used on shutdown """
+        self._flushing.set()
+        if self._pending:
+            await asyncio.wait(list(self._pending.values()))
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def stats(self):
+        return {
+            "online": len(self._online),
+            "pending_offline": len(self._pending),
+            "deferred_offline": len(self._deferred),
+            "remote_workers": len(self._remote),
+            "suppressed": self.suppressed,
+        }
+
+
+def connected_only(receivers: Iterable[int], clients: dict) -> List[int]:
+    return [receiver for receiver in receivers if receiver in clients and clients[receiver].online]
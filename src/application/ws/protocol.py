@@ -0,0 +1,50 @@
+import logging
+from typing import Dict
+
+from src.application.codec import JsonCodec, MsgpackCodec
+from src.application.ws.adapters import CommandAction
+
+
+logger = logging.getLogger(__name__)
+
+JSON_PROTOCOL = 'ws-chat.json'
+MSGPACK_PROTOCOL = 'ws-chat.msgpack'
+
+# integer codes of the binary protocol, never change existing values
+TYPE_CODES = {
+    'query': 1,
+    'command': 2,
+}
+
+RESOURCE_CODES = {
+    'user': 1,
+    'friend': 2,
+    'friend_request': 3,
+    'room': 4,
+    'message': 5,
+    'friends': 6,
+    'message_search': 7,
+}
+
+ACTION_CODES = {action.value: code for action, code in (
+    (CommandAction.CREATE, 1),
+    (CommandAction.UPDATE, 2),
+    (CommandAction.DELETE, 3),
+)}
+# Command.to_dict dumps action as str(CommandAction)
+ACTION_CODES.update({str(CommandAction(action)): code for action, code in list(ACTION_CODES.items())})
+
+
+def protocol_codecs(json_codec: JsonCodec) -> Dict[str, object]:
+    """ Supported websocket subprotocols in order of preference """
+    codecs = {}
+    try:
+        codecs[MSGPACK_PROTOCOL] = MsgpackCodec(codes={
+            'type': TYPE_CODES,
+            'resource': RESOURCE_CODES,
+            'action': ACTION_CODES,
+        })
+    except ImportError:
+        logger.warning("msgpack is not installed, binary protocol is disabled")
+    codecs[JSON_PROTOCOL] = json_codec
+    return codecs
@@ -0,0 +1,98 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from src.core.exceptions.base import ThrottledError
+
+
+def default_costs() -> Dict[str, float]:
+    # user search is a LIKE scan over the user table, message search ranks all matches
+    return {"user": 5.0, "message_search": 5.0}
+
+
+def parse_costs(value: str) -> Dict[str, float]:
+    """ "user:5,room:2" -> {"user": 5.0, "room": 2.0} """
+    costs = default_costs()
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        resource, _, cost = item.partition(':')
+        costs[resource.strip()] = float(cost)
+    return costs
+
+
+@dataclass
+class RateLimitConfig:
+    enabled: bool = True
+    # tokens per second and bucket size, one event costs 1 token unless listed in costs
+    session_rate: float = 20.0
+    session_burst: float = 40.0
+    # shared by all sessions of the user
+    user_rate: float = 40.0
+    user_burst: float = 80.0
+    costs: Dict[str, float] = field(default_factory=default_costs)
+    # larger frames close the connection with MESSAGE_TOO_BIG
+    max_frame_size: int = 64 * 1024
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def retry_after(self, cost: float) -> float:
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """ Token buckets per session and per user, an event is admitted only if both have tokens """
+    FRAME_COST = 1.0
+
+    def __init__(self, config: Optional[RateLimitConfig] = None):
+        self.config = config or RateLimitConfig()
+        self.throttled = 0
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_event_loop().time()
+
+    def attach(self, session, client):
+        if not self.config.enabled:
+            return
+        now = self._now()
+        session.bucket = TokenBucket(self.config.session_rate, self.config.session_burst, now)
+        if client.bucket is None:
+            client.bucket = TokenBucket(self.config.user_rate, self.config.user_burst, now)
+
+    def cost(self, resource: str) -> float:
+        return self.config.costs.get(resource, 1.0)
+
+    def check_frame(self, session, client):
+        """ Take FRAME_COST tokens for a received frame before it is decoded, so malformed
+        and invalid frames are limited as well. The tokens count toward its first event """
+        self._take(session, client, self.FRAME_COST)
+
+    def check(self, session, client, resource: str, prepaid: float = 0.0):
+        """ Take tokens for the event or raise ThrottledError, `prepaid` tokens were taken by check_frame """
+        self._take(session, client, self.cost(resource) - prepaid)
+
+    def _take(self, session, client, cost: float):
+        if not self.config.enabled or session.bucket is None or cost <= 0:
+            return
+        now = self._now()
+        buckets = (session.bucket, client.bucket) if client is not None else (session.bucket,)
+        for bucket in buckets:
+            bucket.refill(now)
+        if all(bucket.tokens >= cost for bucket in buckets):
+            for bucket in buckets:
+                bucket.tokens -= cost
+            return
+        self.throttled += 1
+        raise ThrottledError(retry_after=round(max(bucket.retry_after(cost) for bucket in buckets), 3))
@@ -0,0 +1,140 @@
+import bisect
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from src.application.adapters import message_data
+from src.core.entity.user import Message
+
+
+# rough size of an entry besides the message body
+ENTRY_OVERHEAD = 400
+
+
+class RoomBuffer:
+    __slots__ = ('keys', 'messages', 'items', 'older', 'size')
+
+    def __init__(self, older: bool):
+        # (created_at, id) of messages, ascending
+        self.keys: List[Tuple[datetime, int]] = []
+        self.messages: List[Message] = []
+        # message_data of messages
+        self.items: List[dict] = []
+        # messages older than the buffer exist in the database
+        self.older = older
+        self.size = 0
+
+
+class RecentMessageCache:
+    """ Last `per_room` messages of hot rooms, in the form the codecs send them.
+
+    A room is added by the first read of its latest page, afterwards new messages are
+    appended on write. Messages appended while the room is read are kept aside, see
+    begin_fill(). Least recently used rooms are evicted above `max_bytes`.
+    """
+
+    def __init__(self, per_room: int = 100, max_bytes: int = 32 * 1024 * 1024):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self._rooms: 'OrderedDict[int, RoomBuffer]' = OrderedDict()
+        # room_id -> messages appended during each running read of the room
+        self._filling: Dict[int, List[List[Message]]] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def page(self, room_id: int, limit: int) -> Optional[Tuple[List[Message], List[dict], bool]]:
+        """ (latest `limit` messages, their data, has_more) or None if the room is not cached deep enough """
+        buffer = self._rooms.get(room_id)
+        if buffer is None or (limit > len(buffer.items) and buffer.older):
+            self.misses += 1
+            return None
+        self._rooms.move_to_end(room_id)
+        self.hits += 1
+        return buffer.messages[-limit:], buffer.items[-limit:], len(buffer.items) > limit or buffer.older
+
+    def begin_fill(self, room_id: int) -> List[Message]:
+        """ Called before the database read for fill(), collects the messages appended meanwhile """
+        pending: List[Message] = []
+        self._filling.setdefault(room_id, []).append(pending)
+        return pending
+
+    def end_fill(self, room_id: int, pending: List[Message]):
+        """ The read is done (or failed), stop collecting """
+        fills = self._filling.get(room_id, [])
+        for index, item in enumerate(fills):
+            if item is pending:
+                del fills[index]
+                break
+        if not fills:
+            self._filling.pop(room_id, None)
+
+    def fill(self, room_id: int, message_list: List[Message], older: bool, pending: Optional[List[Message]] = None):
+        """ Cache the latest messages of the room read from the database, ascending, and the
+        messages appended during the read """
+        buffer = self._rooms.get(room_id)
+        if buffer is None:
+            buffer = self._rooms[room_id] = RoomBuffer(older)
+        else:
+            buffer.older = buffer.older and older
+        for message in message_list:
+            self._insert(buffer, message, latest=True)
+        for message in pending or ():
+            self._insert(buffer, message)
+        self._trim(room_id, buffer)
+
+    def append(self, message: Message):
+        """ New message, only rooms which are already cached or being read are updated """
+        for pending in self._filling.get(message.room_id, ()):
+            pending.append(message)
+        buffer = self._rooms.get(message.room_id)
+        if buffer is None:
+            return
+        self._insert(buffer, message)
+        self._trim(message.room_id, buffer)
+
+    def invalidate_room(self, room_id: int):
+        buffer = self._rooms.pop(room_id, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def _insert(self, buffer: RoomBuffer, message: Message, latest: bool = False):
+        key = (message.created_at, message.id)
+        index = bisect.bisect_left(buffer.keys, key)
+        if index < len(buffer.keys) and buffer.keys[index] == key:
+            return
+        if index == 0 and buffer.older and buffer.keys and not latest:
+            # before the cached window, the messages in between are not cached
+            return
+        buffer.keys.insert(index, key)
+        buffer.messages.insert(index, message)
+        buffer.items.insert(index, message_data(message))
+        size = len(message.msg_body) + ENTRY_OVERHEAD
+        buffer.size += size
+        self.size += size
+
+    def _trim(self, room_id: int, buffer: RoomBuffer):
+        excess = len(buffer.items) - self.per_room
+        if excess > 0:
+            size = sum(len(message.msg_body) + ENTRY_OVERHEAD for message in buffer.messages[:excess])
+            del buffer.keys[:excess]
+            del buffer.messages[:excess]
+            del buffer.items[:excess]
+            buffer.older = True
+            buffer.size -= size
+            self.size -= size
+        self._rooms.move_to_end(room_id)
+        while self.size > self.max_bytes and len(self._rooms) > 1:
+            self.invalidate_room(next(iter(self._rooms)))
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "rooms": len(self._rooms),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "filling": len(self._filling),
+        }
@@ -1,19 +1,34 @@
 import asyncio
 import logging
-import json
-from typing import Dict, List, Callable, Optional, Any, Awaitable
-from aiohttp import web, WSMsgType, WSCloseCode
-from marshmallow import ValidationError
+import math
+import random
+from contextlib import asynccontextmanager
+from typing import Dict, List, Callable, Optional, Any, Awaitable, Set
+from aiohttp import web, hdrs, WSMsgType, WSCloseCode
 
-from src.core.exceptions.base import DomainError, NotFoundError, UnauthorizedError,\
-    ValidationError as DomainValidationError
-from src.application.ws.event import Command, Query, event_from_dict, Broadcast
-from src.application.ws.base import WsClient, WebsocketSession
+from src.application.codec import JsonCodec
+from src.core.exceptions.base import DomainError, NotFoundError, UnauthorizedError, UnavailableError,\
+    ThrottledError, ValidationError as DomainValidationError
+from src.application.ws.event import Command, Query, event_from_dict, Broadcast, ReconnectEvent, SessionEvent
+from src.application.ws.base import WsClient, WebsocketSession, BatchSession, OverflowPolicy, Frame, Priority, \
+    ReplayBuffer
+from src.application.ws.bus import BaseBroadcastBus, LocalBroadcastBus
+from src.application.ws.dispatcher import EventDispatcher
+from src.application.ws.protocol import protocol_codecs
+from src.application.ws.compression import CompressedWebSocketResponse, CompressionConfig, CompressionStats
+from src.application.ws.presence import PresenceManager, connected_only
+from src.application.ws.liveness import LivenessMonitor
+from src.application.ws.ratelimit import RateLimiter, RateLimitConfig
 
 
 logger = logging.getLogger(__name__)
 
 
+@asynccontextmanager
+async def no_unit_of_work():
+    yield
+
+
 class BaseCommandHandler:
     async def __call__(self, command: Command, session: WebsocketSession) -> List[Broadcast]:
         command_action_name = command.action.value.lower()
@@ -21,9 +36,10 @@ class BaseCommandHandler:
             action_handler = getattr(self, command_action_name)
             return await action_handler(command, session)
         else:
-            await session.ws.send_json(
-                DomainValidationError(obj="command action", value="command_action_name").to_dict()
+            session.send_json(
+                DomainValidationError(obj="command action", value=command_action_name).to_dict()
             )
+            return []
 
 
 class BaseQueryHandler:
@@ -36,124 +52,404 @@ class BaseQueryHandler:
 
 class WebSocketServer:
 
-    def __init__(self, user_repo, ws_connection_repo: Dict[Any, WsClient]):
+    def __init__(self, user_repo, ws_connection_repo: Dict[Any, WsClient], session_queue_size: int = 256,
+                 session_overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+                 bus: Optional[BaseBroadcastBus] = None, max_in_flight: int = 8, codec: Optional[JsonCodec] = None,
+                 compression: Optional[CompressionConfig] = None, max_batch_size: int = 32,
+                 presence_grace: float = 5.0, presence_sync_interval: float = 5.0,
+                 ping_interval: float = 30.0, ping_timeout: float = 10.0,
+                 drain_timeout: float = 20.0, drain_concurrency: int = 512, reconnect_delay: float = 5.0,
+                 rate_limit: Optional[RateLimitConfig] = None, replay_events: int = 256,
+                 replay_bytes: int = 256 * 1024, token_cache=None, unit_of_work=None, db_pool=None):
         self.user_repo = user_repo
         self.ws_clients = ws_connection_repo
+        self.codec = codec or JsonCodec()
+        # websocket subprotocol -> codec, the client chooses with Sec-WebSocket-Protocol
+        self.protocol_codecs = protocol_codecs(self.codec)
+        self.binary_codec = next((c for c in self.protocol_codecs.values() if c.binary), None)
+        self.bus = bus or LocalBroadcastBus()
+        self.bus.subscribe(self.deliver)
+        self.session_queue_size = session_queue_size
+        self.session_overflow_policy = OverflowPolicy(session_overflow_policy)
+        if unit_of_work is None and max_in_flight > 1:
+            # without a unit of work every event uses the same db session, which can't be shared by tasks
+            logger.warning(f"max_in_flight={max_in_flight} needs a unit_of_work, events are handled one by one")
+            max_in_flight = 1
+        self.max_in_flight = max_in_flight
+        self.max_batch_size = max_batch_size
+        self.compression = compression or CompressionConfig()
+        self.compression_stats = CompressionStats()
+        self.presence = PresenceManager(grace=presence_grace, sync_interval=presence_sync_interval)
+        if not self.bus.local:
+            # users online in the other workers, see PresenceManager
+            self.presence.publish = self.bus.publish_control
+            self.bus.subscribe_control(self.presence.on_remote)
+        self.liveness = LivenessMonitor(ping_interval=ping_interval, ping_timeout=ping_timeout)
+        self.drain_timeout = drain_timeout
+        self.drain_concurrency = drain_concurrency
+        self.reconnect_delay = reconnect_delay
+        self.draining = False
+        self.drain_stats = None
+        # running handle() calls, shutdown waits for their disconnect handling
+        self._handlers: Set[asyncio.Task] = set()
+        self.rate_limiter = RateLimiter(rate_limit)
+        # per-user replay buffer for resume, 0 disables sequence numbers
+        self.replay_events = replay_events
+        self.replay_bytes = replay_bytes
+        self.resumed = 0
+        # token -> user, see TokenCache
+        self.token_cache = token_cache
+        # db session scope of every event, connect and disconnect
+        self.unit_of_work = unit_of_work or no_unit_of_work
+        self.db_pool = db_pool
+        # counters of already closed sessions, see stats()
+        self.closed_sent = 0
+        self.closed_dropped = 0
+        # broadcasts dropped because they can't be encoded
+        self.encode_errors = 0
         self.command_handlers: Dict[str, BaseCommandHandler] = {}
         self.query_handlers: Dict[str, BaseQueryHandler] = {}
-        self.connect_handler = None
-        self.disconnect_handler = None
-        # self.disconnect_handler: Optional[Callable[[None, WebsocketSession], Awaitable[List[Broadcast]]]] = None
+        self.connect_handler: Optional[Callable[[None, WebsocketSession], Awaitable[List[Broadcast]]]] = None
+        self.disconnect_handler: Optional[Callable[[None, WebsocketSession], Awaitable[List[Broadcast]]]] = None
 
     async def handle(self, request):
+        if self.draining:
+            return web.json_response(UnavailableError("Server is shutting down").to_dict(), status=503,
+                                     headers={hdrs.RETRY_AFTER: str(math.ceil(self.reconnect_delay))},
+                                     dumps=self.codec.dumps)
+        task = asyncio.current_task()
+        self._handlers.add(task)
         try:
-            user = await self.get_user(request)
+            return await self._handle(request)
+        finally:
+            self._handlers.discard(task)
+
+    async def _handle(self, request):
+        try:
+            async with self.unit_of_work():
+                user = await self.get_user(request)
         except UnauthorizedError:
-            return web.json_response({"status": "fail", "code": 2}, status=401)
-        ws = web.WebSocketResponse()
+            return web.json_response({"status": "fail", "code": 2}, status=401, dumps=self.codec.dumps)
+        # pings and pongs are handled in handle_websocket, see LivenessMonitor
+        ws = CompressedWebSocketResponse(protocols=tuple(self.protocol_codecs), autoping=False,
+                                         max_msg_size=self.rate_limiter.config.max_frame_size,
+                                         compression=self.compression, stats=self.compression_stats)
         await ws.prepare(request)
 
-        client = self.ws_clients.setdefault(user.id, WsClient(user_id=user.id))
-        session = WebsocketSession(ws=ws, user_id=user.id, sid=None)
+        client = self.ws_clients.get(user.id)
+        if client is None:
+            client = self.ws_clients[user.id] = WsClient(user_id=user.id, replay=self.new_replay_buffer())
+        session = WebsocketSession(ws=ws, user_id=user.id, sid=None,
+                                   max_queue_size=self.session_queue_size,
+                                   overflow_policy=self.session_overflow_policy,
+                                   codec=self.protocol_codecs.get(ws.ws_protocol, self.codec),
+                                   transport=request.transport)
+        session.start()
+        # replayed frames are queued before any new event of the client
+        self.resume(session, client, request.headers.get("resume") or request.query.get("resume"))
         client.add(session)
-        await self.on_connect(session)
-        await self.handle_websocket(session)
-        await self.on_disconnect(session)
-
-        client.discard(ws)
+        self.liveness.add(session)
+        self.rate_limiter.attach(session, client)
+        try:
+            # a user online in another worker is already online for everybody else
+            if await self.presence.connect(user.id) and not self.presence.online_elsewhere(user.id):
+                await self.on_connect(session)
+            await self.handle_websocket(session)
+        finally:
+            client.discard(session)
+            self.liveness.remove(session)
+            await session.stop()
+            self.closed_sent += session.sent
+            self.closed_dropped += session.dropped
+            if not client.online:
+                self.presence.disconnect(user.id, lambda: self.on_disconnect(session),
+                                         on_leave=lambda: self.forget(client))
         return ws
 
+    def new_replay_buffer(self) -> Optional[ReplayBuffer]:
+        if self.replay_events <= 0:
+            return None
+        return ReplayBuffer(max_events=self.replay_events, max_bytes=self.replay_bytes, codec=self.codec)
+
+    def resume(self, session: WebsocketSession, client: WsClient, token: Optional[str]) -> bool:
+        """ Replay events missed since the "<epoch>:<seq>" token """
+        if client.replay is None:
+            return False
+        frames = None
+        if token:
+            epoch, _, seq = token.partition(':')
+            if epoch == client.epoch and seq.isdigit():
+                frames = client.replay.since(int(seq))
+        session.send_frame(SessionEvent(epoch=client.epoch, seq=client.seq, resumed=frames is not None).to_frame(),
+                           Priority.HIGH)
+        if frames is None:
+            return False
+        for frame in frames:
+            session.send_frame(frame, Priority.HIGH)
+        self.resumed += 1
+        return True
+
+    def forget(self, client: WsClient):
+        # the user is gone for longer than the presence grace, resume starts from scratch
+        if not client.online and self.ws_clients.get(client.user_id) is client:
+            del self.ws_clients[client.user_id]
+
     async def handle_websocket(self, session):
-        async for msg in session.ws:
-            if msg.type == WSMsgType.TEXT:
-                if msg.data == 'close':
+        dispatcher = EventDispatcher(self.handle_event, max_in_flight=self.max_in_flight)
+        try:
+            async for msg in session.ws:
+                self.liveness.touch(session)
+                if msg.type == WSMsgType.PING:
+                    await session.ws.pong(msg.data)
+                elif msg.type == WSMsgType.TEXT and msg.data == 'close':
                     await session.ws.close()
                     break
-                else:
+                elif msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    # text frames are always json, binary frames are msgpack
+                    codec = self.codec if msg.type == WSMsgType.TEXT else self.binary_codec
+                    # charged before decoding, malformed and invalid frames are limited too
+                    if not self.admit_frame(session):
+                        continue
                     try:
-                        event = event_from_dict(json.loads(msg.data))
-                    except ValidationError as err:
-                        await session.ws.send_json(DomainValidationError(msg=err.normalized_messages()).to_dict())
+                        if codec is None:
+                            raise DomainValidationError("Binary frames are not supported")
+                        try:
+                            data = codec.loads(msg.data)
+                        except codec.decode_errors:
+                            raise DomainValidationError("Malformed frame")
+                        if isinstance(data, list):
+                            await self.handle_batch(data, session, dispatcher)
+                            continue
+                        event = event_from_dict(data)
                     except DomainValidationError as err:
-                        await session.ws.send_json(err.to_dict())
+                        session.send_json(err.to_dict())
                     else:
-                        stop = await self.handle_event(event, session)
-                        if stop:
-                            break
+                        if self.admit(event, session, prepaid=self.rate_limiter.FRAME_COST):
+                            await dispatcher.submit(event, session)
+
+                elif msg.type == WSMsgType.ERROR:
+                    logger.debug('ws connection closed with exception %s' %
+                          session.ws.exception())
+        finally:
+            await dispatcher.join()
+
+    async def handle_batch(self, data: list, session: WebsocketSession, dispatcher: EventDispatcher):
+        """ Several events in one frame, responses are sent back in one frame {"batch": [...]}
+        in the order of events """
+        if not data or len(data) > self.max_batch_size:
+            raise DomainValidationError(f"Batch size must be from 1 to {self.max_batch_size}")
+        batch, tasks = [], []
+        # the frame tokens count toward the first event
+        prepaid = self.rate_limiter.FRAME_COST
+        for item in data:
+            batch_session = BatchSession(session)
+            batch.append(batch_session)
+            try:
+                event = event_from_dict(item)
+            except DomainValidationError as err:
+                batch_session.send_json(err.to_dict())
+            else:
+                admitted, prepaid = self.admit(event, batch_session, prepaid), 0.0
+                if admitted:
+                    tasks.append(await dispatcher.submit(event, batch_session))
+        dispatcher.spawn(self._send_batch(batch, tasks, session))
 
-            elif msg.type == WSMsgType.ERROR:
-                logger.debug('ws connection closed with exception %s' %
-                      session.ws.exception())
+    @staticmethod
+    async def _send_batch(batch: List[BatchSession], tasks: List[asyncio.Task], session: WebsocketSession):
+        if tasks:
+            await asyncio.wait(tasks)
+        session.send_json({"batch": [response for batch_session in batch for response in batch_session.responses]})
+
+    def admit_frame(self, session) -> bool:
+        try:
+            self.rate_limiter.check_frame(session, self.ws_clients.get(session.user_id))
+        except ThrottledError as err:
+            self.send_error(session, err)
+            return False
+        return True
+
+    def admit(self, event, session, prepaid: float = 0.0) -> bool:
+        try:
+            self.rate_limiter.check(session, self.ws_clients.get(session.user_id), event.resource, prepaid)
+        except ThrottledError as err:
+            self.send_error(session, err, event)
+            return False
+        return True
 
     async def on_connect(self, session):
         if self.connect_handler:
-            connect_handler = await self.connect_handler()
-            broadcast_list = await connect_handler(None, session)
+            async with self.unit_of_work():
+                broadcast_list = await self.connect_handler(None, session)
             logger.debug(f"{broadcast_list}, {len(broadcast_list)}")
-            await asyncio.gather(*[self.broadcast(broadcast_message) for broadcast_message in broadcast_list])
+            await self.broadcast_presence(broadcast_list)
         else:
             logger.debug(f"New connection: {session}")
 
     async def on_disconnect(self, session):
         if self.disconnect_handler:
-            disconnect_handler = await self.disconnect_handler()
-            broadcast_list = await disconnect_handler(None, session)
+            async with self.unit_of_work():
+                broadcast_list = await self.disconnect_handler(None, session)
             logger.debug(f"{broadcast_list}, {len(broadcast_list)}")
-            await asyncio.gather(*[self.broadcast(broadcast_message) for broadcast_message in broadcast_list])
+            await self.broadcast_presence(broadcast_list)
         else:
 
             logger.debug(f"Connection close {session}")
 
     async def handle_event(self, event, session):
+        logger.debug(f"{event} - {session}")
+        handlers = self.query_handlers if isinstance(event, Query) else self.command_handlers
+        try:
+            handler = handlers[event.resource]
+        except KeyError as e:
+            self.send_error(session, DomainValidationError(f"Invalid resource {e}"), event)
+            return
         try:
-            logger.debug(f"{event} - {session}")
             if isinstance(event, Query):
-                query_handler = self.query_handlers[event.resource]
-                await query_handler(event, session)
-            elif isinstance(event, Command):
-                command_handler = self.command_handlers[event.resource]
-                broadcast_list = await command_handler(event, session)
+                async with self.unit_of_work():
+                    await handler(event, session)
+            else:
+                # the session is released before broadcasting
+                async with self.unit_of_work():
+                    broadcast_list = await handler(event, session)
                 logger.debug(f"broadcast: {broadcast_list}")
                 await asyncio.gather(*[self.broadcast(broadcast_message) for broadcast_message in broadcast_list])
+        except DomainError as err:
+            self.send_error(session, err, event)
 
-        except KeyError as e:
-            try:
-                await session.ws.send_json(DomainValidationError(f"Invalid resource {e}").to_dict())
-            except ConnectionResetError:
-                # connection already close
-                return True
+    @staticmethod
+    def send_error(session, err: DomainError, event=None):
+        # uid lets the client match the error with its query/command
+        data = err.to_dict()
+        if event is not None:
+            data["uid"] = event.uid
+        session.send_json(data)
 
     async def broadcast(self, broadcast: Broadcast):
-        for receiver in broadcast.receivers:
+        # event is serialized once, all sessions (and other workers) share the same frame
+        await self.bus.publish(broadcast.receivers, broadcast.event.to_frame(), broadcast.priority)
+
+    async def broadcast_presence(self, broadcast_list: List[Broadcast]):
+        # presence is interesting only for connected friends, other workers' clients are unknown here
+        for broadcast_message in broadcast_list:
+            if self.bus.local:
+                broadcast_message.receivers = connected_only(broadcast_message.receivers, self.ws_clients)
+            if broadcast_message.receivers:
+                await self.broadcast(broadcast_message)
+
+    def deliver(self, receivers: List[int], frame: Frame, priority: Priority):
+        # encoded once here, replay buffers measure frames in this format
+        try:
+            frame.encode(self.codec)
+        except Exception:
+            logger.exception(f"broadcast frame encode error, dropped for {len(receivers)} receivers")
+            self.encode_errors += 1
+            return
+        # only enqueue, every session has own writer task
+        for receiver in receivers:
             client = self.ws_clients.get(receiver)
             if client:
-                await client.send_json(broadcast.event.to_dict())
+                client.send_frame(frame, priority)
+
+    def stats(self):
+        sessions = [session for client in self.ws_clients.values() for session in client.session_list]
+        return {
+            "sessions": len(sessions),
+            "queue_depth": sum(session.depth for session in sessions),
+            "max_queue_depth": max((session.depth for session in sessions), default=0),
+            "sent": self.closed_sent + sum(session.sent for session in sessions),
+            "dropped": self.closed_dropped + sum(session.dropped for session in sessions),
+            "compression": self.compression_stats.to_dict(),
+            "presence": self.presence.stats(),
+            "liveness": self.liveness.stats(),
+            "throttled": self.rate_limiter.throttled,
+            "encode_errors": self.encode_errors,
+            "resumed": self.resumed,
+            "auth_cache": self.token_cache.stats() if self.token_cache is not None else None,
+            "db_pool": self.db_pool.stats() if hasattr(self.db_pool, "stats") else None,
+        }
 
     async def get_user(self, request):
         session_token = request.headers.get("sid") or request.query.get('sid')
         if not session_token:
             raise UnauthorizedError()
+        if self.token_cache is not None:
+            hit, user = self.token_cache.lookup(session_token)
+            if hit:
+                if user is None:
+                    raise UnauthorizedError()
+                return user
         try:
             user_list = await self.user_repo.get_users(self.user_repo.UserSearchSpec(token=session_token))
         except NotFoundError:
-            raise UnauthorizedError()
+            user_list = []
         except Exception:
             await self.user_repo.rollback()
             raise
-        if not user_list:
+        user = user_list[0] if user_list else None
+        if self.token_cache is not None:
+            self.token_cache.set(session_token, user)
+        if user is None:
             raise UnauthorizedError()
-        user = user_list[0]
         # todo: self.user_repo.update_device(spec=token, last_usage=datetime.now())
         return user
 
+    async def start(self):
+        self.liveness.start()
+        await self.bus.start()
+        self.presence.start()
+
     async def shutdown(self):
-        clients = list(self.ws_clients.values())
-        logger.debug(f"shutdown clients: {clients}")
-        for client in clients:
-            for session in set(client.session_list):
-                logger.debug(f"close: {session}")
-                await session.close(code=WSCloseCode.GOING_AWAY,
-                               message='Server shutdown')
+        await self.liveness.stop()
+        await self.drain()
+        # the presence flush must see the disconnect of every closed session
+        await self.wait_closed()
+        await self.presence.flush()
+        await self.presence.stop()
+        await self.bus.close()
+
+    async def wait_closed(self):
+        """ Wait until handle() of every session has finished, at most drain_timeout """
+        handlers = [task for task in self._handlers if task is not asyncio.current_task()]
+        if handlers:
+            _, pending = await asyncio.wait(handlers, timeout=self.drain_timeout)
+            if pending:
+                logger.warning(f"{len(pending)} sessions are still closing")
+
+    async def drain(self):
+        """ Stop accepting connections, ask every session to reconnect and close it.
+
+        Sessions are drained concurrently (at most drain_concurrency at once), the ones
+        not closed within drain_timeout are aborted.
+        """
+        self.draining = True
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        sessions = [session for client in list(self.ws_clients.values()) for session in set(client.session_list)]
+        slots = asyncio.Semaphore(self.drain_concurrency)
+
+        async def drain_session(session: WebsocketSession):
+            async with slots:
+                # jitter spreads reconnects of all clients over the reconnect_delay
+                delay = round(random.uniform(0, self.reconnect_delay), 3)
+                session.send_frame(ReconnectEvent(delay=delay).to_frame(), Priority.HIGH)
+                await session.flush()
+                await session.close(code=WSCloseCode.GOING_AWAY, message=b'Server shutdown')
+
+        forced = 0
+        tasks = [asyncio.ensure_future(drain_session(session)) for session in sessions]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+            for session, task in zip(sessions, tasks):
+                if task in pending:
+                    forced += 1
+                    session.abort()
+                elif task.exception() is not None:
+                    logger.warning(f"drain error {session}: {task.exception()!r}")
+        self.drain_stats = {"sessions": len(sessions), "forced": forced, "time": round(loop.time() - start, 3)}
+        logger.info(f"drain: {self.drain_stats}")
+        return self.drain_stats
 
     def register_command_handlers(self, handler_list):
         for resource, handler in handler_list:
@@ -162,3 +458,7 @@ class WebSocketServer:
     def register_query_handlers(self, handler_list):
         for resource, handler in handler_list:
             self.query_handlers[resource] = handler
+
+    def register_connection_handlers(self, connect_handler, disconnect_handler):
+        self.connect_handler = connect_handler
+        self.disconnect_handler = disconnect_handler
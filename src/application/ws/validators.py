@@ -0,0 +1,86 @@
+from collections.abc import Mapping
+from enum import Enum
+from typing import Any, Callable, Dict, Tuple, Type
+
+from src.core.exceptions.base import ValidationError
+
+
+MISSING_MSG = 'Missing data for required field.'
+NULL_MSG = 'Field may not be null.'
+UNKNOWN_MSG = 'Unknown field.'
+INVALID_INPUT_MSG = 'Invalid input type.'
+
+_missing = object()
+
+
+class FieldError(Exception):
+    pass
+
+
+def string(value) -> str:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise FieldError('Not a valid utf-8 string.')
+    raise FieldError('Not a valid string.')
+
+
+def mapping(value) -> dict:
+    if isinstance(value, Mapping):
+        return value
+    raise FieldError('Not a valid mapping type.')
+
+
+def enum(enum_cls: Type[Enum]) -> Callable[[Any], Enum]:
+    members = {member.value: member for member in enum_cls}
+
+    def convert(value) -> Enum:
+        value = string(value)
+        try:
+            return members[value]
+        except KeyError:
+            raise FieldError(f"'{value}' is not a valid {enum_cls.__name__}")
+    return convert
+
+
+def compile_decoder(fields: Dict[str, Tuple[Callable[[Any], Any], bool]]) -> Callable[[Any], dict]:
+    """ Build a decoder for fields: name -> (converter, required).
+
+    Error messages are the same as marshmallow schemas in adapters.py produce.
+    """
+    names = frozenset(fields)
+    items = tuple((name, converter, required) for name, (converter, required) in fields.items())
+
+    def decode(data) -> dict:
+        if not isinstance(data, dict):
+            raise ValidationError(msg={'_schema': [INVALID_INPUT_MSG]})
+        result = {}
+        errors = None
+        for name, converter, required in items:
+            value = data.get(name, _missing)
+            try:
+                if value is _missing:
+                    if required:
+                        raise FieldError(MISSING_MSG)
+                    continue
+                if value is None:
+                    raise FieldError(NULL_MSG)
+                result[name] = converter(value)
+            except FieldError as e:
+                if errors is None:
+                    errors = {}
+                errors[name] = [str(e)]
+        if not names.issuperset(data):
+            if errors is None:
+                errors = {}
+            for key in data:
+                if key not in names:
+                    errors[key] = [UNKNOWN_MSG]
+        if errors:
+            raise ValidationError(msg=errors)
+        return result
+
+    return decode
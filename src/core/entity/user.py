@@ -1,7 +1,7 @@
 from dataclasses import dataclass, MISSING, asdict
 from uuid import uuid4
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
 from src.core.exceptions.base import ValidationError
 
@@ -15,6 +15,7 @@ class User:
     online: bool
     last_activity: datetime
     created_at: datetime
+    updated_at: Optional[datetime] = None
 
     def check_password(self, password: str):
         if self.password != password:
@@ -88,6 +89,8 @@ class Room:
     created_at: datetime
     members_id: List[int]
     private: bool = True
+    updated_at: Optional[datetime] = None
+    deleted_at: Optional[datetime] = None
 
     @property
     def name(self):
@@ -102,5 +105,17 @@ class Message:
     msg_type: int
     msg_body: str
     created_at: datetime
+    updated_at: Optional[datetime] = None
+    deleted_at: Optional[datetime] = None
 
     # todo msg_type Enum?
+
+
+@dataclass
+class MessageMatch:
+    """ full-text search hit """
+    message: Message
+    rank: float
+    # plain text fragments of msg_body, the matched words are between \x02 and \x03;
+    # clients escape the text before turning the markers into markup
+    snippet: str
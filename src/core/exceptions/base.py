@@ -55,5 +55,25 @@ class NotUniqueError(DomainError):
         super().__init__(msg or f"Not unique {obj}: {value}")
 
 
+class UnavailableError(DomainError):
+    code = 6
+
+    def __init__(self, msg=None):
+        super().__init__(msg or "Service unavailable")
+
+
+class ThrottledError(DomainError):
+    code = 7
+
+    def __init__(self, msg=None, retry_after: float = 0):
+        self.retry_after = retry_after
+        super().__init__(msg or "Too many requests")
+
+    def to_dict(self):
+        data = super().to_dict()
+        data["error"]["retry_after"] = self.retry_after
+        return data
+
+
 class StorageError(DomainError):
-    pass
\ No newline at end of file
+    pass
@@ -43,8 +43,7 @@ class UseCase(UseCaseBase):
         except ValidationError as e:
             return FailResult(code=e.code, msg=str(e))
         device_token = Device.generate_token()
-        device_id = await self.user_repo.create_device(user.id, name=device_name, info=device_info,
-                                                       token=device_token)
+        await self.user_repo.create_device(user.id, name=device_name, info=device_info, token=device_token)
         await self.user_repo.commit()
 
         return SuccessResult(device_name=device_name, token=device_token, id=user.id)
@@ -1,7 +1,7 @@
 from typing import Union
 from dataclasses import dataclass
 
-from src.core.exceptions.base import NotFoundError
+from src.core.exceptions.base import UnauthorizedError
 from src.core.usecase.base import SuccessResultBase, FailResultBase, UseCaseBase
 
 
@@ -20,15 +20,16 @@ class UseCase(UseCaseBase):
     SuccessResult = SuccessResult
     FailResult = FailResult
 
-    def __init__(self, user_repo):
+    def __init__(self, user_repo, token_cache=None):
         self.user_repo = user_repo
-
-    def execute(self, user_session) -> Union[SuccessResult, FailResult]:
-        try:
-            device = self.user_repo.get_device(user_session)
-        except NotFoundError as e:
-            return FailResult(4, msg="Unauthorized")
-
-        self.user_repo.delete_device(device)
-        self.user_repo.commit()
+        self.token_cache = token_cache
+
+    async def execute(self, user_session: str) -> Union[SuccessResult, FailResult]:
+        deleted = await self.user_repo.delete_device(user_session)
+        if not deleted:
+            await self.user_repo.rollback()
+            return FailResult(code=UnauthorizedError.code, msg="Unauthorized")
+        await self.user_repo.commit()
+        if self.token_cache is not None:
+            self.token_cache.invalidate(user_session)
         return SuccessResult()
@@ -39,7 +39,7 @@ class UseCase(UseCaseBase):
             await self.user_repo.rollback()
             return FailResult(e.code, str(e))
         code = Confirmation.generate_code()
-        confirmation_id = await self.user_repo.create_confirmation(
+        await self.user_repo.create_confirmation(
             user_id, type_="register", code=code,
             expires_at=(datetime.utcnow()+timedelta(days=1))
         )
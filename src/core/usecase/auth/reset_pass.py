@@ -41,7 +41,7 @@ class UseCase(UseCaseBase):
         user = user_list[0]
         code = Confirmation.generate_code()
         try:
-            confirmation_id = await self.user_repo.create_confirmation(
+            await self.user_repo.create_confirmation(
                 user.id, type_="reset_password", code=code,
                 expires_at=(datetime.utcnow() + timedelta(days=1))
             )
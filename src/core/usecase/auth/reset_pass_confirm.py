@@ -21,8 +21,9 @@ class UseCase(UseCaseBase):
     SuccessResult = SuccessResult
     FailResult = FailResult
 
-    def __init__(self, user_repo):
+    def __init__(self, user_repo, token_cache=None):
         self.user_repo = user_repo
+        self.token_cache = token_cache
 
     async def execute(self, confirm_code: str, password: str) -> Union[SuccessResult, FailResult]:
         spec = self.user_repo.ConfirmationSearchSpec(code=confirm_code)
@@ -40,8 +41,12 @@ class UseCase(UseCaseBase):
         try:
             await self.user_repo.update_confirmation(confirmation_id=confirmation.id, data=asdict(confirmation))
             await self.user_repo.update_user(user_id=confirmation.user_id, data=User.update(password=password))
+            # sessions opened with the old password are logged out
+            await self.user_repo.delete_user_devices(confirmation.user_id)
             await self.user_repo.commit()
         except Exception as e:
             await self.user_repo.rollback()
             return FailResult(msg="Unexpected error", code=6)
+        if self.token_cache is not None:
+            self.token_cache.invalidate_user(confirmation.user_id)
         return SuccessResult()
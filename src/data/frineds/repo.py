@@ -1,5 +1,5 @@
 import logging
-from typing import List
+from typing import List, Tuple
 from enum import Enum
 import aiohttp
 
@@ -114,6 +114,39 @@ class FriendsRepo:
             r_user_id_list.extend(u['id'] for u in row['row'])
         return r_user_id_list
 
+    async def get_friendships(self, user_id, since: int = 0) -> List[Tuple[int, int]]:
+        """ (friend id, neo4j timestamp when the friendship became mutual) created at or after since """
+        stmt = """
+                match (e:{user_label} {{id: $user_id}})-[r:{friendship_label}]->(d:{user_label})
+                match (d)-[r2:{friendship_label}]->(e)
+                with d, coalesce(r.created_at, 0) as t1, coalesce(r2.created_at, 0) as t2
+                with d, case when t1 > t2 then t1 else t2 end as created_at
+                where created_at >= $since
+                return d.id, created_at
+                """
+        parameters = {
+            "user_id": user_id,
+            "since": since
+        }
+        stmt = stmt.format_map(
+            dict(
+                user_label=Label.USER.value,
+                friendship_label=Label.FRIENDSHIP.value
+            )
+        )
+        body = {
+            "statements": [{
+                "statement": stmt,
+                "parameters": parameters
+
+            }]
+        }
+        result = await self._request(body)
+        if result['errors']:
+            raise StorageError(str(result['errors']))
+        stmt_result = result['results'][0]
+        return [(row['row'][0], row['row'][1]) for row in stmt_result['data']]
+
     async def get_incoming_friend_request(self, user_id) -> List[int]:
         stmt = """
         match (e:{user_label})-[r:{friendship_label}]->(d:{user_label} {{id: $user_id}})
@@ -182,7 +215,7 @@ class FriendsRepo:
         stmt = """
         match (e:{user_label}) where not exists((e)-[:Friendship]->(:{user_label} {{id: $friend_id}})) and e.id=$user_id
         match (d:{user_label}) where d.id=$friend_id
-        create (e)-[r:{friendship_label}]->(d)
+        create (e)-[r:{friendship_label} {{created_at: timestamp()}}]->(d)
         return r
         """
         parameters = {
@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from src.core.entity.user import User
+
+
+class TokenCache:
+    """ LRU cache token -> user for connect authentication.
+
+    Unknown tokens are cached as None for `negative_ttl`. Invalidation is local to
+    the process, the cache is only used with one worker (WS_BUS=local).
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300.0, negative_ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # token -> (expires, user)
+        self._items: 'OrderedDict[str, Tuple[float, Optional[User]]]' = OrderedDict()
+        self._user_tokens: Dict[int, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def lookup(self, token: str) -> Tuple[bool, Optional[User]]:
+        """ (True, user) on hit, user is None for a cached unknown token """
+        item = self._items.get(token)
+        if item is not None:
+            expires, user = item
+            if expires > time.monotonic():
+                self._items.move_to_end(token)
+                if user is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return True, user
+            self._remove(token)
+        self.misses += 1
+        return False, None
+
+    def set(self, token: str, user: Optional[User]):
+        self._remove(token)
+        ttl = self.ttl if user is not None else self.negative_ttl
+        self._items[token] = (time.monotonic() + ttl, user)
+        if user is not None:
+            self._user_tokens.setdefault(user.id, set()).add(token)
+        while len(self._items) > self.max_size:
+            self._remove(next(iter(self._items)))
+
+    def invalidate(self, token: str):
+        self._remove(token)
+
+    def invalidate_user(self, user_id: int):
+        for token in self._user_tokens.pop(user_id, ()):
+            self._items.pop(token, None)
+
+    def _remove(self, token: str):
+        item = self._items.pop(token, None)
+        if item is not None and item[1] is not None:
+            tokens = self._user_tokens.get(item[1].id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._user_tokens[item[1].id]
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
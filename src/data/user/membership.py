@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, Optional, Set
+
+from src.core.entity.user import Room
+
+
+class RoomMembershipIndex:
+    """ room_id -> member ids and user_id -> room ids of the rooms known to this process.
+
+    Filled lazily from room reads and on room creation, membership is fixed when a room
+    is created. Deleted rooms seen by room queries are dropped, the least recently used
+    rooms are evicted above `max_rooms`. Changes made by other workers are not seen, the
+    index is only used with one worker (WS_BUS=local).
+    """
+
+    def __init__(self, max_rooms: int = 100000):
+        self.max_rooms = max_rooms
+        self._members: 'OrderedDict[int, FrozenSet[int]]' = OrderedDict()
+        self._rooms: Dict[int, Set[int]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def members(self, room_id: int) -> Optional[FrozenSet[int]]:
+        """ member ids of the room, None if the room is not indexed """
+        members = self._members.get(room_id)
+        if members is None:
+            self.misses += 1
+            return None
+        self._members.move_to_end(room_id)
+        self.hits += 1
+        return members
+
+    def rooms(self, user_id: int) -> FrozenSet[int]:
+        """ indexed rooms of the user """
+        return frozenset(self._rooms.get(user_id, ()))
+
+    def set_room(self, room_id: int, members_id: Iterable[int]):
+        self.invalidate_room(room_id)
+        members = frozenset(members_id)
+        self._members[room_id] = members
+        for user_id in members:
+            self._rooms.setdefault(user_id, set()).add(room_id)
+        while len(self._members) > self.max_rooms:
+            self.invalidate_room(next(iter(self._members)))
+
+    def update(self, rooms: Iterable[Room]):
+        for room in rooms:
+            if room.deleted_at:
+                self.invalidate_room(room.id)
+            else:
+                self.set_room(room.id, room.members_id)
+
+    def invalidate_room(self, room_id: int):
+        members = self._members.pop(room_id, None)
+        if members is None:
+            return
+        for user_id in members:
+            rooms = self._rooms.get(user_id)
+            if rooms is not None:
+                rooms.discard(room_id)
+                if not rooms:
+                    del self._rooms[user_id]
+
+    def __len__(self):
+        return len(self._members)
+
+    def stats(self):
+        return {
+            "rooms": len(self._members),
+            "users": len(self._rooms),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
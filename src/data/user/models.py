@@ -1,10 +1,15 @@
 import sqlalchemy as sa
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from src.application.db import Base
 
 from src.core.consts import RoomMessageType
 
 
+# text search configuration of message search, messages are in several languages
+SEARCH_CONFIG = "simple"
+
+
 class UserModel(Base):
     __tablename__ = 'user'
 
@@ -15,6 +20,8 @@ class UserModel(Base):
     online = sa.Column(sa.Boolean, server_default='f', nullable=False)
     last_activity = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), nullable=False)
     created_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), nullable=False)
+    # change time for delta queries
+    updated_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), onupdate=sa.func.now(), nullable=False)
 
 
 class ConfirmationModel(Base):
@@ -60,6 +67,9 @@ class RoomModel(Base):
     private = sa.Column(sa.Boolean, nullable=False, server_default='t')
     creator_id = sa.Column(sa.Integer, sa.ForeignKey('user.id'))
     created_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), nullable=False)
+    updated_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), onupdate=sa.func.now(), nullable=False)
+    # tombstone, deleted rooms are reported to delta queries as removed
+    deleted_at = sa.Column(sa.TIMESTAMP, nullable=True)
     members = relationship("RoomMemberModel", lazy="select")
     # todo name
 
@@ -76,4 +86,14 @@ class MessageModel(Base):
     msg_type = sa.Column(sa.Integer, server_default=str(RoomMessageType.DEFAULT.value))
     msg_body = sa.Column(sa.Text, nullable=False)
     created_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), nullable=False)
+    updated_at = sa.Column(sa.TIMESTAMP, server_default=sa.func.now(), onupdate=sa.func.now(), nullable=False)
+    deleted_at = sa.Column(sa.TIMESTAMP, nullable=True)
     # todo attachments
+    # generated by postgres, only read by search
+    msg_tsv = deferred(sa.Column(TSVECTOR, sa.Computed(f"to_tsvector('{SEARCH_CONFIG}', msg_body)", persisted=True)))
+
+    __table_args__ = (
+        # room history pages are read by keyset (created_at, id) within a room
+        sa.Index("ix_message_room_created_id", "room_id", "created_at", "id"),
+        sa.Index("ix_message_msg_tsv", "msg_tsv", postgresql_using="gin"),
+    )
@@ -0,0 +1,106 @@
+import asyncio
+import logging
+from dataclasses import replace
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.core.entity.user import User
+from src.data.user.repo import UserRepo
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceStore:
+    """ online/last_activity of the users connected to this process.
+
+    The store is the source of truth for its users, the user table is updated by a
+    periodic flush of the changed entries in one statement. Offline users are dropped
+    from the store once they are flushed. With several workers only the worker where
+    the user is left last sets offline (see PresenceManager), and an offline flush
+    never overrides a later online state written by another worker.
+    """
+
+    def __init__(self, unit_of_work: Callable, user_repo: UserRepo, flush_interval: float = 2.0):
+        self.unit_of_work = unit_of_work
+        self.user_repo = user_repo
+        self.flush_interval = flush_interval
+        self._state: Dict[int, Tuple[bool, datetime]] = {}
+        self._dirty: Dict[int, Tuple[bool, datetime]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def set(self, user_id: int, online: bool, last_activity: Optional[datetime] = None):
+        state = (online, last_activity or datetime.now())
+        self._state[user_id] = state
+        self._dirty[user_id] = state
+
+    def get(self, user_id: int) -> Optional[Tuple[bool, datetime]]:
+        return self._state.get(user_id)
+
+    def overlay(self, user_list: List[User]) -> List[User]:
+        """ users with online/last_activity from the store """
+        result = []
+        for user in user_list:
+            state = self._state.get(user.id)
+            if state is not None:
+                user = replace(user, online=state[0], last_activity=state[1])
+            result.append(user)
+        return result
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("presence flush failed")
+
+    async def flush(self) -> int:
+        async with self._lock:
+            if not self._dirty:
+                return 0
+            batch, self._dirty = self._dirty, {}
+            try:
+                async with self.unit_of_work():
+                    await self.user_repo.update_presence(
+                        (user_id, online, last_activity) for user_id, (online, last_activity) in batch.items()
+                    )
+                    await self.user_repo.commit()
+            except Exception:
+                self.failures += 1
+                # retried with the next flush unless changed meanwhile
+                for user_id, state in batch.items():
+                    self._dirty.setdefault(user_id, state)
+                raise
+            self.flushes += 1
+            self.flushed += len(batch)
+            for user_id, (online, _) in batch.items():
+                if not online and user_id not in self._dirty:
+                    self._state.pop(user_id, None)
+            return len(batch)
+
+    def stats(self):
+        return {
+            "users": len(self._state),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "failures": self.failures,
+        }
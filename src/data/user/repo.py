@@ -1,16 +1,26 @@
-from typing import Optional, List
+from typing import Optional, List, Tuple, Iterable
 from dataclasses import dataclass, asdict
 from datetime import datetime
 
 import asyncpg
-from sqlalchemy import update, select
+from sqlalchemy import update, select, delete, insert, tuple_, and_, or_, func, literal_column, cast, \
+    Integer, Boolean, TIMESTAMP
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.dialects.postgresql.asyncpg import AsyncAdapt_asyncpg_dbapi
 from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import IntegrityError
 
 from src.core.exceptions.base import NotUniqueError, NotFoundError
-from src.core.entity.user import User, Device, Confirmation, Room, Message
-from src.data.user.models import UserModel, DeviceModel, ConfirmationModel, RoomModel, MessageModel, RoomMemberModel
+from src.core.entity.user import User, Device, Confirmation, Room, Message, MessageMatch
+from src.data.user.models import UserModel, DeviceModel, ConfirmationModel, RoomModel, MessageModel, \
+    RoomMemberModel, SEARCH_CONFIG
+
+# message columns without the search vector
+MESSAGE_COLUMNS = [column for column in MessageModel.__table__.c if column.key != "msg_tsv"]
+SEARCH_REGCONFIG = literal_column(f"'{SEARCH_CONFIG}'::regconfig")
+# snippets are plain text, matches are marked with control characters instead of html
+HIGHLIGHT_START, HIGHLIGHT_STOP = "\x02", "\x03"
+HEADLINE_OPTIONS = f"StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2, MaxWords=20, MinWords=5"
 
 
 def db_to_user(user_db: UserModel) -> User:
@@ -21,7 +31,8 @@ def db_to_user(user_db: UserModel) -> User:
         last_activity=user_db.last_activity,
         password=user_db.password,
         created_at=user_db.created_at,
-        online=user_db.online
+        online=user_db.online,
+        updated_at=user_db.updated_at
     )
 
 
@@ -53,7 +64,9 @@ def db_to_room(room_db: RoomModel) -> Room:
         id=room_db.id,
         creator_id=room_db.creator_id,
         created_at=room_db.created_at,
-        members_id=[member.user_id for member in room_db.members]
+        members_id=[member.user_id for member in room_db.members],
+        updated_at=room_db.updated_at,
+        deleted_at=room_db.deleted_at
     )
 
 
@@ -64,7 +77,9 @@ def db_to_message(message_db: MessageModel) -> Message:
         creator_id=message_db.creator_id,
         msg_type=message_db.msg_type,
         msg_body=message_db.msg_body,
-        created_at=message_db.created_at
+        created_at=message_db.created_at,
+        updated_at=message_db.updated_at,
+        deleted_at=message_db.deleted_at
     )
 
 
@@ -74,6 +89,10 @@ class UserSearchSpec:
     email: Optional[str] = None
     email_like: Optional[str] = None
     token: Optional[str] = None
+    updated_since: Optional[datetime] = None
+    # change stream page: ascending (updated_at, id) after the exclusive keyset, at most changes_limit rows
+    changed_after: Optional[Tuple[datetime, int]] = None
+    changes_limit: Optional[int] = None
 
     def __repr__(self):
         spec_data = {k: v for k, v in asdict(self).items() if v}
@@ -97,6 +116,11 @@ class ConfirmationSearchSpec:
 class RoomSearchSpec:
     id_list: Optional[List[int]] = None
     member_id: Optional[int] = None  # user_id
+    # changed rooms including deleted ones
+    updated_since: Optional[datetime] = None
+    # change stream page: ascending (updated_at, id) after the exclusive keyset, at most changes_limit rows
+    changed_after: Optional[Tuple[datetime, int]] = None
+    changes_limit: Optional[int] = None
 
 
 @dataclass
@@ -106,6 +130,34 @@ class MessageSearchSpec:
     end_time: Optional[datetime] = None
     message_body_like: Optional[str] = None
     message_id: Optional[int] = None
+    # changed messages including deleted ones
+    updated_since: Optional[datetime] = None
+    # keyset (created_at, id) bounds, exclusive
+    before: Optional[Tuple[datetime, int]] = None
+    after: Optional[Tuple[datetime, int]] = None
+    # with limit and no `after` the newest messages are taken, results are always in ascending order
+    limit: Optional[int] = None
+    # change stream page: ascending (updated_at, id) after the exclusive keyset, at most changes_limit rows
+    changed_after: Optional[Tuple[datetime, int]] = None
+    changes_limit: Optional[int] = None
+
+
+@dataclass
+class MessageTextSearchSpec:
+    text: str
+    # only rooms of this user
+    member_id: int
+    room_id: Optional[int] = None
+    limit: int = 20
+    offset: int = 0
+
+
+def changes_page(stmt, model, spec):
+    if spec.changed_after:
+        stmt = stmt.where(tuple_(model.updated_at, model.id) > tuple_(*spec.changed_after))
+    if spec.changes_limit is not None:
+        stmt = stmt.order_by(model.updated_at, model.id).limit(spec.changes_limit)
+    return stmt
 
 
 class UserRepo:
@@ -114,6 +166,7 @@ class UserRepo:
     ConfirmationSearchSpec = ConfirmationSearchSpec
     RoomSearchSpec = RoomSearchSpec
     MessageSearchSpec = MessageSearchSpec
+    MessageTextSearchSpec = MessageTextSearchSpec
 
     def __init__(self, session):
         self.session = session
@@ -129,6 +182,9 @@ class UserRepo:
             stmt = stmt.where(UserModel.email.like(f"%{spec.email_like}%"))
         if spec.token:
             stmt = stmt.join(DeviceModel).where(DeviceModel.token == spec.token)
+        if spec.updated_since:
+            stmt = stmt.where(UserModel.updated_at >= spec.updated_since)
+        stmt = changes_page(stmt, UserModel, spec)
 
         if exclude and exclude.id_list:
             stmt = stmt.where(UserModel.id.notin_(exclude.id_list))
@@ -157,19 +213,38 @@ class UserRepo:
         res = await self.session.execute(stmt)
         return True
 
-    async def create_device(self, user_id: int, name: str, info: dict, token: str):
-        device_db = DeviceModel(
+    async def update_presence(self, presence_list: Iterable[Tuple[int, bool, datetime]]) -> int:
+        """ (user_id, online, last_activity) rows in one UPDATE ... FROM unnest(...) """
+        presence_list = list(presence_list)
+        if not presence_list:
+            return 0
+        ids, online, last_activity = (list(items) for items in zip(*presence_list))
+        # typed arrays, untyped parameters would be compared as text
+        presence = func.unnest(
+            cast(ids, ARRAY(Integer)), cast(online, ARRAY(Boolean)), cast(last_activity, ARRAY(TIMESTAMP))
+        ).table_valued("id", "online", "last_activity").render_derived(name="presence")
+        stmt = update(UserModel).where(
+            UserModel.id == presence.c.id,
+            # workers flush independently, an offline state must not override a later online one
+            or_(presence.c.online, UserModel.last_activity <= presence.c.last_activity)
+        ).values(
+            online=presence.c.online, last_activity=presence.c.last_activity
+        )
+        res = await self.session.execute(stmt)
+        return res.rowcount
+
+    async def create_device(self, user_id: int, name: str, info: dict, token: str) -> Device:
+        stmt = insert(DeviceModel).values(
             user_id=user_id,
             name=name,
             info=info,
             token=token
-        )
-        self.session.add(device_db)
+        ).returning(*DeviceModel.__table__.c)
         try:
-            await self.session.flush()
+            result = await self.session.execute(stmt)
         except IntegrityError as e:
             raise NotUniqueError(f"device not unique: {name}")
-        return device_db.id
+        return db_to_device(result.one())
 
     async def get_devices(self, spec: DeviceSearchSpec):
         stmt = select(DeviceModel)
@@ -181,20 +256,29 @@ class UserRepo:
             for entity in result.scalars()
         ]
 
-    async def create_confirmation(self, user_id: int, code: str, type_: str, expires_at: int):
-        confirmation_db = ConfirmationModel(
+    async def delete_device(self, token: str) -> bool:
+        stmt = delete(DeviceModel).where(DeviceModel.token == token)
+        res = await self.session.execute(stmt)
+        return bool(res.rowcount)
+
+    async def delete_user_devices(self, user_id: int) -> int:
+        stmt = delete(DeviceModel).where(DeviceModel.user_id == user_id)
+        res = await self.session.execute(stmt)
+        return res.rowcount
+
+    async def create_confirmation(self, user_id: int, code: str, type_: str, expires_at: int) -> Confirmation:
+        stmt = insert(ConfirmationModel).values(
             user_id=user_id,
             code=code,
             type_=type_,
             expires_at=expires_at
-        )
-        self.session.add(confirmation_db)
+        ).returning(*ConfirmationModel.__table__.c)
         try:
-            await self.session.flush()
+            result = await self.session.execute(stmt)
         except IntegrityError as e:
             print(e.orig)
             raise NotUniqueError(f"device not unique: {code}")
-        return confirmation_db.id
+        return db_to_confirmation(result.one())
 
     async def update_confirmation(self, confirmation_id: int, data: dict):
         data = {k: v for k, v in data.items() if k in ['confirmed_at']}
@@ -224,6 +308,11 @@ class UserRepo:
             stmt = stmt.where(RoomModel.id.in_(spec.id_list))
         if spec.member_id:
             stmt = stmt.join(RoomMemberModel).where(RoomMemberModel.user_id == spec.member_id)
+        if spec.updated_since:
+            stmt = stmt.where(RoomModel.updated_at >= spec.updated_since)
+        else:
+            stmt = stmt.where(RoomModel.deleted_at.is_(None))
+        stmt = changes_page(stmt, RoomModel, spec)
         # stmt = stmt.distinct()
         result = await self.session.execute(stmt)
 
@@ -232,19 +321,28 @@ class UserRepo:
             for entity in result.scalars()
         ]
 
-    async def create_room(self, creator_id: int, members_id: List[int], private=False):
-        members = [RoomMemberModel(user_id=user_id) for user_id in members_id]
-        room_db = RoomModel(creator_id=creator_id, private=private,
-                            members=members)
-        self.session.add(room_db)
+    async def create_room(self, creator_id: int, members_id: List[int], private=False) -> Room:
+        room_stmt = insert(RoomModel).values(creator_id=creator_id, private=private).returning(*RoomModel.__table__.c)
         try:
-            await self.session.flush()
+            room_row = (await self.session.execute(room_stmt)).one()
+            await self.session.execute(
+                insert(RoomMemberModel),
+                [{"user_id": user_id, "room_id": room_row.id} for user_id in members_id]
+            )
         except IntegrityError as e:
             await self.session.rollback()
             if isinstance(e.orig, AsyncAdapt_asyncpg_dbapi.IntegrityError):
                 raise NotFoundError(f"Not found users with {members_id=}") from e
-            raise NotUniqueError(f"room not unique: {room_db}") from e
-        return room_db.id
+            raise NotUniqueError(f"room not unique: {creator_id=}, {members_id=}") from e
+        return Room(
+            id=room_row.id,
+            creator_id=room_row.creator_id,
+            created_at=room_row.created_at,
+            members_id=list(members_id),
+            private=room_row.private,
+            updated_at=room_row.updated_at,
+            deleted_at=room_row.deleted_at
+        )
 
     async def get_messages(self, spec: MessageSearchSpec):
         stmt = select(MessageModel)
@@ -256,27 +354,92 @@ class UserRepo:
             stmt = stmt.where(MessageModel.created_at >= spec.start_time)
         if spec.end_time:
             stmt = stmt.where(MessageModel.created_at <= spec.end_time)
+        if spec.message_body_like:
+            stmt = stmt.where(MessageModel.msg_body.ilike(f"%{spec.message_body_like}%"))
+        if spec.updated_since:
+            stmt = stmt.where(MessageModel.updated_at >= spec.updated_since)
+        else:
+            stmt = stmt.where(MessageModel.deleted_at.is_(None))
+        position = tuple_(MessageModel.created_at, MessageModel.id)
+        if spec.before:
+            stmt = stmt.where(position < tuple_(*spec.before))
+        if spec.after:
+            stmt = stmt.where(position > tuple_(*spec.after))
+        stmt = changes_page(stmt, MessageModel, spec)
+        newest_first = spec.limit is not None and spec.after is None and spec.changes_limit is None
+        if newest_first:
+            stmt = stmt.order_by(MessageModel.created_at.desc(), MessageModel.id.desc())
+        elif spec.changes_limit is None:
+            stmt = stmt.order_by(MessageModel.created_at, MessageModel.id)
+        if spec.limit is not None:
+            stmt = stmt.limit(spec.limit)
         result = await self.session.execute(stmt)
 
-        return [
+        message_list = [
             db_to_message(entity)
             for entity in result.scalars()
         ]
+        if newest_first:
+            message_list.reverse()
+        return message_list
+
+    async def search_messages(self, spec: MessageTextSearchSpec) -> List[MessageMatch]:
+        """ Full-text search over the msg_tsv GIN index, best matches first """
+        tsquery = func.websearch_to_tsquery(SEARCH_REGCONFIG, spec.text)
+        rank = func.ts_rank(MessageModel.msg_tsv, tsquery).label("rank")
+        page = (
+            select(MessageModel.id, rank)
+            .join(RoomMemberModel, and_(RoomMemberModel.room_id == MessageModel.room_id,
+                                        RoomMemberModel.user_id == spec.member_id))
+            .where(MessageModel.msg_tsv.op("@@")(tsquery), MessageModel.deleted_at.is_(None))
+        )
+        if spec.room_id:
+            page = page.where(MessageModel.room_id == spec.room_id)
+        page = page.order_by(rank.desc(), MessageModel.id.desc()).limit(spec.limit).offset(spec.offset).subquery()
+        # snippets are built only for the rows of the page
+        # markers typed into a message must not pass for highlights
+        body = func.translate(MessageModel.msg_body, HIGHLIGHT_START + HIGHLIGHT_STOP, "")
+        snippet = func.ts_headline(SEARCH_REGCONFIG, body, tsquery, HEADLINE_OPTIONS).label("snippet")
+        stmt = (
+            select(*MESSAGE_COLUMNS, page.c.rank, snippet)
+            .join(page, page.c.id == MessageModel.id)
+            .order_by(page.c.rank.desc(), MessageModel.id.desc())
+        )
+        result = await self.session.execute(stmt)
+        return [
+            MessageMatch(message=db_to_message(row), rank=row.rank, snippet=row.snippet)
+            for row in result
+        ]
 
-    async def create_message(self, creator_id: int, room_id: int, msg_type: str, msg_body: str):
-        message_db = MessageModel(
+    async def create_message(self, creator_id: int, room_id: int, msg_type: str, msg_body: str) -> Message:
+        stmt = insert(MessageModel).values(
             room_id=room_id,
             creator_id=creator_id,
             msg_type=msg_type,
             msg_body=msg_body
-        )
-        self.session.add(message_db)
+        ).returning(*MESSAGE_COLUMNS)
         try:
-            await self.session.flush()
+            result = await self.session.execute(stmt)
         except IntegrityError as e:
             await self.session.rollback()
             raise NotFoundError(obj="Room", search_spec={"room_id":room_id})
-        return message_db.id
+        return db_to_message(result.one())
+
+    async def create_messages(self, message_list: List[dict]) -> List[Message]:
+        """ Multi-row insert, messages are returned in the order of message_list """
+        if not message_list:
+            return []
+        # ids are taken from the sequence first, the order of RETURNING rows is not defined
+        sequence = func.pg_get_serial_sequence(MessageModel.__tablename__, MessageModel.id.name)
+        ids_stmt = select(func.nextval(sequence)).select_from(
+            func.generate_series(cast(1, Integer), cast(len(message_list), Integer))
+        )
+        id_list = (await self.session.execute(ids_stmt)).scalars().all()
+        stmt = insert(MessageModel).values(
+            [dict(values, id=message_id) for values, message_id in zip(message_list, id_list)]
+        ).returning(*MESSAGE_COLUMNS)
+        rows = {row.id: row for row in (await self.session.execute(stmt)).all()}
+        return [db_to_message(rows[message_id]) for message_id in id_list]
 
     async def commit(self):
         await self.session.commit()
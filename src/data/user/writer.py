@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from src.core.entity.user import Message
+from src.core.exceptions.base import UnavailableError
+from src.data.user.repo import UserRepo
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """ Group commit of chat messages.
+
+    Messages wait up to `max_latency` seconds after the first one, or until `max_batch`
+    are pending, and are written with one multi-row INSERT in one transaction. Each
+    writer gets the persisted Message when its batch is committed.
+    """
+
+    def __init__(self, unit_of_work: Callable, user_repo: UserRepo, max_batch: int = 100,
+                 max_latency: float = 0.005):
+        self.unit_of_work = unit_of_work
+        self.user_repo = user_repo
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._first_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_seen = 0
+        self.fallbacks = 0
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def write(self, creator_id: int, room_id: int, msg_type: int, msg_body: str) -> Message:
+        if self._closing:
+            raise UnavailableError("Message writer is closed")
+        self.start()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if not self._pending:
+            self._first_at = loop.time()
+            self._wakeup.set()
+        self._pending.append((dict(creator_id=creator_id, room_id=room_id, msg_type=msg_type, msg_body=msg_body),
+                              future))
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def close(self):
+        """ Write the pending messages and stop """
+        self._closing = True
+        if self._task is None:
+            return
+        self._wakeup.set()
+        self._full.set()
+        await self._task
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._wakeup.wait()
+            if not self._pending:
+                self._wakeup.clear()
+                if self._closing:
+                    return
+                continue
+            timeout = self._first_at + self.max_latency - loop.time()
+            if timeout > 0 and len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            # the rest of an overfull batch keeps its _first_at and goes out right after this one
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if len(self._pending) < self.max_batch and not self._closing:
+                self._full.clear()
+            await self._write(batch)
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            async with self.unit_of_work():
+                message_list = await self.user_repo.create_messages([values for values, _ in batch])
+                await self.user_repo.commit()
+        except IntegrityError:
+            # one row with a removed room fails the statement, the others are written one by one
+            self.fallbacks += 1
+            await asyncio.gather(*[self._write_one(values, future) for values, future in batch])
+            return
+        except Exception as e:
+            logger.exception("message batch failed")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.batches += 1
+        self.messages += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        for (_, future), message in zip(batch, message_list):
+            if not future.done():
+                future.set_result(message)
+
+    async def _write_one(self, values: dict, future: asyncio.Future):
+        try:
+            async with self.unit_of_work():
+                message = await self.user_repo.create_message(**values)
+                await self.user_repo.commit()
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.messages += 1
+        if not future.done():
+            future.set_result(message)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch": round(self.messages / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch_seen,
+            "fallbacks": self.fallbacks,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import time
+from unittest import mock
+
+from src.application.ws.adapters import CommandAction
+from src.application.ws.base import WebsocketSession, WsClient
+from src.application.ws.event import Broadcast, Command, CommandDoneEvent
+from src.application.ws.server import WebSocketServer
+
+
+RECEIVERS = (1, 10, 100, 500)
+ROUNDS = 100
+
+
+class NullWs:
+    async def send_str(self, data):
+        pass
+
+
+class CountingEvent(CommandDoneEvent):
+    to_dict_calls = 0
+
+    def to_dict(self):
+        CountingEvent.to_dict_calls += 1
+        return super().to_dict()
+
+
+async def bench(receivers_count):
+    ws_clients = {}
+    for user_id in range(receivers_count):
+        client = ws_clients[user_id] = WsClient(user_id)
+        session = WebsocketSession(NullWs(), user_id=user_id, sid=None, max_queue_size=ROUNDS)
+        session.start()
+        client.add(session)
+    server = WebSocketServer(user_repo=None, ws_connection_repo=ws_clients)
+    command = Command(resource="message", action=CommandAction.CREATE,
+                      payload={"room_id": 1, "msg_type": 1, "msg_body": "x" * 200})
+    event = CountingEvent(command=command, user_id=1, result={"id": 1})
+
+    CountingEvent.to_dict_calls = 0
+    with mock.patch.object(json, 'dumps', wraps=json.dumps) as dumps:
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            await server.broadcast(Broadcast(receivers=list(ws_clients), event=event))
+        while any(session.depth for client in ws_clients.values() for session in client.session_list):
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        encode_calls = dumps.call_count
+
+    for client in ws_clients.values():
+        for session in list(client.session_list):
+            await session.stop()
+
+    assert CountingEvent.to_dict_calls == ROUNDS, CountingEvent.to_dict_calls
+    assert encode_calls == ROUNDS, encode_calls
+    print(f"receivers={receivers_count:<4} encodes/broadcast={encode_calls / ROUNDS:.0f} "
+          f"to_dict/broadcast={CountingEvent.to_dict_calls / ROUNDS:.0f} "
+          f"time/broadcast={elapsed / ROUNDS * 1000:.3f}ms")
+
+
+async def main():
+    for receivers_count in RECEIVERS:
+        await bench(receivers_count)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
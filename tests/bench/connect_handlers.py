@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+
+from dependency_injector import providers
+
+from src.application.containers import Container
+from src.application.handlers.websocket import connection
+
+
+CONNECTS = int(os.getenv("BENCH_CONNECTS", 100_000))
+
+
+class FriendRepo:
+    async def get_friends_id(self, user_id):
+        return []
+
+
+async def init_friend_repo():
+    # async resource like the neo4j repo, makes dependent providers async
+    yield FriendRepo()
+
+
+def container():
+    container = Container()
+    container.config.from_dict(dict(db_user="user", db_password="password", db_host="localhost", db_name="chat",
+                                     db_pool_size=10, db_max_overflow=10, db_pool_timeout=30,
+                                     db_pool_pre_ping=False, db_statement_timeout=10000,
+                                     presence_flush_interval=2.0))
+    container.friend_repo.override(providers.Resource(init_friend_repo))
+    return container
+
+
+async def per_connect_factory(container):
+    # before: every connect built the handler and its repos through the provider graph
+    factory = providers.Factory(
+        connection.OnConnectHandler,
+        friend_repo=container.friend_repo,
+        user_repo=container.user_repo,
+        ws_connection_repo=container.ws_connection_repo,
+        presence_store=container.presence_store
+    )
+    start = time.perf_counter()
+    for _ in range(CONNECTS):
+        handler = await factory()
+        async with container.unit_of_work():
+            assert handler is not None
+    return time.perf_counter() - start
+
+
+async def pre_resolved(container):
+    # after: the handler is resolved once, only the unit of work is created per connect
+    handler = await container.connect_handler()
+    start = time.perf_counter()
+    for _ in range(CONNECTS):
+        async with container.unit_of_work():
+            assert handler is not None
+    return time.perf_counter() - start
+
+
+async def main():
+    print(f"connects: {CONNECTS:,} (handler resolution only, no db)")
+    factory_time = await per_connect_factory(container())
+    resolved_time = await pre_resolved(container())
+    print(f"factory={factory_time:.2f}s ({factory_time / CONNECTS * 1e6:.1f}us/connect) "
+          f"pre-resolved={resolved_time:.2f}s ({resolved_time / CONNECTS * 1e6:.1f}us/connect) "
+          f"speedup={factory_time / resolved_time:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import os
+import time
+
+from src.application.ws.adapters import QuerySchema, CommandSchema
+from src.application.ws.event import Query, Command
+
+
+EVENTS = int(os.getenv("BENCH_EVENTS", 1_000_000))
+
+QUERY = {"resource": "message", "payload": {"room_id": 1}, "uid": "q-1"}
+COMMAND = {"resource": "message", "action": "create", "uid": "c-1",
+           "payload": {"room_id": 1, "msg_type": 1, "msg_body": "hello"}}
+
+
+def schema_round_trip(schema, event_cls, data):
+    event = event_cls(**schema.load(data))
+    return schema.dump(event)
+
+
+def compiled_round_trip(schema, event_cls, data):
+    return event_cls.from_dict(data).to_dict()
+
+
+def bench(round_trip, schema, event_cls, data):
+    start = time.perf_counter()
+    for _ in range(EVENTS):
+        round_trip(schema, event_cls, data)
+    return time.perf_counter() - start
+
+
+def main():
+    print(f"events: {EVENTS:,} (load + dump)")
+    for name, schema, event_cls, data in (("query", QuerySchema(), Query, QUERY),
+                                          ("command", CommandSchema(), Command, COMMAND)):
+        assert schema_round_trip(schema, event_cls, data) == compiled_round_trip(schema, event_cls, data)
+        marshmallow_time = bench(schema_round_trip, schema, event_cls, data)
+        compiled_time = bench(compiled_round_trip, schema, event_cls, data)
+        print(f"{name:<8} marshmallow={marshmallow_time:.2f}s compiled={compiled_time:.2f}s "
+              f"speedup={marshmallow_time / compiled_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
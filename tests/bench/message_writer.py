@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+
+from src.application.containers import Container
+from src.application.db import metadata
+from src.data.user.writer import MessageWriter
+
+
+# needs a postgres database, DB_USER/DB_PASS/DB_HOST/DB_NAME as for the app
+MESSAGES = int(os.getenv("BENCH_MESSAGES", 5000))
+SENDERS = (1, 10, 100)
+
+
+def container():
+    container = Container()
+    container.config.from_dict(dict(db_user=os.getenv("DB_USER"),
+                                    db_password=os.getenv("DB_PASS"),
+                                    db_host=os.getenv("DB_HOST"),
+                                    db_name=os.getenv("DB_NAME"),
+                                    db_pool_size=int(os.getenv("DB_POOL_SIZE", 10)),
+                                    db_max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+                                    db_pool_timeout=30.0,
+                                    db_pool_pre_ping=False,
+                                    db_statement_timeout=0))
+    return container
+
+
+async def create_room(container):
+    async with container.unit_of_work():
+        repo = container.user_repo()
+        user_id = await repo.create_user(f"bench-{time.time()}@test", "")
+        room = await repo.create_room(creator_id=user_id, members_id=[user_id])
+        await repo.commit()
+    return user_id, room.id
+
+
+async def direct(container, user_id, room_id, n):
+    async with container.unit_of_work():
+        repo = container.user_repo()
+        await repo.create_message(creator_id=user_id, room_id=room_id, msg_type=1, msg_body=f"m{n}")
+        await repo.commit()
+
+
+async def run(senders, send):
+    per_sender = MESSAGES // senders
+
+    async def sender(i):
+        for n in range(per_sender):
+            await send(i * per_sender + n)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[sender(i) for i in range(senders)])
+    return senders * per_sender / (time.perf_counter() - start)
+
+
+async def main():
+    di = container()
+    async with di.engine().begin() as connection:
+        await connection.run_sync(metadata.create_all)
+    user_id, room_id = await create_room(di)
+    latency = float(os.getenv("MESSAGE_WRITER_LATENCY", 0.005))
+    print(f"messages: {MESSAGES:,} max_latency={latency * 1000:.1f}ms")
+    for senders in SENDERS:
+        direct_rate = await run(senders, lambda n: direct(di, user_id, room_id, n))
+        writer = MessageWriter(di.unit_of_work, di.user_repo(), max_latency=latency)
+        batch_rate = await run(senders, lambda n: writer.write(creator_id=user_id, room_id=room_id,
+                                                                msg_type=1, msg_body=f"m{n}"))
+        await writer.close()
+        print(f"senders={senders:<4} direct={direct_rate:,.0f} msg/s batch={batch_rate:,.0f} msg/s "
+              f"avg_batch={writer.stats()['avg_batch']}")
+    await di.engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from src.core.entity.user import Message
+from src.core.exceptions.base import NotFoundError, UnavailableError
+from src.data.user.repo import UserRepo
+from src.data.user.writer import MessageWriter
+
+
+@asynccontextmanager
+async def unit_of_work():
+    yield
+
+
+class Repo:
+    def __init__(self, missing_rooms=()):
+        self.missing_rooms = set(missing_rooms)
+        self.statements = []
+        self.commits = 0
+        self.last_id = 0
+
+    def message(self, values):
+        self.last_id += 1
+        return Message(id=self.last_id, created_at=datetime.now(), **values)
+
+    async def create_messages(self, message_list):
+        await asyncio.sleep(0)
+        self.statements.append(len(message_list))
+        if any(values["room_id"] in self.missing_rooms for values in message_list):
+            raise IntegrityError("insert", {}, Exception("fk"))
+        return [self.message(values) for values in message_list]
+
+    async def create_message(self, **values):
+        self.statements.append(1)
+        if values["room_id"] in self.missing_rooms:
+            raise NotFoundError(obj="Room", search_spec={"room_id": values["room_id"]})
+        return self.message(values)
+
+    async def commit(self):
+        self.commits += 1
+
+
+def write(writer, n, room_id=1):
+    return writer.write(creator_id=n, room_id=room_id, msg_type=1, msg_body=f"m{n}")
+
+
+@pytest.mark.asyncio
+async def test_group_commit():
+    repo = Repo()
+    writer = MessageWriter(unit_of_work, repo, max_batch=100, max_latency=0.01)
+    messages = await asyncio.gather(*[write(writer, n) for n in range(30)])
+    assert [message.msg_body for message in messages] == [f"m{n}" for n in range(30)]
+    assert repo.statements == [30] and repo.commits == 1
+    await writer.close()
+    assert writer.stats()["avg_batch"] == 30
+
+
+@pytest.mark.asyncio
+async def test_max_batch():
+    repo = Repo()
+    writer = MessageWriter(unit_of_work, repo, max_batch=10, max_latency=10)
+    # full batches do not wait for max_latency
+    messages = await asyncio.wait_for(asyncio.gather(*[write(writer, n) for n in range(20)]), 1)
+    assert len({message.id for message in messages}) == 20
+    rest = asyncio.ensure_future(write(writer, 20))
+    await asyncio.sleep(0.01)
+    assert not rest.done()
+    await writer.close()
+    assert rest.result().msg_body == "m20"
+    assert repo.statements == [10, 10, 1]
+
+
+@pytest.mark.asyncio
+async def test_failed_row_does_not_fail_batch():
+    repo = Repo(missing_rooms=[2])
+    writer = MessageWriter(unit_of_work, repo, max_latency=0.01)
+    results = await asyncio.gather(write(writer, 1), write(writer, 2, room_id=2), write(writer, 3),
+                                   return_exceptions=True)
+    assert isinstance(results[1], NotFoundError)
+    assert results[0].msg_body == "m1" and results[2].msg_body == "m3"
+    assert writer.stats()["fallbacks"] == 1
+    await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_close_flushes_pending():
+    repo = Repo()
+    writer = MessageWriter(unit_of_work, repo, max_latency=10)
+    pending = [asyncio.ensure_future(write(writer, n)) for n in range(3)]
+    await asyncio.sleep(0)
+    await asyncio.wait_for(writer.close(), 1)
+    assert all(task.done() and task.result() for task in pending)
+    with pytest.raises(UnavailableError):
+        await write(writer, 4)
+
+
+class Result:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class ShuffledSession:
+    """ ids from the sequence, then RETURNING rows in reverse order """
+
+    def __init__(self, id_list, message_list):
+        self.results = [Result(id_list), Result([
+            Message(id=message_id, created_at=datetime.now(), **values)
+            for message_id, values in reversed(list(zip(id_list, message_list)))
+        ])]
+
+    async def execute(self, stmt):
+        return self.results.pop(0)
+
+
+@pytest.mark.asyncio
+async def test_create_messages_ignores_returning_order():
+    message_list = [dict(creator_id=1, room_id=1, msg_type=1, msg_body=f"m{n}") for n in range(3)]
+    repo = UserRepo(ShuffledSession([7, 3, 5], message_list))
+    messages = await repo.create_messages(message_list)
+    assert [(message.id, message.msg_body) for message in messages] == [(7, "m0"), (3, "m1"), (5, "m2")]
+    assert await UserRepo(None).create_messages([]) == []
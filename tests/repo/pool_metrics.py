@@ -0,0 +1,28 @@
+import sqlite3
+
+import pytest
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.util import greenlet_spawn
+
+from src.application.containers import MeteredPool
+
+
+def checkout_twice(pool):
+    first = pool.connect()
+    try:
+        with pytest.raises(sa_exc.TimeoutError):
+            pool.connect()
+    finally:
+        first.close()
+    pool.connect().close()
+
+
+@pytest.mark.asyncio
+async def test_checkout_metrics():
+    pool = MeteredPool(lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=0, timeout=0.05)
+    await greenlet_spawn(checkout_twice, pool)
+    stats = pool.stats()
+    assert stats["checkouts"] == 3
+    assert stats["timeouts"] == 1
+    assert stats["max_wait_time"] >= 0.05
+    assert stats["checked_out"] == 0
@@ -0,0 +1,88 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+
+from src.core.entity.user import User
+from src.data.user.presence import PresenceStore
+
+
+NOW = datetime(2022, 5, 1, 12, 0, 0)
+
+
+@asynccontextmanager
+async def unit_of_work():
+    yield
+
+
+def user(user_id, online=False):
+    return User(id=user_id, email=f"{user_id}@test", password="", active=True, online=online,
+                last_activity=datetime(2022, 1, 1), created_at=datetime(2022, 1, 1))
+
+
+class Repo:
+    def __init__(self):
+        self.updates = []
+        self.commits = 0
+        self.fail = False
+
+    async def update_presence(self, presence_list):
+        if self.fail:
+            raise ConnectionError("db is down")
+        self.updates.append(sorted(presence_list))
+        return len(self.updates[-1])
+
+    async def commit(self):
+        self.commits += 1
+
+
+def test_overlay():
+    store = PresenceStore(unit_of_work, Repo())
+    store.set(1, True, NOW)
+    users = store.overlay([user(1), user(2)])
+    assert (users[0].online, users[0].last_activity) == (True, NOW)
+    assert users[1].online is False
+    assert store.get(2) is None
+
+
+@pytest.mark.asyncio
+async def test_flush_in_one_statement():
+    repo = Repo()
+    store = PresenceStore(unit_of_work, repo)
+    store.set(1, True, NOW)
+    store.set(2, True, NOW)
+    store.set(2, False, NOW)
+    assert await store.flush() == 2
+    assert repo.updates == [[(1, True, NOW), (2, False, NOW)]] and repo.commits == 1
+    # flushed offline users are served from the table again
+    assert store.get(2) is None and store.get(1) == (True, NOW)
+    assert await store.flush() == 0
+    assert store.stats() == {"users": 1, "dirty": 0, "flushes": 1, "flushed": 2, "failures": 0}
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_is_retried():
+    repo = Repo()
+    store = PresenceStore(unit_of_work, repo)
+    store.set(1, True, NOW)
+    repo.fail = True
+    with pytest.raises(ConnectionError):
+        await store.flush()
+    store.set(1, False, NOW)
+    repo.fail = False
+    await store.flush()
+    assert repo.updates == [[(1, False, NOW)]]
+
+
+@pytest.mark.asyncio
+async def test_periodic_flush_and_stop():
+    repo = Repo()
+    store = PresenceStore(unit_of_work, repo, flush_interval=0.01)
+    store.start()
+    store.set(1, True, NOW)
+    await asyncio.sleep(0.05)
+    assert repo.updates == [[(1, True, NOW)]]
+    store.set(1, False, NOW)
+    await store.stop()
+    assert repo.updates[-1] == [(1, False, NOW)]
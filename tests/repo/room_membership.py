@@ -0,0 +1,123 @@
+from datetime import datetime
+
+import pytest
+
+from src.core.entity.user import Room, Message
+from src.data.user.membership import RoomMembershipIndex
+from src.data.user.repo import UserRepo
+from src.application.adapters import message_data
+from src.application.handlers.websocket.command import MessageCommandHandler
+from src.application.ws.event import Command, CommandAction
+
+
+def room(room_id, members_id, deleted=False):
+    now = datetime.now()
+    return Room(id=room_id, creator_id=members_id[0], created_at=now, members_id=members_id,
+                deleted_at=now if deleted else None)
+
+
+def test_set_and_lookup():
+    index = RoomMembershipIndex()
+    assert index.members(1) is None
+    index.set_room(1, [1, 2])
+    index.set_room(2, [2, 3])
+    assert index.members(1) == {1, 2}
+    assert index.rooms(2) == {1, 2}
+    assert index.stats() == {"rooms": 2, "users": 3, "hits": 1, "misses": 1}
+
+
+def test_invalidate():
+    index = RoomMembershipIndex()
+    index.set_room(1, [1, 2])
+    index.set_room(2, [2, 3])
+    index.invalidate_room(1)
+    assert index.members(1) is None
+    assert index.rooms(1) == frozenset() and index.rooms(2) == {2}
+    index.update([room(2, [2, 3], deleted=True), room(3, [4])])
+    assert index.members(2) is None
+    assert index.rooms(3) == frozenset()
+    assert index.members(3) == {4}
+
+
+def test_lru_eviction():
+    index = RoomMembershipIndex(max_rooms=2)
+    index.set_room(1, [1])
+    index.set_room(2, [2])
+    index.members(1)
+    index.set_room(3, [3])
+    assert len(index) == 2
+    assert index.members(2) is None
+    assert index.rooms(2) == frozenset()
+
+
+class Repo:
+    RoomSearchSpec = UserRepo.RoomSearchSpec
+
+    def __init__(self, rooms):
+        self.rooms = {r.id: r for r in rooms}
+        self.room_reads = 0
+        self.messages = []
+
+    async def get_rooms(self, spec):
+        self.room_reads += 1
+        return [self.rooms[room_id] for room_id in spec.id_list if room_id in self.rooms]
+
+    async def create_message(self, creator_id, room_id, msg_type, msg_body):
+        message = Message(id=len(self.messages) + 1, room_id=room_id, creator_id=creator_id,
+                          msg_type=msg_type, msg_body=msg_body, created_at=datetime.now())
+        self.messages.append(message)
+        return message
+
+    async def commit(self):
+        pass
+
+
+class Session:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.sent = []
+
+    def send_json(self, data):
+        self.sent.append(data)
+
+
+def message(room_id):
+    return Command(resource="message", action=CommandAction.CREATE,
+                   payload={"room_id": room_id, "msg_type": 1, "msg_body": "hi"})
+
+
+@pytest.mark.asyncio
+async def test_send_reads_room_once():
+    repo = Repo([room(1, [1, 2])])
+    handler = MessageCommandHandler(user_repo=repo, friend_repo=None, membership=RoomMembershipIndex())
+    for _ in range(3):
+        broadcasts = await handler.create(message(1), Session(1))
+        assert sorted(broadcasts[0].receivers) == [1, 2]
+        assert broadcasts[0].event.result == [message_data(repo.messages[-1])]
+    assert repo.room_reads == 1
+    assert len(repo.messages) == 3
+
+
+@pytest.mark.asyncio
+async def test_send_rejects_non_member_and_unknown_room():
+    repo = Repo([room(1, [1, 2])])
+    handler = MessageCommandHandler(user_repo=repo, friend_repo=None, membership=RoomMembershipIndex())
+    session = Session(3)
+    assert await handler.create(message(1), session) == []
+    assert await handler.create(message(5), session) == []
+    assert [data["error"]["code"] for data in session.sent] == [3, 4]
+    assert repo.messages == []
+
+
+@pytest.mark.asyncio
+async def test_send_without_index_reads_room():
+    # several workers, membership changes of the others are not seen by an index
+    repo = Repo([room(1, [1, 2]), room(2, [1, 3], deleted=True)])
+    handler = MessageCommandHandler(user_repo=repo, friend_repo=None)
+    session = Session(1)
+    for _ in range(2):
+        broadcasts = await handler.create(message(1), session)
+        assert sorted(broadcasts[0].receivers) == [1, 2]
+    assert await handler.create(message(2), session) == []
+    assert repo.room_reads == 3
+    assert session.sent[-1]["error"]["code"] == 4
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.application.containers import Container
+from src.core.entity.user import Confirmation, User
+from src.core.usecase.auth import reset_pass_confirm
+from src.data.user import cache
+from src.data.user.cache import TokenCache
+from src.data.user.repo import ConfirmationSearchSpec
+
+
+def user(user_id):
+    now = datetime.now()
+    return User(id=user_id, email=f"{user_id}@test", password="", active=True, online=False,
+                last_activity=now, created_at=now)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_hit_and_miss():
+    tokens = TokenCache()
+    assert tokens.lookup("a") == (False, None)
+    tokens.set("a", user(1))
+    hit, cached = tokens.lookup("a")
+    assert hit and cached.id == 1
+    assert tokens.stats() == {"size": 1, "hits": 1, "negative_hits": 0, "misses": 1}
+
+
+def test_negative_and_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    tokens = TokenCache(ttl=60, negative_ttl=5)
+    tokens.set("unknown", None)
+    tokens.set("a", user(1))
+    assert tokens.lookup("unknown") == (True, None)
+    clock.now = 10
+    assert tokens.lookup("unknown") == (False, None)
+    assert tokens.lookup("a")[0]
+    clock.now = 61
+    assert tokens.lookup("a") == (False, None)
+    assert len(tokens) == 0
+
+
+def test_lru_eviction():
+    tokens = TokenCache(max_size=2)
+    tokens.set("a", user(1))
+    tokens.set("b", user(2))
+    tokens.lookup("a")
+    tokens.set("c", user(3))
+    assert tokens.lookup("b") == (False, None)
+    assert tokens.lookup("a")[0] and tokens.lookup("c")[0]
+
+
+def test_invalidate():
+    tokens = TokenCache()
+    tokens.set("phone", user(1))
+    tokens.set("laptop", user(1))
+    tokens.set("other", user(2))
+    tokens.invalidate("other")
+    assert tokens.lookup("other") == (False, None)
+    tokens.invalidate_user(1)
+    assert tokens.lookup("phone") == (False, None)
+    assert tokens.lookup("laptop") == (False, None)
+    assert len(tokens) == 0
+
+
+class ResetRepo:
+    ConfirmationSearchSpec = ConfirmationSearchSpec
+
+    def __init__(self, user_id, tokens):
+        now = datetime.now()
+        self.confirmation = Confirmation(id=1, user_id=user_id, code="c", type_="reset_password",
+                                         confirmed_at=None, created_at=now, expires_at=now + timedelta(days=1))
+        self.devices = {token: user_id for token in tokens}
+        self.committed = False
+
+    async def get_confirmations(self, spec):
+        return [self.confirmation]
+
+    async def update_confirmation(self, confirmation_id, data):
+        pass
+
+    async def update_user(self, user_id, data):
+        pass
+
+    async def delete_user_devices(self, user_id):
+        tokens = [token for token, owner in self.devices.items() if owner == user_id]
+        for token in tokens:
+            del self.devices[token]
+        return len(tokens)
+
+    async def commit(self):
+        self.committed = True
+
+
+@pytest.mark.asyncio
+async def test_password_reset_logs_out_devices():
+    tokens = TokenCache()
+    tokens.set("old", user(1))
+    repo = ResetRepo(1, ["old", "other"])
+    result = await reset_pass_confirm.UseCase(repo, token_cache=tokens).execute("c", "new password")
+    assert isinstance(result, reset_pass_confirm.SuccessResult)
+    assert repo.devices == {} and repo.committed
+    assert tokens.lookup("old") == (False, None)
+
+
+@pytest.mark.parametrize("bus, enabled", [("local", True), ("unix", False)])
+def test_cache_only_with_local_bus(bus, enabled):
+    container = Container()
+    container.config.from_dict(dict(ws_bus=bus, auth_cache_size=10, auth_cache_ttl=1, auth_cache_negative_ttl=1))
+    assert isinstance(container.token_cache(), TokenCache) is enabled
@@ -1,4 +1,5 @@
 import asyncio
+from datetime import datetime, timedelta
 from functools import wraps
 
 from src.application.db import metadata
@@ -40,16 +41,72 @@ async def test_create_user(di):
 @test
 async def test_create_user_device(di):
     repo = await di.user_repo()
-    device_id = await repo.create_device(user_id=conf.USER_ID,
-                                         name=conf.DEVICE_NAME,
-                                         info=conf.DEVICE_INFO,
-                                         token=conf.DEVICE_TOKEN)
-    assert isinstance(device_id, int)
+    device = await repo.create_device(user_id=conf.USER_ID,
+                                      name=conf.DEVICE_NAME,
+                                      info=conf.DEVICE_INFO,
+                                      token=conf.DEVICE_TOKEN)
+    assert isinstance(device.id, int)
+    assert device.token == conf.DEVICE_TOKEN
     device_list = await repo.get_devices(DeviceSearchSpec(user_id=conf.USER_ID))
     print(device_list)
     print("hello world")
 
 
+@test
+async def test_delete_user_devices(di):
+    repo = await di.user_repo()
+    user_id = await repo.create_user("devices", "asd")
+    for n in range(2):
+        await repo.create_device(user_id=user_id, name=f"d{n}", info={}, token=f"devices-{n}")
+    assert await repo.delete_user_devices(user_id) == 2
+    await repo.commit()
+    assert await repo.get_devices(DeviceSearchSpec(token="devices-0")) == []
+    assert await repo.get_devices(DeviceSearchSpec(token=conf.DEVICE_TOKEN))
+
+
+@test
+async def test_update_presence(di):
+    repo = await di.user_repo()
+    other_id = await repo.create_user("presence", "asd")
+    last_activity = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+    updated = await repo.update_presence([(conf.USER_ID, True, last_activity), (other_id, False, last_activity)])
+    assert updated == 2
+    await repo.commit()
+    user_list = await repo.get_users(UserSearchSpec(id_list=[conf.USER_ID, other_id]))
+    presence = {user.id: (user.online, user.last_activity) for user in user_list}
+    assert presence == {conf.USER_ID: (True, last_activity), other_id: (False, last_activity)}
+    # offline flushed late by another worker
+    assert await repo.update_presence([(conf.USER_ID, False, last_activity - timedelta(seconds=1))]) == 0
+    assert await repo.update_presence([]) == 0
+
+
+@test
+async def test_create_messages(di):
+    repo = await di.user_repo()
+    room = await repo.create_room(conf.USER_ID, [conf.USER_ID])
+    message_list = [dict(creator_id=conf.USER_ID, room_id=room.id, msg_type=1, msg_body=f"m{n}") for n in range(5)]
+    messages = await repo.create_messages(message_list)
+    await repo.commit()
+    assert [message.msg_body for message in messages] == [f"m{n}" for n in range(5)]
+    assert len({message.id for message in messages}) == 5
+
+
+@test
+async def test_get_message_changes_page(di):
+    repo = await di.user_repo()
+    room = await repo.create_room(conf.USER_ID, [conf.USER_ID])
+    messages = await repo.create_messages([dict(creator_id=conf.USER_ID, room_id=room.id, msg_type=1,
+                                                msg_body=f"c{n}") for n in range(5)])
+    await repo.commit()
+    # one transaction, the same updated_at for all rows
+    spec = UserRepo.MessageSearchSpec(room_id=room.id, updated_since=messages[0].updated_at, changes_limit=3)
+    first = await repo.get_messages(spec)
+    assert [message.id for message in first] == [message.id for message in messages[:3]]
+    spec.changed_after = (first[-1].updated_at, first[-1].id)
+    rest = await repo.get_messages(spec)
+    assert [message.id for message in rest] == [message.id for message in messages[3:]]
+
+
 async def main():
 
     di = Container()
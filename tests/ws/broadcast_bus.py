@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from src.application.codec import JsonCodec
+from src.application.ws.base import Frame, Priority
+from src.application.ws.bus import LocalBroadcastBus, UnixSocketBroadcastBus
+
+
+class Collector:
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, receivers, frame, priority):
+        self.messages.append((receivers, frame.encode(JsonCodec()), priority))
+
+
+@pytest.mark.asyncio
+async def test_local_bus():
+    bus = LocalBroadcastBus()
+    first, second = Collector(), Collector()
+    bus.subscribe(first)
+    bus.subscribe(second)
+    await bus.publish([1, 2], Frame({"a": 1}), Priority.LOW)
+    assert first.messages == second.messages == [([1, 2], '{"a": 1}', Priority.LOW)]
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    workers = [UnixSocketBroadcastBus(path, reconnect_delay=0.01) for _ in range(3)]
+    collectors = [Collector() for _ in workers]
+    for bus, collector in zip(workers, collectors):
+        bus.subscribe(collector)
+        await bus.start()
+    for bus in workers:
+        await bus.wait_connected(timeout=1)
+    assert sum(bus.is_broker for bus in workers) == 1
+
+    await workers[1].publish([7], Frame({"a": 1}))
+    await asyncio.sleep(0.05)
+    for collector in collectors:
+        assert collector.messages == [([7], '{"a": 1}', Priority.NORMAL)]
+
+    # broker worker dies, others re-elect and keep working
+    broker = next(bus for bus in workers if bus.is_broker)
+    await broker.close()
+    alive = [bus for bus in workers if bus is not broker]
+    await asyncio.sleep(0.1)
+    for bus in alive:
+        await bus.wait_connected(timeout=1)
+    await alive[0].publish([8], Frame({"b": 2}))
+    await asyncio.sleep(0.05)
+    assert collectors[workers.index(alive[1])].messages[-1] == ([8], '{"b": 2}', Priority.NORMAL)
+
+    for bus in alive:
+        await bus.close()
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_control(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    workers = [UnixSocketBroadcastBus(path, reconnect_delay=0.01) for _ in range(2)]
+    frames, controls = Collector(), [[], []]
+    for bus, received in zip(workers, controls):
+        bus.subscribe(frames)
+        bus.subscribe_control(received.append)
+        await bus.start()
+    try:
+        for bus in workers:
+            await bus.wait_connected(timeout=1)
+        workers[0].publish_control({"w": "a", "on": [1]})
+        await asyncio.sleep(0.05)
+        # control messages reach the control handlers of the other workers only
+        assert controls == [[], [{"w": "a", "on": [1]}]]
+        assert frames.messages == []
+    finally:
+        for bus in workers:
+            await bus.close()
@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytest
+
+from src.application.handlers.websocket.query import MessageQueryHandler
+from src.application.ws.cursor import OVERLAP, Cursor, Position, split_changes
+from src.application.ws.event import Query
+from src.core.entity.user import Message
+from src.data.user.repo import UserRepo
+from src.core.exceptions.base import ValidationError
+
+
+NOW = datetime(2022, 5, 1, 12, 0, 0)
+
+
+@dataclass
+class Item:
+    id: int
+    created_at: datetime
+    updated_at: datetime
+    deleted_at: Optional[datetime] = None
+
+
+def test_encode_decode():
+    cursor = Cursor(updated_at=NOW, graph_time=1651406400000)
+    token = cursor.encode()
+    assert isinstance(token, str)
+    assert Cursor.decode(token) == cursor
+    assert Cursor().encode() is None
+    assert Cursor.decode(None) == Cursor()
+
+
+@pytest.mark.parametrize("token", ["", "not a cursor", "e30", 1])
+def test_decode_invalid(token):
+    with pytest.raises(ValidationError):
+        Cursor.decode(token)
+
+
+def test_since_overlap():
+    cursor = Cursor(updated_at=NOW, graph_time=10_000)
+    assert cursor.since == NOW - OVERLAP
+    assert cursor.graph_since == 10_000 - OVERLAP.total_seconds() * 1000
+    assert Cursor().since is None
+    assert Cursor().graph_since == 0
+
+
+def test_page_continues_without_overlap():
+    items = [Item(i, NOW, NOW) for i in range(1, 5)]
+    cursor = Cursor(updated_at=NOW - timedelta(hours=1))
+    page, has_more, following = cursor.page(items, 3)
+    assert [item.id for item in page] == [1, 2, 3] and has_more
+    assert following.since == NOW and following.changed_after == (NOW, 3)
+    assert Cursor.decode(following.encode()) == following
+    # the last page brings the overlap back
+    page, has_more, last = following.page(items[3:], 3)
+    assert not has_more and last.after_id is None and last.since == NOW - OVERLAP
+
+
+def test_advance_keeps_max():
+    cursor = Cursor(updated_at=NOW)
+    items = [Item(1, NOW, NOW - timedelta(minutes=1)), Item(2, NOW, NOW + timedelta(minutes=1))]
+    assert cursor.advance(items).updated_at == NOW + timedelta(minutes=1)
+    assert cursor.advance(items[:1]) is cursor
+    assert cursor.advance([], [5]).graph_time == 5
+
+
+def test_split_changes():
+    since = NOW - timedelta(minutes=5)
+    items = [
+        Item(1, NOW, NOW),
+        Item(2, NOW - timedelta(days=1), NOW),
+        Item(3, NOW - timedelta(days=1), NOW, deleted_at=NOW),
+    ]
+    created, updated, removed = split_changes(items, since)
+    assert [item.id for item in created] == [1]
+    assert [item.id for item in updated] == [2]
+    assert removed == [3]
+
+
+def test_position_encode_decode():
+    position = Position(created_at=NOW, id=7)
+    assert Position.decode(position.encode()) == position
+    assert Position.decode(None) is None
+    with pytest.raises(ValidationError):
+        Position.decode("e30", "before")
+
+
+class MessageRepo:
+    """ keyset semantics of UserRepo.get_messages over a list """
+    MessageSearchSpec = UserRepo.MessageSearchSpec
+
+    def __init__(self, n):
+        # equal created_at for pairs, id breaks the tie
+        self.messages = [Message(id=i, room_id=1, creator_id=1, msg_type=1, msg_body="hi",
+                                 created_at=NOW + timedelta(seconds=i // 2), updated_at=NOW)
+                         for i in range(1, n + 1)]
+
+    async def get_messages(self, spec):
+        if spec.changes_limit is not None:
+            items = sorted(self.messages, key=lambda item: (item.updated_at, item.id))
+            if spec.updated_since:
+                items = [item for item in items if item.updated_at >= spec.updated_since]
+            if spec.changed_after:
+                items = [item for item in items if (item.updated_at, item.id) > spec.changed_after]
+            return items[:spec.changes_limit]
+        items = sorted(self.messages, key=lambda item: (item.created_at, item.id))
+        if spec.before:
+            items = [item for item in items if (item.created_at, item.id) < spec.before]
+        if spec.after:
+            items = [item for item in items if (item.created_at, item.id) > spec.after]
+        if spec.limit is not None:
+            items = items[:spec.limit] if spec.after else items[-spec.limit:]
+        return items
+
+
+class Session:
+    def __init__(self):
+        self.sent = []
+
+    def send_json(self, data):
+        self.sent.append(data)
+
+
+async def page(handler, **payload):
+    session = Session()
+    await handler.handle(Query(resource="message", payload=dict(room_id=1, **payload)), session)
+    return session.sent[-1]
+
+
+@pytest.mark.asyncio
+async def test_message_history_pages():
+    handler = MessageQueryHandler(MessageRepo(25), page_size=10)
+    latest = await page(handler)
+    assert [item["id"] for item in latest["response"]] == list(range(16, 26))
+    assert latest["has_more"]
+
+    ids, data = [], latest
+    while data["has_more"]:
+        data = await page(handler, before=data["before"], limit=8)
+        ids = [item["id"] for item in data["response"]] + ids
+    assert ids == list(range(1, 16))
+
+    newer = await page(handler, after=Position(created_at=NOW, id=1).encode(), limit=100)
+    assert [item["id"] for item in newer["response"]][:3] == [2, 3, 4]
+    assert len(newer["response"]) == 10 and newer["has_more"]
+    last = await page(handler, after=latest["after"])
+    assert last["response"] == [] and not last["has_more"] and last["after"] is None
+
+
+@pytest.mark.asyncio
+async def test_message_history_invalid_limit():
+    handler = MessageQueryHandler(MessageRepo(1))
+    with pytest.raises(ValidationError):
+        await page(handler, limit=0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("room_id", [0, -1, "1", [1], True, 1.5])
+async def test_message_invalid_room_id(room_id):
+    handler = MessageQueryHandler(MessageRepo(1))
+    session = Session()
+    with pytest.raises(ValidationError):
+        await handler.handle(Query(resource="message", payload={"room_id": room_id}), session)
+    assert session.sent == []
+
+
+@pytest.mark.asyncio
+async def test_message_changes_pages():
+    repo = MessageRepo(25)
+    # all changes in one second, the overlap alone would repeat the first page forever
+    for message in repo.messages:
+        message.updated_at = NOW + timedelta(hours=1)
+    handler = MessageQueryHandler(repo, page_size=10)
+    ids, data = [], {"cursor": None}
+    for _ in range(5):
+        data = await page(handler, cursor=data["cursor"])
+        ids += [item["id"] for item in data["response"]["created"] + data["response"]["updated"]]
+        if not data["has_more"]:
+            break
+    assert ids == list(range(1, 26))
+    assert not data["has_more"]
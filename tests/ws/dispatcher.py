@@ -0,0 +1,101 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from src.application.ws.adapters import CommandAction
+from src.application.ws.dispatcher import EventDispatcher
+from src.application.ws.event import Command, Query
+from src.application.ws.server import WebSocketServer
+
+
+def message(room_id, uid):
+    return Command(resource="message", action=CommandAction.CREATE, payload={"room_id": room_id}, uid=uid)
+
+
+class Recorder:
+    def __init__(self, delays=None):
+        self.delays = delays or {}
+        self.done = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, event):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delays.get(event.uid, 0))
+        self.running -= 1
+        self.done.append(event.uid)
+
+
+@pytest.mark.asyncio
+async def test_slow_query_does_not_block_command():
+    recorder = Recorder(delays={"history": 0.05})
+    dispatcher = EventDispatcher(recorder)
+    await dispatcher.submit(Query(resource="message", payload={"room_id": 1}, uid="history"))
+    await dispatcher.submit(message(1, "send"))
+    await dispatcher.join()
+    assert recorder.done == ["send", "history"]
+
+
+@pytest.mark.asyncio
+async def test_commands_on_same_room_are_ordered():
+    recorder = Recorder(delays={"a1": 0.03, "b1": 0.01})
+    dispatcher = EventDispatcher(recorder)
+    for event in (message(1, "a1"), message(2, "b1"), message(1, "a2"), message(2, "b2")):
+        await dispatcher.submit(event)
+    await dispatcher.join()
+    assert recorder.done.index("a1") < recorder.done.index("a2")
+    assert recorder.done.index("b1") < recorder.done.index("b2")
+    assert recorder.done.index("b2") < recorder.done.index("a2")
+
+
+@pytest.mark.asyncio
+async def test_in_flight_limit():
+    recorder = Recorder(delays={str(n): 0.01 for n in range(10)})
+    dispatcher = EventDispatcher(recorder, max_in_flight=3)
+    for n in range(10):
+        await dispatcher.submit(Query(resource="user", payload={}, uid=str(n)))
+        assert dispatcher.in_flight <= 3
+    await dispatcher.join()
+    assert recorder.max_running == 3
+    assert len(recorder.done) == 10
+
+
+@pytest.mark.asyncio
+async def test_join_waits_for_spawned():
+    recorder = Recorder(delays={"1": 0.02})
+    dispatcher = EventDispatcher(recorder)
+    task = await dispatcher.submit(Query(resource="user", payload={}, uid="1"))
+    done = []
+
+    async def after():
+        await asyncio.wait([task])
+        done.append(recorder.done[:])
+
+    dispatcher.spawn(after())
+    await dispatcher.join()
+    assert done == [["1"]]
+
+
+def test_concurrent_events_need_unit_of_work():
+    @asynccontextmanager
+    async def unit_of_work():
+        yield
+
+    assert WebSocketServer(user_repo=None, ws_connection_repo={}, max_in_flight=8).max_in_flight == 1
+    assert WebSocketServer(user_repo=None, ws_connection_repo={}, max_in_flight=8,
+                           unit_of_work=unit_of_work).max_in_flight == 8
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("room_id", [[1], {"id": 1}, "1", True])
+async def test_unhashable_room_id_is_dispatched(room_id):
+    recorder = Recorder()
+    dispatcher = EventDispatcher(recorder, max_in_flight=1)
+    assert dispatcher.order_key(message(room_id, "bad")) == ("message", None)
+    for uid in ("bad", "next"):
+        await dispatcher.submit(message(room_id if uid == "bad" else 1, uid))
+    await dispatcher.join()
+    assert recorder.done == ["bad", "next"]
+    assert dispatcher.in_flight == 0
@@ -0,0 +1,133 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from src.application.handlers.websocket.connection import OnConnectHandler, OnDisconnectHandler
+from src.application.ws.base import WsClient
+from src.application.ws.server import WebSocketServer, no_unit_of_work
+from src.core.entity.user import User
+from src.data.user.presence import PresenceStore
+from src.data.user.repo import UserSearchSpec
+
+
+class FakeSession:
+    def __init__(self, user_id, close_delay=0.0):
+        self.user_id = user_id
+        self.close_delay = close_delay
+        self.frames = []
+        self.closed = False
+        self.aborted = False
+
+    def send_frame(self, frame, priority):
+        self.frames.append(frame.data)
+
+    async def flush(self):
+        pass
+
+    async def close(self, code, message):
+        await asyncio.sleep(self.close_delay)
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+def server_with(sessions, **kwargs):
+    server = WebSocketServer(user_repo=None, ws_connection_repo={}, **kwargs)
+    for session in sessions:
+        server.ws_clients.setdefault(session.user_id, WsClient(session.user_id)).add(session)
+    return server
+
+
+@pytest.mark.asyncio
+async def test_drain_sends_reconnect_and_closes():
+    sessions = [FakeSession(user_id) for user_id in range(20)]
+    server = server_with(sessions, drain_concurrency=4, reconnect_delay=2)
+    stats = await server.drain()
+    assert server.draining
+    assert stats["sessions"] == 20 and stats["forced"] == 0
+    for session in sessions:
+        assert session.closed
+        assert session.frames[0]["type"] == "reconnect"
+        assert 0 <= session.frames[0]["delay"] <= 2
+
+
+@pytest.mark.asyncio
+async def test_drain_is_concurrent_and_aborts_stragglers():
+    sessions = [FakeSession(user_id, close_delay=0.05) for user_id in range(10)]
+    straggler = FakeSession(100, close_delay=10)
+    server = server_with(sessions + [straggler], drain_timeout=0.2)
+    stats = await server.drain()
+    assert stats["forced"] == 1
+    assert stats["time"] < 1
+    assert straggler.aborted and not straggler.closed
+    assert all(session.closed and not session.aborted for session in sessions)
+
+
+class FakeUserRepo:
+    UserSearchSpec = UserSearchSpec
+
+    def __init__(self):
+        self.presence = {}
+
+    async def get_users(self, spec):
+        user_id = int(spec.token)
+        return [User(id=user_id, email=f"{user_id}@test", password="", active=True, online=False,
+                     last_activity=datetime.now(), created_at=datetime.now())]
+
+    async def update_presence(self, presence_list):
+        for user_id, online, _ in presence_list:
+            self.presence[user_id] = online
+
+    async def commit(self):
+        pass
+
+
+class FakeFriendRepo:
+    async def get_friends_id(self, user_id):
+        return []
+
+
+@pytest.mark.asyncio
+async def test_shutdown_persists_offline_presence():
+    user_repo = FakeUserRepo()
+    store = PresenceStore(no_unit_of_work, user_repo, flush_interval=60)
+    server = WebSocketServer(user_repo=user_repo, ws_connection_repo={}, presence_grace=60, drain_timeout=2)
+    server.connect_handler = OnConnectHandler(FakeFriendRepo(), user_repo, server.ws_clients, store)
+    server.disconnect_handler = OnDisconnectHandler(FakeFriendRepo(), user_repo, server.ws_clients, store)
+    started = asyncio.Event()
+
+    async def slow_query(query, session):
+        started.set()
+        await asyncio.sleep(0.2)
+
+    # handle() of the session with a query in flight returns after the drain
+    server.register_query_handlers([("user", slow_query)])
+    app = web.Application()
+    app.router.add_get("/ws", server.handle)
+
+    async with TestClient(TestServer(app)) as http:
+        connections = [await http.ws_connect(f"/ws?sid={user_id}") for user_id in range(1, 6)]
+
+        async def read(ws):
+            async for _ in ws:
+                pass
+
+        readers = [asyncio.ensure_future(read(ws)) for ws in connections]
+        while store.stats()["dirty"] < 5:
+            await asyncio.sleep(0.01)
+        await store.flush()
+        assert user_repo.presence == {user_id: True for user_id in range(1, 6)}
+        await connections[0].send_json({"type": "query", "resource": "user"})
+        await started.wait()
+
+        # the same order as on_shutdown of the app
+        await server.shutdown()
+        await store.stop()
+        await asyncio.gather(*readers)
+
+    assert user_repo.presence == {user_id: False for user_id in range(1, 6)}
+    assert store.stats()["users"] == 0
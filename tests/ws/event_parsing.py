@@ -0,0 +1,58 @@
+import pytest
+from marshmallow import ValidationError
+
+from src.core.exceptions.base import ValidationError as DomainValidationError
+from src.application.ws.adapters import QuerySchema, CommandSchema, CommandAction
+from src.application.ws.event import Query, Command, event_from_dict
+
+
+CASES = [
+    {},
+    {"resource": 1},
+    {"resource": None},
+    {"resource": "room", "payload": 1},
+    {"resource": "room", "payload": None},
+    {"resource": "room", "uid": 5},
+    {"resource": "room", "x": 1, "y": 2},
+    {"resource": "room", "payload": {"id": 1}, "uid": "u"},
+    {"resource": "room", "payload": {}, "action": 1},
+    {"resource": "room", "payload": {}, "action": "update"},
+    [1],
+]
+
+
+def schema_load(schema, data):
+    try:
+        return schema.load(data)
+    except ValidationError as err:
+        return err.normalized_messages()
+
+
+def compiled_load(event_cls, data):
+    try:
+        return event_cls._decode(data)
+    except DomainValidationError as err:
+        return err.args[0]
+
+
+@pytest.mark.parametrize("data", CASES)
+@pytest.mark.parametrize("schema, event_cls", [(QuerySchema(), Query), (CommandSchema(), Command)])
+def test_same_result_as_schema(schema, event_cls, data):
+    assert compiled_load(event_cls, data) == schema_load(schema, data)
+
+
+def test_same_dump_as_schema():
+    query = Query(resource="room", payload={"id": 1}, uid="u")
+    command = Command(resource="room", action=CommandAction.CREATE, payload={"members_id": [1]})
+    assert query.to_dict() == QuerySchema().dump(query)
+    assert command.to_dict() == CommandSchema().dump(command)
+
+
+def test_invalid_action():
+    with pytest.raises(DomainValidationError, match="'bogus' is not a valid CommandAction"):
+        event_from_dict({"type": "command", "resource": "room", "payload": {}, "action": "bogus"})
+
+
+def test_invalid_type():
+    with pytest.raises(DomainValidationError, match="Invalid type event"):
+        event_from_dict({"type": "event", "resource": "room"})
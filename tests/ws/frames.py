@@ -0,0 +1,63 @@
+import pytest
+from aiohttp import WSMessage, WSMsgType
+
+from src.application.codec import JsonCodec, MsgpackCodec, OrjsonCodec
+from src.application.ws.base import WsClient
+from src.application.ws.server import WebSocketServer
+from src.core.exceptions.base import ValidationError
+
+
+class FakeWs:
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for msg_type, data in self.messages:
+            yield WSMessage(msg_type, data, None)
+
+
+class FakeSession:
+    user_id = 1
+    bucket = None
+
+    def __init__(self, messages):
+        self.ws = FakeWs(messages)
+        self.sent = []
+
+    def send_json(self, data):
+        self.sent.append(data)
+
+
+async def receive(server, messages):
+    """ responses of the server to the frames of one session """
+    session = FakeSession(messages)
+    server.rate_limiter.attach(session, server.ws_clients.setdefault(session.user_id, WsClient(session.user_id)))
+
+    async def echo(query, session):
+        session.send_json({"response": query.payload})
+
+    server.register_query_handlers([("user", echo)])
+    await server.handle_websocket(session)
+    return session.sent
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec, msg_type, data", [
+    (JsonCodec(), WSMsgType.TEXT, '{"type": "query", '),
+    (JsonCodec(), WSMsgType.TEXT, '[' * 100000),
+    (OrjsonCodec(), WSMsgType.TEXT, '{"type": "query"}}'),
+    # binary frames are decoded by the msgpack codec
+    (None, WSMsgType.BINARY, b'\xc1'),
+    (None, WSMsgType.BINARY, b'\x81\xa1a\x01\x02'),
+    (None, WSMsgType.BINARY, b'\x81\x91\x01\x02'),
+])
+async def test_malformed_frame_keeps_session(codec, msg_type, data):
+    server = WebSocketServer(user_repo=None, ws_connection_repo={}, codec=codec)
+    assert isinstance(server.binary_codec, MsgpackCodec)
+    valid = '{"type": "query", "resource": "user", "payload": {"id": 1}}'
+    sent = await receive(server, [(msg_type, data), (WSMsgType.TEXT, valid)])
+    assert sent[0]["error"] == {"message": "Malformed frame", "code": ValidationError.code}
+    assert sent[1] == {"response": {"id": 1}}
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from src.application.ws.liveness import LivenessMonitor, TimingWheel
+
+
+class FakeWs:
+    def __init__(self):
+        self.pings = 0
+        self.closed = None
+
+    async def ping(self):
+        self.pings += 1
+
+
+class FakeSession:
+    def __init__(self):
+        self.ws = FakeWs()
+        self.last_seen = 0.0
+
+    async def close(self, code, message):
+        self.ws.closed = message
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(monitor, clock, seconds):
+    for _ in range(int(seconds / monitor._wheel.tick)):
+        clock.now += monitor._wheel.tick
+        monitor.tick()
+
+
+def test_wheel_expiry():
+    wheel = TimingWheel(tick=1, span=5)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 3)
+    wheel.schedule("a", 4)
+    assert wheel.advance() == set()
+    assert wheel.advance() == set()
+    assert wheel.advance() == {"b"}
+    assert wheel.advance() == {"a"}
+    assert len(wheel) == 0
+
+
+def test_wheel_cancel():
+    wheel = TimingWheel(tick=1, span=2)
+    wheel.schedule("a", 1)
+    wheel.cancel("a")
+    assert wheel.advance() == set()
+
+
+@pytest.mark.asyncio
+async def test_active_session_is_not_pinged():
+    clock = Clock()
+    monitor = LivenessMonitor(ping_interval=3, ping_timeout=2)
+    monitor._now = clock
+    session = FakeSession()
+    monitor.add(session)
+    for _ in range(10):
+        run(monitor, clock, 1)
+        monitor.touch(session)
+    await asyncio.sleep(0)
+    assert session.ws.pings == 0
+    assert monitor.stats() == {"tracked": 1, "pings": 0, "reaped": 0}
+
+
+@pytest.mark.asyncio
+async def test_answered_ping_keeps_session():
+    clock = Clock()
+    monitor = LivenessMonitor(ping_interval=3, ping_timeout=3)
+    monitor._now = clock
+    session = FakeSession()
+    monitor.add(session)
+    run(monitor, clock, 3)
+    await asyncio.sleep(0)
+    assert session.ws.pings == 1
+    # pong
+    monitor.touch(session)
+    run(monitor, clock, 3)
+    await asyncio.sleep(0)
+    assert session.ws.closed is None
+    assert monitor.reaped == 0
+
+
+@pytest.mark.asyncio
+async def test_unresponsive_session_is_reaped():
+    clock = Clock()
+    monitor = LivenessMonitor(ping_interval=3, ping_timeout=2)
+    monitor._now = clock
+    session = FakeSession()
+    monitor.add(session)
+    run(monitor, clock, 5)
+    await asyncio.sleep(0)
+    assert session.ws.pings == 1
+    assert session.ws.closed == b'Ping timeout'
+    assert monitor.stats() == {"tracked": 0, "pings": 1, "reaped": 1}
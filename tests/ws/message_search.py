@@ -0,0 +1,98 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from src.application.adapters import MESSAGE_FIELDS
+from src.application.handlers.websocket.query import MessageSearchQueryHandler
+from src.application.ws.event import Query
+from src.core.entity.user import Message, MessageMatch
+from src.core.exceptions.base import ValidationError
+from src.data.user import repo as repo_module
+from src.data.user.repo import UserRepo
+
+
+def match(message_id):
+    message = Message(id=message_id, room_id=1, creator_id=1, msg_type=1, msg_body="hello world",
+                      created_at=datetime(2022, 5, 1))
+    return MessageMatch(message=message, rank=1.0 / message_id, snippet="\x02hello\x03 world")
+
+
+class Repo:
+    MessageTextSearchSpec = UserRepo.MessageTextSearchSpec
+
+    def __init__(self, n):
+        self.matches = [match(i) for i in range(1, n + 1)]
+        self.specs = []
+
+    async def search_messages(self, spec):
+        self.specs.append(spec)
+        return self.matches[spec.offset:spec.offset + spec.limit]
+
+
+class Session:
+    user_id = 7
+
+    def __init__(self):
+        self.sent = []
+
+    def send_json(self, data):
+        self.sent.append(data)
+
+
+async def search(handler, **payload):
+    session = Session()
+    await handler.handle(Query(resource="message_search", payload=payload), session)
+    return session.sent[-1]
+
+
+@pytest.mark.asyncio
+async def test_search_pages():
+    repo = Repo(25)
+    handler = MessageSearchQueryHandler(repo, page_size=10)
+    first = await search(handler, q="hello")
+    assert [m["message"]["id"] for m in first["response"]] == list(range(1, 11))
+    assert set(first["response"][0]["message"]) == set(MESSAGE_FIELDS)
+    assert first["has_more"] and first["offset"] == 10
+    assert repo.specs[-1].member_id == 7 and repo.specs[-1].limit == 11
+    last = await search(handler, q="hello", offset=20, limit=50)
+    assert len(last["response"]) == 5 and not last["has_more"] and last["offset"] is None
+    assert repo.specs[-1].room_id is None
+    await search(handler, q="hello", room_id=3)
+    assert repo.specs[-1].room_id == 3
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("payload", [dict(q="hello", offset=-1), dict(q="hello", limit="5"),
+                                     dict(q="hello", offset=5000), dict(q="hello", room_id="1 OR 1=1"),
+                                     dict(q="hello", room_id=[1]), dict(q="hello", room_id=0)])
+async def test_search_invalid(payload):
+    with pytest.raises(ValidationError):
+        await search(MessageSearchQueryHandler(Repo(1)), **payload)
+
+
+@pytest.mark.asyncio
+async def test_search_requires_text():
+    data = await search(MessageSearchQueryHandler(Repo(1)), q="  ")
+    assert data["error"]["code"] == ValidationError.code
+
+
+class StatementSession:
+    async def execute(self, stmt):
+        self.sql = str(stmt.compile(dialect=postgresql.dialect()))
+        return []
+
+
+@pytest.mark.asyncio
+async def test_search_sql_uses_index_and_membership():
+    session = StatementSession()
+    await UserRepo(session).search_messages(UserRepo.MessageTextSearchSpec(text="hello", member_id=7))
+    assert "message.msg_tsv @@ websearch_to_tsquery('simple'::regconfig" in session.sql
+    assert "room_member.user_id = %(user_id_1)s" in session.sql
+    assert "ts_headline('simple'::regconfig, translate(message.msg_body" in session.sql
+
+
+def test_snippet_markers_are_not_html():
+    options = repo_module.HEADLINE_OPTIONS
+    assert "<" not in options and ">" not in options
+    assert f"StartSel={repo_module.HIGHLIGHT_START}" in options
@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from src.application.ws.base import WsClient
+from src.application.ws.presence import PresenceManager, connected_only
+
+
+class OfflineRecorder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, user_id):
+        async def on_offline():
+            self.calls.append(user_id)
+        return on_offline
+
+
+@pytest.mark.asyncio
+async def test_first_connect_is_transition():
+    presence = PresenceManager(grace=0.01)
+    assert await presence.connect(1)
+    # second session of the same user
+    assert not await presence.connect(1)
+    assert presence.is_online(1)
+
+
+@pytest.mark.asyncio
+async def test_reconnect_within_grace_is_suppressed():
+    recorder = OfflineRecorder()
+    presence = PresenceManager(grace=0.05)
+    await presence.connect(1)
+    presence.disconnect(1, recorder(1))
+    await asyncio.sleep(0.01)
+    assert not await presence.connect(1)
+    await asyncio.sleep(0.08)
+    assert recorder.calls == []
+    assert presence.is_online(1)
+    assert presence.suppressed == 1
+
+
+@pytest.mark.asyncio
+async def test_offline_after_grace():
+    recorder = OfflineRecorder()
+    presence = PresenceManager(grace=0.01)
+    await presence.connect(1)
+    presence.disconnect(1, recorder(1))
+    # duplicate disconnect doesn't schedule the second transition
+    presence.disconnect(1, recorder(1))
+    await asyncio.sleep(0.05)
+    assert recorder.calls == [1]
+    assert not presence.is_online(1)
+    assert await presence.connect(1)
+
+
+@pytest.mark.asyncio
+async def test_flush_fires_pending():
+    recorder = OfflineRecorder()
+    presence = PresenceManager(grace=60)
+    for user_id in (1, 2):
+        await presence.connect(user_id)
+        presence.disconnect(user_id, recorder(user_id))
+    await presence.flush()
+    assert sorted(recorder.calls) == [1, 2]
+    assert presence.stats()["pending_offline"] == 0
+
+
+def test_connected_only():
+    online, offline = WsClient(user_id=1), WsClient(user_id=2)
+    # session_list is a WeakSet, keep the reference
+    session = type("Session", (), {})()
+    online.add(session)
+    clients = {1: online, 2: offline}
+    assert connected_only([1, 2, 3], clients) == [1]
+
+
+def workers(*grace):
+    """ Presence managers of workers exchanging control messages directly """
+    managers = [PresenceManager(grace=value, sync_interval=0.02) for value in grace]
+    for manager in managers:
+        others = [other for other in managers if other is not manager]
+        manager.publish = lambda message, others=others: [other.on_remote(message) for other in others]
+    return managers
+
+
+@pytest.mark.asyncio
+async def test_offline_waits_for_other_worker():
+    recorder = OfflineRecorder()
+    first, second = workers(0.01, 0.01)
+    assert await first.connect(1)
+    assert await second.connect(1)
+    assert second.online_elsewhere(1)
+    left = []
+    first.disconnect(1, recorder(1), on_leave=lambda: left.append(1))
+    await asyncio.sleep(0.03)
+    # the worker leaves the user but the user is still online in the second one
+    assert left == [1] and recorder.calls == []
+    assert first.stats()["deferred_offline"] == 1
+    assert not second.online_elsewhere(1)
+    second.disconnect(1, recorder(1))
+    await asyncio.sleep(0.03)
+    # reported once, by the worker the user left last
+    assert recorder.calls == [1]
+    assert first.stats()["deferred_offline"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reconnect_cancels_deferred_offline():
+    recorder = OfflineRecorder()
+    first, second = workers(0.01, 0.01)
+    await first.connect(1)
+    await second.connect(1)
+    first.disconnect(1, recorder(1))
+    await asyncio.sleep(0.03)
+    await first.connect(1)
+    assert first.stats()["deferred_offline"] == 0
+    second.disconnect(1, recorder(1))
+    await asyncio.sleep(0.03)
+    assert recorder.calls == []
+
+
+@pytest.mark.asyncio
+async def test_snapshot_releases_lost_offline():
+    recorder = OfflineRecorder()
+    first = PresenceManager(grace=0.01)
+    first.publish = lambda message: None
+    first.on_remote({"w": "other", "on": [1, 2]})
+    await first.connect(1)
+    first.disconnect(1, recorder(1))
+    await asyncio.sleep(0.03)
+    assert recorder.calls == []
+    # the "off" message of the other worker was lost, the next snapshot doesn't list the user
+    first.on_remote({"w": "other", "on": [2], "all": True})
+    await asyncio.sleep(0)
+    assert recorder.calls == [1]
+    assert first.online_elsewhere(2)
+
+
+@pytest.mark.asyncio
+async def test_silent_worker_expires():
+    recorder = OfflineRecorder()
+    first = PresenceManager(grace=0.01, sync_interval=0.01)
+    first.publish = lambda message: None
+    first.on_remote({"w": "gone", "on": [1]})
+    first.start()
+    try:
+        await first.connect(1)
+        first.disconnect(1, recorder(1))
+        await asyncio.sleep(0.1)
+    finally:
+        await first.stop()
+    assert recorder.calls == [1]
+    assert first.stats()["remote_workers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_own_messages_are_ignored():
+    presence = PresenceManager()
+    presence.on_remote({"w": presence.worker_id, "on": [1]})
+    assert not presence.online_elsewhere(1)
@@ -0,0 +1,107 @@
+import pytest
+from aiohttp import WSMsgType
+
+from src.application.ws.base import WsClient
+from src.application.ws.ratelimit import RateLimiter, RateLimitConfig, TokenBucket, parse_costs
+from src.application.ws.server import WebSocketServer
+from src.core.exceptions.base import ThrottledError, ValidationError
+from tests.ws.frames import receive
+
+
+class FakeSession:
+    bucket = None
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def limiter_with(clock, **kwargs):
+    limiter = RateLimiter(RateLimitConfig(**kwargs))
+    limiter._now = clock
+    return limiter
+
+
+def test_bucket_refill_is_capped():
+    bucket = TokenBucket(rate=2, burst=4, now=0)
+    bucket.tokens = 0
+    assert bucket.refill(1) == 2
+    assert bucket.refill(10) == 4
+    assert bucket.retry_after(5) == 0.5
+
+
+def test_session_burst_then_throttled():
+    clock = Clock()
+    limiter = limiter_with(clock, session_rate=1, session_burst=3, user_rate=100, user_burst=100)
+    session, client = FakeSession(), WsClient(user_id=1)
+    limiter.attach(session, client)
+    for _ in range(3):
+        limiter.check(session, client, "room")
+    with pytest.raises(ThrottledError) as e:
+        limiter.check(session, client, "room")
+    assert e.value.to_dict()["error"] == {"message": "Too many requests", "code": 7, "retry_after": 1.0}
+    clock.now += 1
+    limiter.check(session, client, "room")
+    assert limiter.throttled == 1
+
+
+def test_user_bucket_is_shared_by_sessions():
+    clock = Clock()
+    limiter = limiter_with(clock, session_rate=1, session_burst=10, user_rate=1, user_burst=4)
+    client = WsClient(user_id=1)
+    first, second = FakeSession(), FakeSession()
+    limiter.attach(first, client)
+    limiter.attach(second, client)
+    for _ in range(2):
+        limiter.check(first, client, "room")
+        limiter.check(second, client, "room")
+    with pytest.raises(ThrottledError):
+        limiter.check(second, client, "room")
+    # rejected event doesn't take tokens from the session bucket
+    assert second.bucket.tokens == 8
+
+
+def test_resource_cost():
+    clock = Clock()
+    limiter = limiter_with(clock, session_rate=1, session_burst=6, costs=parse_costs("room:2"))
+    session, client = FakeSession(), WsClient(user_id=1)
+    limiter.attach(session, client)
+    limiter.check(session, client, "user")
+    with pytest.raises(ThrottledError):
+        limiter.check(session, client, "room")
+    limiter.check(session, client, "message")
+
+
+def test_disabled():
+    limiter = limiter_with(Clock(), enabled=False, session_burst=0)
+    session, client = FakeSession(), WsClient(user_id=1)
+    limiter.attach(session, client)
+    limiter.check(session, client, "user")
+
+
+def test_frame_tokens_count_toward_the_event():
+    clock = Clock()
+    limiter = limiter_with(clock, session_rate=1, session_burst=6, user_rate=100, user_burst=100)
+    session, client = FakeSession(), WsClient(user_id=1)
+    limiter.attach(session, client)
+    limiter.check_frame(session, client)
+    limiter.check(session, client, "user", prepaid=limiter.FRAME_COST)
+    assert session.bucket.tokens == 1
+    limiter.check_frame(session, client)
+    with pytest.raises(ThrottledError):
+        limiter.check_frame(session, client)
+
+
+@pytest.mark.asyncio
+async def test_malformed_frames_are_throttled():
+    server = WebSocketServer(user_repo=None, ws_connection_repo={},
+                             rate_limit=RateLimitConfig(session_rate=0.001, session_burst=3))
+    valid = '{"type": "query", "resource": "room", "payload": {}}'
+    sent = await receive(server, [(WSMsgType.TEXT, "{")] * 2 + [(WSMsgType.TEXT, '{"type": "x"}'),
+                                                                 (WSMsgType.TEXT, "{"), (WSMsgType.TEXT, valid)])
+    assert [data["error"]["code"] for data in sent] == [ValidationError.code] * 3 + [ThrottledError.code] * 2
+    assert server.rate_limiter.throttled == 2
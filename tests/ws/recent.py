@@ -0,0 +1,159 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.application.codec import JsonCodec
+from src.application.handlers.websocket.query import MessageQueryHandler
+from src.application.ws.event import Query
+from src.application.adapters import MessageSchema, message_data
+from src.application.ws.recent import RecentMessageCache, ENTRY_OVERHEAD
+from src.core.entity.user import Message
+from src.data.user.repo import UserRepo
+
+
+NOW = datetime(2022, 5, 1, 12, 0, 0)
+
+
+def message(message_id, room_id=1, body="hello"):
+    return Message(id=message_id, room_id=room_id, creator_id=1, msg_type=1, msg_body=body,
+                   created_at=NOW + timedelta(seconds=message_id), updated_at=NOW)
+
+
+def ids(items):
+    return [item["id"] if isinstance(item, dict) else item.id for item in items]
+
+
+def test_message_data_is_the_schema_projection():
+    data = message_data(message(1))
+    assert data == MessageSchema().dump(message(1))
+    assert JsonCodec().loads(JsonCodec().dumps(data)) == data
+
+
+def test_page_and_append():
+    cache = RecentMessageCache(per_room=5)
+    assert cache.page(1, 3) is None
+    cache.fill(1, [message(i) for i in range(1, 6)], older=True)
+    messages, items, has_more = cache.page(1, 3)
+    assert ids(items) == [3, 4, 5] and ids(messages) == [3, 4, 5] and has_more
+    cache.append(message(6))
+    cache.append(message(7, room_id=2))
+    assert ids(cache.page(1, 5)[1]) == [2, 3, 4, 5, 6]
+    assert len(cache) == 1
+    # the window is full, deeper pages go to the database
+    assert cache.page(1, 6) is None
+
+
+def test_small_room_is_complete():
+    cache = RecentMessageCache(per_room=5)
+    cache.fill(1, [message(1), message(2)], older=False)
+    assert cache.page(1, 5)[1:] == ([message_data(message(1)), message_data(message(2))], False)
+    # late commit of an older message is placed in order
+    cache.append(message(3))
+    cache.append(message(3))
+    assert ids(cache.page(1, 5)[1]) == [1, 2, 3]
+
+
+def test_memory_budget_evicts_cold_rooms():
+    size = len("hello") + ENTRY_OVERHEAD
+    cache = RecentMessageCache(per_room=10, max_bytes=size * 4)
+    cache.fill(1, [message(1, 1), message(2, 1)], older=False)
+    cache.fill(2, [message(3, 2), message(4, 2)], older=False)
+    cache.page(1, 1)
+    cache.fill(3, [message(5, 3)], older=False)
+    assert cache.page(2, 1) is None
+    assert cache.page(1, 1) is not None
+    assert cache.stats()["bytes"] == size * 3
+
+
+class Repo:
+    MessageSearchSpec = UserRepo.MessageSearchSpec
+
+    def __init__(self, n):
+        self.messages = [message(i) for i in range(1, n + 1)]
+        self.reads = 0
+
+    async def get_messages(self, spec):
+        self.reads += 1
+        items = sorted(self.messages, key=lambda item: (item.created_at, item.id))
+        if spec.before:
+            items = [item for item in items if (item.created_at, item.id) < spec.before]
+        return items[-spec.limit:]
+
+
+class Session:
+    def __init__(self):
+        self.sent = []
+
+    def send_json(self, data):
+        self.sent.append(data)
+
+
+async def latest(handler, **payload):
+    session = Session()
+    await handler.handle(Query(resource="message", payload=dict(room_id=1, **payload)), session)
+    return session.sent[-1]
+
+
+@pytest.mark.asyncio
+async def test_latest_page_from_cache():
+    repo = Repo(30)
+    cache = RecentMessageCache(per_room=20)
+    handler = MessageQueryHandler(repo, page_size=10, recent_messages=cache)
+    uncached = await latest(MessageQueryHandler(repo, page_size=10))
+    first = await latest(handler)
+    second = await latest(handler)
+    assert repo.reads == 2
+    assert ids(first["response"]) == ids(second["response"]) == ids(uncached["response"]) == list(range(21, 31))
+    assert second["has_more"] and second["before"] == uncached["before"]
+    assert second["cursor"] == uncached["cursor"]
+
+    cache.append(message(31))
+    assert ids((await latest(handler, limit=3))["response"]) == [29, 30, 31]
+    older = await latest(handler, before=second["before"])
+    assert ids(older["response"]) == list(range(11, 21))
+    assert repo.reads == 3
+
+
+class SlowRepo(Repo):
+    def __init__(self, n):
+        super().__init__(n)
+        self.reading = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def get_messages(self, spec):
+        # the snapshot is taken before the concurrent write commits
+        items = await super().get_messages(spec)
+        self.reading.set()
+        await self.release.wait()
+        return items
+
+
+@pytest.mark.asyncio
+async def test_append_during_first_fill_is_kept():
+    repo = SlowRepo(5)
+    cache = RecentMessageCache(per_room=20)
+    handler = MessageQueryHandler(repo, page_size=10, recent_messages=cache)
+    read = asyncio.ensure_future(latest(handler))
+    await repo.reading.wait()
+    repo.messages.append(message(6))
+    cache.append(message(6))
+    repo.release.set()
+    assert ids((await read)["response"]) == [1, 2, 3, 4, 5]
+    assert ids((await latest(handler))["response"]) == [1, 2, 3, 4, 5, 6]
+    assert repo.reads == 1
+    assert cache.stats()["filling"] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_fill_stops_collecting():
+    class FailingRepo(Repo):
+        async def get_messages(self, spec):
+            raise RuntimeError("db is down")
+
+    cache = RecentMessageCache(per_room=20)
+    handler = MessageQueryHandler(FailingRepo(0), page_size=10, recent_messages=cache)
+    with pytest.raises(RuntimeError):
+        await latest(handler)
+    cache.append(message(1))
+    assert cache.stats()["filling"] == 0 and len(cache) == 0
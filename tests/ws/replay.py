@@ -0,0 +1,62 @@
+import json
+
+from src.application.codec import JsonCodec
+from src.application.ws.base import Frame, Priority, ReplayBuffer, SequencedFrame, WsClient
+from src.application.ws.server import WebSocketServer
+
+
+def buffer_with(count, **kwargs):
+    replay = ReplayBuffer(**kwargs)
+    for seq in range(1, count + 1):
+        replay.append(SequencedFrame(Frame({"n": seq}), seq))
+    return replay
+
+
+def test_sequenced_frame_reuses_shared_encoding():
+    codec = JsonCodec()
+    frame = Frame({"n": 1})
+    shared = frame.encode(codec)
+    sequenced = SequencedFrame(frame, 5)
+    assert json.loads(sequenced.encode(codec)) == {"seq": 5, "n": 1}
+    assert sequenced.data == {"seq": 5, "n": 1}
+    assert frame.encode(codec) is shared
+
+
+def test_since():
+    replay = buffer_with(5)
+    assert [frame.seq for frame in replay.since(2)] == [3, 4, 5]
+    assert replay.since(5) == []
+    assert replay.since(0) is not None
+    # seq from the future, e.g. another worker
+    assert replay.since(6) is None
+
+
+def test_eviction_by_count_makes_gap():
+    replay = buffer_with(5, max_events=3)
+    assert len(replay) == 3
+    assert [frame.seq for frame in replay.since(2)] == [3, 4, 5]
+    assert replay.since(1) is None
+
+
+def test_eviction_by_bytes():
+    size = len(JsonCodec().dumps({"n": 1}))
+    replay = buffer_with(5, max_bytes=size * 2)
+    assert len(replay) == 2
+    assert replay.size == size * 2
+
+
+def test_client_numbers_frames():
+    client = WsClient(user_id=1, replay=ReplayBuffer())
+    client.send_frame(Frame({"n": 1}))
+    client.send_frame(Frame({"n": 2}))
+    assert client.seq == 2
+    assert [frame.data for frame in client.replay.since(0)] == [{"seq": 1, "n": 1}, {"seq": 2, "n": 2}]
+
+
+def test_unencodable_broadcast_keeps_replay():
+    server = WebSocketServer(user_repo=None, ws_connection_repo={})
+    client = server.ws_clients[1] = WsClient(user_id=1, replay=server.new_replay_buffer())
+    server.deliver([1], Frame({"payload": b"\x01"}), Priority.NORMAL)
+    server.deliver([1], Frame({"n": 1}), Priority.NORMAL)
+    assert [frame.seq for frame in client.replay.since(0)] == [1]
+    assert server.stats()["encode_errors"] == 1
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import pytest
+
+from src.application.ws.base import WebsocketSession, WsClient, OverflowPolicy, Priority
+
+
+class SlowWs:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.received = []
+        self.closed = False
+
+    async def send_str(self, data):
+        await asyncio.sleep(self.delay)
+        self.received.append(json.loads(data))
+
+    async def close(self, code, message):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_broadcast_not_blocked_by_slow_session():
+    slow_ws, fast_ws = SlowWs(delay=10), SlowWs()
+    client = WsClient(user_id=1)
+    sessions = [WebsocketSession(ws, user_id=1, sid=None) for ws in (slow_ws, fast_ws)]
+    for session in sessions:
+        session.start()
+        client.add(session)
+
+    client.send_json({"n": 1})
+    await asyncio.sleep(0.01)
+
+    assert fast_ws.received == [{"n": 1}]
+    assert slow_ws.received == []
+    for session in sessions:
+        await session.stop()
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest():
+    session = WebsocketSession(SlowWs(), user_id=1, sid=None, max_queue_size=2)
+    for n in range(4):
+        session.send_json(n)
+    assert [frame.data for _, frame in session._queue] == [2, 3]
+    assert session.dropped == 2
+
+
+@pytest.mark.asyncio
+async def test_drop_low_priority():
+    session = WebsocketSession(SlowWs(), user_id=1, sid=None, max_queue_size=2,
+                               overflow_policy=OverflowPolicy.DROP_LOW_PRIORITY)
+    session.send_json("presence", Priority.LOW)
+    session.send_json("message", Priority.NORMAL)
+    assert session.send_json("message2", Priority.NORMAL)
+    assert not session.send_json("presence2", Priority.LOW)
+    assert [frame.data for _, frame in session._queue] == ["message", "message2"]
+    assert session.dropped == 2
+
+
+@pytest.mark.asyncio
+async def test_disconnect_slow_consumer():
+    ws = SlowWs()
+    session = WebsocketSession(ws, user_id=1, sid=None, max_queue_size=1,
+                               overflow_policy=OverflowPolicy.DISCONNECT)
+    session.send_json(1)
+    assert not session.send_json(2)
+    await asyncio.sleep(0)
+    assert ws.closed
+    assert session.depth == 0
+    assert not session.send_json(3)
+
+
+@pytest.mark.asyncio
+async def test_unencodable_frame_is_dropped():
+    ws = SlowWs()
+    session = WebsocketSession(ws, user_id=1, sid=None)
+    session.start()
+    session.send_json({"payload": b"\x01"})
+    session.send_json({"n": 2})
+    await session.flush()
+    assert ws.received == [{"n": 2}]
+    assert session.sent == 1 and session.dropped == 1
+    await session.stop()